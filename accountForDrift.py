@@ -10,12 +10,22 @@ def matchFrames(seq1,seq2,drift):
     # user must provide drift (see period.txt files)
     # Drift provided should be in the order (dx, dy).
     # A positive value moves the object imaged in seq2 up/left to correct for drift
+    rectF, rect = matchRects(seq1[0].shape, seq2[0].shape, drift)
+
+    seq1 = seq1[:,rectF[0]:rectF[1],rectF[2]:rectF[3]]
+    seq2 = seq2[:,rect[0]:rect[1],rect[2]:rect[3]]
+
+    return seq1,seq2
+
+def matchRects(shape1,shape2,drift):
+    # The regions of frames of shape1 and shape2 that matchFrames crops them to, as [X1,X2,Y1,Y2]
+    # (where X is the first axis of the frame). Row r of the first region lines up with row r+dy of the second.
     dx = drift[0]
     dy = drift[1]
 
     #apply shifts
-    rectF = [0,seq1[0].shape[0],0,seq1[0].shape[1]]#X1,X2,Y1,Y2
-    rect = [0,seq2[0].shape[0],0,seq2[0].shape[1]]#X1,X2,Y1,Y2
+    rectF = [0,shape1[0],0,shape1[1]]#X1,X2,Y1,Y2
+    rect = [0,shape2[0],0,shape2[1]]#X1,X2,Y1,Y2
 
     if dy<=0:
         rectF[0] = -dy
@@ -30,7 +40,4 @@ def matchFrames(seq1,seq2,drift):
         rectF[3] = rectF[3]-dx
         rect[2] = +dx
 
-    seq1 = seq1[:,rectF[0]:rectF[1],rectF[2]:rectF[3]]
-    seq2 = seq2[:,rect[0]:rect[1],rect[2]:rect[3]]
-
-    return seq1,seq2
+    return rectF,rect
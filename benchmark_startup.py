@@ -0,0 +1,74 @@
+'''Startup-time benchmark for the realtime (LTU) entry points.
+
+The acquisition software imports multifish-ltu-wrapper.py when it starts, so everything that pulls in
+(directly or indirectly) adds to its launch time. This script imports each realtime entry point
+in a fresh interpreter, reports how long that took, and checks that none of the heavyweight modules
+that only the offline analysis needs (plotting, image file I/O etc.) have been imported along the way.
+
+It exits with a non-zero status if any entry point imports one of those modules,
+or (if --max-seconds is given) takes longer than that to import, so it can be used to guard against regressions:
+    python benchmark_startup.py --max-seconds 1.0'''
+
+# Python Imports
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+repoDirectory = os.path.dirname(os.path.abspath(__file__))
+
+# Statements importing each realtime entry point (the wrapper's filename isn't a valid module name, so we load it by path)
+entryPoints = {'multifish-ltu-wrapper': "import importlib.util; spec = importlib.util.spec_from_file_location('multifish_ltu_wrapper', 'multifish-ltu-wrapper.py'); spec.loader.exec_module(importlib.util.module_from_spec(spec))",
+               'memoryCC': 'import memoryCC',
+               'simpleCC': 'import simpleCC',
+               'shifts_global_solution': 'import shifts_global_solution',
+               'accountForDrift': 'import accountForDrift'}
+
+# Modules the realtime path must not import at startup
+heavyModules = ['matplotlib', 'PIL', 'tifffile', 'tqdm', 'scipy.signal', 'scipy.ndimage', 'scipy.interpolate', 'scipy.sparse', 'scipy.linalg',
+                'image_loading', 'image_saving', 'image_class', 'shifts', 'periods']
+
+# Run in the fresh interpreter: time the import, and report which of the heavy modules ended up loaded
+timingScript = '''
+import sys, time, json
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'elapsed': elapsed, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def TimeImport(statement, pythonExecutable=sys.executable):
+    # Import time (in seconds) for statement in a fresh interpreter, and the list of heavy modules it imported
+    script = timingScript.format(statement=statement, heavy=heavyModules)
+    output = subprocess.run([pythonExecutable, '-c', script], cwd=repoDirectory, check=True,
+                            capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    return (result['elapsed'], result['heavy'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time a cold import of each realtime entry point')
+    parser.add_argument('--repeats', type=int, default=5, help='number of fresh interpreters to time each import in')
+    parser.add_argument('--max-seconds', type=float, default=None, help='fail if the median import time of any entry point exceeds this')
+    parser.add_argument('--python', default=sys.executable, help='python executable to benchmark')
+    args = parser.parse_args()
+
+    failed = False
+    for (name, statement) in entryPoints.items():
+        times = []
+        heavy = []
+        for r in range(args.repeats):
+            (elapsed, heavy) = TimeImport(statement, args.python)
+            times.append(elapsed)
+        medianTime = np.median(times)
+        print('{0:24s} median {1:6.3f}s  (min {2:.3f}s, max {3:.3f}s)'.format(name, medianTime, np.min(times), np.max(times)))
+        if len(heavy) > 0:
+            print('  FAIL: imports {0}'.format(', '.join(heavy)))
+            failed = True
+        if (args.max_seconds is not None) and (medianTime > args.max_seconds):
+            print('  FAIL: slower than {0:.3f}s'.format(args.max_seconds))
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,238 @@
+'''Benchmarks of the numerical kernels and pipeline stages of the sync and post-acquisition analysis.
+
+Each case times one kernel on a fixed, synthetic input (see synthetic_data.py), so the numbers are comparable
+between runs and between machines of the same kind. For each case we report the median (and min/max) time
+over a number of repeats, and the peak memory allocated (as seen by tracemalloc) during one further run.
+
+The results can be written out as JSON (--output), and compared against a stored baseline: any case whose time
+(its fastest run, which is the least affected by whatever else the machine is doing)
+is more than --tolerance slower than in the baseline is reported, and the script exits with a non-zero status,
+so it can be used to catch speed regressions:
+    python benchmark_suite.py --update-baseline          (on a known-good tree)
+    python benchmark_suite.py                            (after a change)
+The baseline is specific to the machine it was recorded on, so it is not kept in the repository.'''
+
+# Python Imports
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+# Local Imports
+import synthetic_data as sd
+
+repoDirectory = os.path.dirname(os.path.abspath(__file__))
+defaultBaselinePath = os.path.join(repoDirectory, 'benchmark_baseline.json')
+
+
+def ImagesFromFrames(frames, timestamps=None):
+    # Wrap frames (of order TXY) as the list of ImageClass objects that the post-acquisition code expects
+    from image_class import ImageClass
+    images = []
+    for (n, frame) in enumerate(frames):
+        image = ImageClass()
+        image.image = frame
+        image.frameIndex = n
+        image.timestamp = n if timestamps is None else timestamps[n]
+        images.append(image)
+    return images
+
+
+def SyntheticShifts(numSequences, period, rng, noise=0.5):
+    # Shifts between sequences (as from shifts.GetShifts, with its power-of-two offsets) consistent with a random-walk solution
+    solution = np.cumsum(rng.uniform(0, period, numSequences))
+    offsets = np.array([1, 2, 3, 4, 6, 8, 16, 32, 64, 128, 256, 512, 1024, 2048])
+    shifts = []
+    for i in range(numSequences):
+        for j in i + offsets[i + offsets < numSequences]:
+            shift = (solution[j] - solution[i] + rng.normal(0, noise)) % period
+            shifts.append((i, int(j), shift, rng.uniform(0.5, 2.0)))
+    return shifts
+
+
+# Each case is a function that prepares its inputs (in the given scratch directory) and returns the function to time
+
+def CrossCorrelationScoresCase(scratch):
+    import simpleCC as scc
+    (frames1, _, _, _) = sd.SyntheticSequence(80, (128, 128), period=80, seed=1)
+    (frames2, _, _, _) = sd.SyntheticSequence(80, (128, 128), period=80, seed=2)
+    (seq1, seq2) = (frames1.astype('float'), frames2.astype('float'))
+    return lambda: scc.crossCorrelationScores(seq1, seq2)
+
+
+def ResampleImageSectionCase(scratch):
+    import simpleCC as scc
+    (frames, _, _, _) = sd.SyntheticSequence(40, (256, 256), period=36.5, seed=1)
+    return lambda: scc.resampleImageSection(frames, 36.5, 80)
+
+
+def ScoreCandidatePeriodCase(scratch):
+    import periods
+    (frames, _, _, _) = sd.SyntheticSequence(120, (128, 128), period=35.5, seed=1)
+    images = ImagesFromFrames(frames)
+    return lambda: periods.ScoreCandidatePeriod(images, 35.5, 1000)
+
+
+def EstablishPeriodCase(scratch):
+    import periods
+    (frames, _, _, _) = sd.SyntheticSequence(120, (128, 128), period=35.5, seed=1)
+    images = ImagesFromFrames(frames)
+    return lambda: periods.EstablishPeriodForImageSequence(images, np.arange(20, 50, 0.5))
+
+
+def CorrectForDriftCase(scratch):
+    import drift_correction
+    (frames, _, _, _) = sd.SyntheticSequence(16 * 80, (96, 96), period=80, wander=0.05, seed=1)
+    sections = [ImagesFromFrames(frames[n:n + 80].astype('float')) for n in range(0, len(frames), 80)]
+    return lambda: drift_correction.CorrectForDrift(sections, 80)
+
+
+def MakeShiftsSelfConsistentCase(numSequences):
+    def case(scratch):
+        import shifts_global_solution as sgs
+        shifts = SyntheticShifts(numSequences, 80, np.random.default_rng(1))
+        # (as the offline analysis calls it, choosing the sparse solver for large problems)
+        return lambda: sgs.MakeShiftsSelfConsistent(shifts, numSequences, 80, log=False, sparse=None)
+    return case
+
+
+def InterpolateWithPhaseWrapCase(scratch):
+    from phase_wrap_interpolation import interpolate_with_phase_wrap
+    rng = np.random.default_rng(1)
+    knownTimes = np.arange(200000) / 80.0
+    knownPhases = (2 * np.pi * knownTimes / 0.45) % (2 * np.pi)
+    unknownTimes = np.sort(rng.uniform(knownTimes[0], knownTimes[-1], 20000))
+    return lambda: interpolate_with_phase_wrap(unknownTimes, knownTimes, knownPhases)
+
+
+def LoadImageFileCase(scratch):
+    import image_loading
+    (frames, _, _, _) = sd.SyntheticSequence(100, (256, 256), period=35.5, seed=1)
+    framesMetadata = [{'frame_number': n, 'time_processing_started': n / 80.0, 'time_exposed': n / 80.0} for n in range(len(frames))]
+    imagePath = os.path.join(scratch, '000000.tif')
+    sd.WriteImageFile(imagePath, frames, framesMetadata, {'binning_code': 0}, 3)
+    return lambda: image_loading.LoadImageFile(imagePath, True, 1, 0, None, None, 'time_processing_started')
+
+
+def ResaveMetadataAfterEditingCase(scratch):
+    import image_loading
+    import image_saving
+    path = os.path.join(scratch, 'resave')
+    sd.WriteSyntheticDataset(path, numFrames=2000, shape=(16, 16), fluorescenceEvery=None, framesPerFile=100)
+    (images, _) = image_loading.LoadAllImages(path + '/brightfield', loadImageData=False, saveCache=False, log=False)
+    for image in images:
+        image._frameMetadata['postacquisition_phase'] = 1.0
+    return lambda: image_saving.ResaveMetadataAfterEditing(images)
+
+
+cases = {'crossCorrelationScores': CrossCorrelationScoresCase,
+         'resampleImageSection': ResampleImageSectionCase,
+         'ScoreCandidatePeriod': ScoreCandidatePeriodCase,
+         'EstablishPeriodForImageSequence': EstablishPeriodCase,
+         'CorrectForDrift': CorrectForDriftCase,
+         'MakeShiftsSelfConsistent/100': MakeShiftsSelfConsistentCase(100),
+         'MakeShiftsSelfConsistent/400': MakeShiftsSelfConsistentCase(400),
+         'MakeShiftsSelfConsistent/1600': MakeShiftsSelfConsistentCase(1600),
+         'interpolate_with_phase_wrap': InterpolateWithPhaseWrapCase,
+         'LoadImageFile': LoadImageFileCase,
+         'ResaveMetadataAfterEditing': ResaveMetadataAfterEditingCase}
+
+
+def RunCase(function, repeats):
+    # Time repeats runs of function (after one warm-up run), then measure its peak memory in one more run.
+    # The code under test reports its progress (tqdm etc), which we hide.
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        function()
+        times = []
+        for r in range(repeats):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        # (tracemalloc slows things down, so it is kept out of the timed runs)
+        tracemalloc.start()
+        try:
+            function()
+            peakBytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {'median': float(np.median(times)), 'min': float(np.min(times)), 'max': float(np.max(times)),
+            'repeats': repeats, 'peakBytes': int(peakBytes)}
+
+
+def Environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(), 'time': time.time()}
+
+
+def CompareWithBaseline(results, baseline, tolerance):
+    # The cases whose fastest run is more than tolerance (a fraction) slower than in baseline, as (name, baseline time, time)
+    regressions = []
+    for (name, result) in results.items():
+        if name in baseline['cases']:
+            baselineTime = baseline['cases'][name]['min']
+            if result['min'] > baselineTime * (1 + tolerance):
+                regressions.append((name, baselineTime, result['min']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the sync and post-acquisition kernels, and compare against a baseline')
+    parser.add_argument('--filter', default=None, help='only run the cases whose name contains this')
+    parser.add_argument('--repeats', type=int, default=5, help='number of timed runs of each case')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=defaultBaselinePath, help='baseline results to compare against (if it exists)')
+    parser.add_argument('--update-baseline', action='store_true', help='save the results as the new baseline, rather than comparing against it')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='fractional slow-down relative to the baseline that counts as a regression')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        print('\n'.join(cases))
+        sys.exit(0)
+
+    results = {}
+    scratch = tempfile.mkdtemp(prefix='benchmark_suite_')
+    try:
+        for (name, case) in cases.items():
+            if (args.filter is not None) and (args.filter not in name):
+                continue
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                function = case(scratch)
+            results[name] = RunCase(function, args.repeats)
+            result = results[name]
+            print('{0:32s} median {1:9.2f}ms  (min {2:.2f}ms, max {3:.2f}ms)  peak {4:8.1f} MB'.format(
+                  name, 1e3 * result['median'], 1e3 * result['min'], 1e3 * result['max'], result['peakBytes'] / 1e6))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    output = {'environment': Environment(), 'cases': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.update_baseline:
+        if os.path.exists(args.baseline):
+            # Keep the baseline for any cases we didn't run this time
+            with open(args.baseline) as f:
+                output['cases'] = dict(json.load(f)['cases'], **results)
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=2)
+        print('Saved baseline to {0}'.format(args.baseline))
+        sys.exit(0)
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = CompareWithBaseline(results, baseline, args.tolerance)
+        for (name, baselineTime, fastest) in regressions:
+            print('  SLOWER: {0} {1:.2f}ms -> {2:.2f}ms ({3:+.0f}%)'.format(name, 1e3 * baselineTime, 1e3 * fastest, 100 * (fastest / baselineTime - 1)))
+        print('{0} of {1} cases slower than the baseline by more than {2:.0f}%'.format(len(regressions), len(results), 100 * args.tolerance))
+    sys.exit(1 if len(regressions) > 0 else 0)
@@ -0,0 +1,221 @@
+'''Compressed representation of the reference frames, for comparing sequences in the LTU.
+
+The SSD scores between two resampled sequences only depend on the inner products between their frames,
+and most of the variation between reference frames (the heart beating) lies in a handful of directions in pixel space.
+FrameEmbedding keeps a small basis (the top principal components of the recent reference frames, updated incrementally
+as each new reference sequence arrives) and projects each sequence onto it, so that it is represented by a
+(numFrames x numComponents) coefficient matrix rather than by its pixels. memoryCC can then score the shifts between
+two sequences using their coefficients (see embedding in memoryCC.processNewReferenceSequence), which costs
+numComponents rather than height*width per frame.
+
+The basis covers a fixed region in absolute coordinates (frame coordinates minus the cumulative drift of the sequence,
+as in motion_roi), so that the same point on the fish is always projected onto the same basis pixel. This is the frame
+of the first sequence seen, less a margin to leave room for drift. A sequence that has drifted so far that the region
+is no longer inside its frame has no coefficients, and has to be compared using its pixels instead. The strips of the
+overlap between two sequences that lie outside the region (along the edges of the frame) are compared using their pixels,
+so that the scores cover the same pixels as a purely pixel-based comparison would. For that, we keep the temporal FFTs
+of just the bands of each sequence outside the region, which are a small fraction of the frame.'''
+
+# Python Imports
+import numpy as np
+# Local Imports
+import scoring_kernel as sk
+import simpleCC as scc
+import motion_roi as mr
+
+
+class FrameEmbedding(object):
+
+    def __init__(self, numComponents=16, driftMargin=8, decay=0.95):
+        # numComponents: size of the basis
+        # driftMargin: number of pixels the region covered by the basis is inset from the edge of the first frame,
+        #   to leave room for drift
+        # decay: weight given to the frames seen previously, relative to a new sequence, each time the basis is updated
+        #   (so that the basis follows gradual changes in the fish over a long timelapse)
+        self.numComponents = numComponents
+        self.driftMargin = driftMargin
+        self.decay = decay
+        self.reset()
+
+    def reset(self):
+        # Region covered by the basis in absolute coordinates, as [X1,X2,Y1,Y2] (see accountForDrift.matchRects)
+        self.box = None
+        # Mean frame and basis (one component per row) over the pixels of that region, and the singular value of each component
+        self.mean = None
+        self.components = None
+        self.singularValues = None
+        # Effective number of frames the basis is based on (older frames count for less - see decay)
+        self.numFrames = 0.0
+        # History index -> (coefficient matrix, residual energy) for the sequences we may still be asked to compare
+        self.coefficients = {}
+        # History index -> list of (fft, energy, band) for each of the bands of the frame outside our region (see edgeBands),
+        # for the same sequences
+        self.edgeTerms = {}
+        # Region (within the basis region) -> transform of the coefficients for comparing over just that region (see regionTransform)
+        self.regionTransforms = {}
+
+    def region(self, frameShape, cumulativeDrift):
+        # Our region in the frame coordinates of a sequence with the given cumulative drift (in x,y order),
+        # or None if it is not entirely inside the frame
+        (dx, dy) = (int(cumulativeDrift[0]), int(cumulativeDrift[1]))
+        rect = [self.box[0] + dy, self.box[1] + dy, self.box[2] + dx, self.box[3] + dx]
+        if (rect[0] < 0) or (rect[1] > frameShape[0]) or (rect[2] < 0) or (rect[3] > frameShape[1]):
+            return None
+        return rect
+
+    def edgeBands(self, frameShape, cumulativeDrift):
+        # The parts of a frame with the given cumulative drift that are outside our region (which should be inside the frame),
+        # in absolute coordinates, as the four bands [above, below, left, right] (any of which may be empty)
+        (dx, dy) = (int(cumulativeDrift[0]), int(cumulativeDrift[1]))
+        return self.strips([-dy, frameShape[0] - dy, -dx, frameShape[1] - dx])
+
+    def addSequence(self, index, sequence, cumulativeDrift, numSamplesPerPeriod):
+        # Update the basis with a new resampled sequence (of order TXY, at history index index), and store its coefficients,
+        # along with the spectral terms (see simpleCC.spectralTerms) of the bands of the frame outside our region.
+        # Returns False if the sequence could not be embedded (because it has drifted too far).
+        frameShape = np.shape(sequence)[1:]
+        if self.box is None:
+            margin = min(self.driftMargin, (min(frameShape) - 1) // 2)
+            (dx, dy) = (int(cumulativeDrift[0]), int(cumulativeDrift[1]))
+            self.box = [margin - dy, frameShape[0] - margin - dy, margin - dx, frameShape[1] - margin - dx]
+        rect = self.region(frameShape, cumulativeDrift)
+        if rect is None:
+            return False
+        frames = np.reshape(np.asarray(sequence[:, rect[0]:rect[1], rect[2]:rect[3]], dtype='float'), (len(sequence), -1))
+
+        (oldMean, oldComponents) = (self.mean, self.components)
+        self.fit(frames)
+        if oldComponents is not None:
+            # Re-express the coefficients we already have in terms of the new basis
+            # (anything outside the old basis was already discarded, so this is as good as re-projecting them)
+            rotation = self.components @ oldComponents.T
+            offset = self.components @ (oldMean - self.mean)
+            for (i, (coefficients, residual)) in self.coefficients.items():
+                self.coefficients[i] = (coefficients @ rotation.T + offset, residual)
+
+        centred = frames - self.mean
+        coefficients = centred @ self.components.T
+        # The energy that the basis doesn't capture, which still contributes to the pixel-based scores
+        residual = max(0.0, np.vdot(centred, centred) - np.vdot(coefficients, coefficients))
+        self.coefficients[index] = (coefficients, residual)
+        self.edgeTerms[index] = self.edgeSpectralTerms(sequence, cumulativeDrift, numSamplesPerPeriod)
+        return True
+
+    def edgeSpectralTerms(self, sequence, cumulativeDrift, numSamplesPerPeriod):
+        # The spectral terms (see simpleCC.spectralTerms) of each of the edge bands of sequence, as a list of (fft, energy, band).
+        # The bands are thin, so rather than resampling and transforming them one by one, we do them all together
+        # as a single column of pixels, and then split the result back up.
+        (dx, dy) = (int(cumulativeDrift[0]), int(cumulativeDrift[1]))
+        bands = self.edgeBands(np.shape(sequence)[1:], cumulativeDrift)
+        shapes = [(max(0, band[1] - band[0]), max(0, band[3] - band[2])) for band in bands]
+        pixels = np.concatenate([np.reshape(sequence[:, band[0]+dy:band[0]+dy+shape[0], band[2]+dx:band[2]+dx+shape[1]], (len(sequence), -1))
+                                 for (band, shape) in zip(bands, shapes)], axis=1)
+        (fft, energy) = scc.spectralTerms(pixels[:, :, np.newaxis], numSamplesPerPeriod)
+        terms = []
+        start = 0
+        for (band, shape) in zip(bands, shapes):
+            end = start + shape[0] * shape[1]
+            terms.append((fft[:, start:end, 0].reshape((len(fft),) + shape), energy[start:end, 0].reshape(shape), band))
+            start = end
+        return terms
+
+    def fit(self, frames):
+        # Incremental PCA: update the mean and basis with new frames (of order T(XY)), without revisiting the old frames.
+        # The previous basis (scaled by its singular values) stands in for all the frames seen so far.
+        numNew = len(frames)
+        frameMean = np.mean(frames, axis=0)
+        if self.components is None:
+            data = frames - frameMean
+            self.mean = frameMean
+            self.numFrames = float(numNew)
+        else:
+            numOld = self.decay * self.numFrames
+            # The correction for the change in mean (see Ross et al., Incremental learning for robust visual tracking, 2008)
+            meanCorrection = np.sqrt(numOld * numNew / (numOld + numNew)) * (self.mean - frameMean)
+            data = np.vstack([np.sqrt(self.decay) * self.singularValues[:, np.newaxis] * self.components,
+                              frames - frameMean,
+                              meanCorrection[np.newaxis]])
+            self.mean = self.mean + (frameMean - self.mean) * numNew / (numOld + numNew)
+            self.numFrames = numOld + numNew
+        self.regionTransforms = {}
+        # data has far fewer rows than columns, so it is much quicker to find its singular vectors from the small Gram matrix
+        # than with a full SVD
+        (eigenvalues, eigenvectors) = np.linalg.eigh(data @ data.T)
+        keep = np.argsort(eigenvalues)[::-1][:self.numComponents]
+        keep = keep[eigenvalues[keep] > 1e-12 * max(eigenvalues[keep[0]], 1e-300)]
+        self.singularValues = np.sqrt(eigenvalues[keep])
+        self.components = (eigenvectors[:, keep].T @ data) / self.singularValues[:, np.newaxis]
+
+    def canCompare(self, i, j):
+        return (i in self.coefficients) and (j in self.coefficients)
+
+    def regionTransform(self, region):
+        # Matrix T such that |(c1 - c2) T|^2 is the squared distance, over just the pixels in region (in absolute coordinates,
+        # and inside our basis region), between the frames with coefficients c1 and c2 (within the basis).
+        # That is (c1 - c2) G (c1 - c2), where G is the Gram matrix of the components restricted to region.
+        key = tuple(region)
+        if key not in self.regionTransforms:
+            components = self.components.reshape((len(self.components), self.box[1] - self.box[0], self.box[3] - self.box[2]))
+            components = components[:, region[0]-self.box[0]:region[1]-self.box[0], region[2]-self.box[2]:region[3]-self.box[2]]
+            components = components.reshape(len(components), -1)
+            (eigenvalues, eigenvectors) = np.linalg.eigh(components @ components.T)
+            self.regionTransforms[key] = eigenvectors * np.sqrt(np.maximum(eigenvalues, 0))[np.newaxis, :]
+        return self.regionTransforms[key]
+
+    def shiftScores(self, i, j, numSamplesPerPeriod, region):
+        # Equivalent of crossCorrelationScoresFromSpectra for history entries i and j (see canCompare), for comparing the frames
+        # over region (in absolute coordinates, as [X1,X2,Y1,Y2]). The part of region inside our basis region is compared using
+        # the coefficients, which are resampled in time just as the pixels would be, with the energy outside the basis added back in.
+        # The rest of region is compared using the spectra of the edge bands. Returns None if region doesn't overlap our basis region.
+        common = mr.boxIntersection(self.box, region)
+        if mr.boxArea(common) == 0:
+            return None
+        transform = self.regionTransform(common)
+        (coefficients1, residual1) = self.coefficients[i]
+        (coefficients2, residual2) = self.coefficients[j]
+        seq1 = scc.scoringSequence(coefficients1 @ transform, numSamplesPerPeriod)
+        seq2 = scc.scoringSequence(coefficients2 @ transform, numSamplesPerPeriod)
+        scale = len(seq1) / len(coefficients1)
+        # (the residual energy is spread across the basis region, so only part of it falls within common)
+        commonFraction = mr.boxArea(common) / mr.boxArea(self.box)
+        scores = sk.shiftScores(seq1, seq2) + scale * commonFraction * (residual1 + residual2)
+        # Each strip of region outside our region lies within the corresponding edge band of both frames
+        # (since region is inside both frames, and our region is inside both of them too)
+        for (strip, terms1, terms2) in zip(self.strips(region), self.edgeTerms[i], self.edgeTerms[j]):
+            if mr.boxArea(strip) > 0:
+                scores = scores + scc.crossCorrelationScoresFromSpectra(*croppedTerms(terms1, strip), *croppedTerms(terms2, strip))
+        return scores
+
+    def strips(self, region):
+        # The strips of region (in absolute coordinates) outside our basis region (which region should overlap),
+        # as the four non-overlapping rects [above, below, left, right], any of which may be empty
+        common = mr.boxIntersection(self.box, region)
+        return [[region[0], common[0], region[2], region[3]],
+                [common[1], region[1], region[2], region[3]],
+                [common[0], common[1], region[2], common[2]],
+                [common[0], common[1], common[3], region[3]]]
+
+    def release(self, keepFrom):
+        # Forget the coefficients (and edge terms) of the sequences before keepFrom, which will not be compared against again
+        for i in [i for i in self.coefficients if i < keepFrom]:
+            del self.coefficients[i]
+            del self.edgeTerms[i]
+
+    def trim(self, trimToLength):
+        # Forget the coefficients (and edge terms) of the sequences trimmed from the history
+        for i in [i for i in self.coefficients if i >= trimToLength]:
+            del self.coefficients[i]
+            del self.edgeTerms[i]
+
+    @property
+    def nbytes(self):
+        arrays = [self.mean, self.components] + [coefficients for (coefficients, residual) in self.coefficients.values()]
+        arrays += [a for terms in self.edgeTerms.values() for (fft, energy, band) in terms for a in (fft, energy)]
+        return sum(a.nbytes for a in arrays if a is not None)
+
+
+def croppedTerms(terms, rect):
+    # (fft, energy) from an entry of FrameEmbedding.edgeTerms, cropped to rect (in absolute coordinates, and inside its band)
+    (fft, energy, band) = terms
+    return (fft[:, rect[0]-band[0]:rect[1]-band[0], rect[2]-band[2]:rect[3]-band[2]],
+            energy[rect[0]-band[0]:rect[1]-band[0], rect[2]-band[2]:rect[3]-band[2]])
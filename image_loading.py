@@ -148,9 +148,10 @@ def MyHash(runningHash, b):
         b = str(b)
     runningHash.update(b.encode('utf-8'))
 
-def LoadOrCacheImagesFromFileList(fileList, loadImageData, downsampleFactor, frameIndexStart, periodRange, plotAllPeriods, cropRect, cropFollowsZ, timestampKey, saveCache=True, lateStart=0, earlyTruncation = -1, log=True):
+def LoadOrCacheImagesFromFileList(fileList, loadImageData, downsampleFactor, frameIndexStart, periodRange, plotAllPeriods, cropRect, cropFollowsZ, timestampKey, saveCache=True, lateStart=0, earlyTruncation = -1, log=True, adaptivePeriodSearch=False):
     # Loads a sequence of images from fileList
     # For performance reasons, we cache the numpy array so we can load faster if rerunning the same code
+    # adaptivePeriodSearch selects the coarse-to-fine search for the initial period estimate (see periods.AdaptivePeriodSearch)
 
     if (len(fileList) == 0):
         return (None, np.nan)
@@ -212,7 +213,7 @@ def LoadOrCacheImagesFromFileList(fileList, loadImageData, downsampleFactor, fra
     if (loadImageData and (periodRange is not None)):
         # Estimate approximate period.
         numImagesToUseForPeriodEstimation = min(int(periodRange[-1] * 12), len(images))
-        averagePeriod = EstablishPeriodForImageSequence(images[0:numImagesToUseForPeriodEstimation], periodRange = periodRange, plotAllPeriods = plotAllPeriods)
+        averagePeriod = EstablishPeriodForImageSequence(images[0:numImagesToUseForPeriodEstimation], periodRange = periodRange, plotAllPeriods = plotAllPeriods, adaptive = adaptivePeriodSearch)
         if log:
             print('estimated average(ish) period', averagePeriod, 'from first', numImagesToUseForPeriodEstimation, 'images')
     else:
@@ -221,7 +222,7 @@ def LoadOrCacheImagesFromFileList(fileList, loadImageData, downsampleFactor, fra
     return (images, averagePeriod)
 
 
-def LoadAllImages(path, loadImageData = True, downsampleFactor = 1, frameIndexStart = 0, earlyTruncation = -1, periodRange = None, plotAllPeriods=False, cropRect=None, cropFollowsZ=None, timestampKey='time_processing_started', lateStart=0, saveCache=True, log=True):
+def LoadAllImages(path, loadImageData = True, downsampleFactor = 1, frameIndexStart = 0, earlyTruncation = -1, periodRange = None, plotAllPeriods=False, cropRect=None, cropFollowsZ=None, timestampKey='time_processing_started', lateStart=0, saveCache=True, log=True, adaptivePeriodSearch=False):
     # Load all images found in the directory at 'path'.
     # We also do a rough estimate the average heart period at the start of the dataset (because that is a useful guide for later sync processing)
     # We skip any invisible files (starting with '.') since on OS X the Preview program sometimes creates invisible mirror files when opening tiff stacks.
@@ -229,17 +230,17 @@ def LoadAllImages(path, loadImageData = True, downsampleFactor = 1, frameIndexSt
     for file in os.listdir(path):
         if ((not file.startswith(".")) and (file.endswith(".tif") or file.endswith(".tiff"))):
             fileList.append(path+'/'+file)
-    return LoadOrCacheImagesFromFileList(sorted(fileList), loadImageData, downsampleFactor, frameIndexStart, periodRange, plotAllPeriods, cropRect, cropFollowsZ, timestampKey,saveCache,lateStart=lateStart,earlyTruncation=earlyTruncation,log=log)
+    return LoadOrCacheImagesFromFileList(sorted(fileList), loadImageData, downsampleFactor, frameIndexStart, periodRange, plotAllPeriods, cropRect, cropFollowsZ, timestampKey,saveCache,lateStart=lateStart,earlyTruncation=earlyTruncation,log=log,adaptivePeriodSearch=adaptivePeriodSearch)
 
 
-def LoadImages(path, format, firstImage, numImagesToProcess, loadImageData = True, downsampleFactor = 1, frameIndexStart = 0, periodRange = np.arange(20, 50, 0.1), plotAllPeriods=False, cropRect=None, cropFollowsZ=None, timestampKey='time_processing_started',saveCache=True, log=True):
+def LoadImages(path, format, firstImage, numImagesToProcess, loadImageData = True, downsampleFactor = 1, frameIndexStart = 0, periodRange = np.arange(20, 50, 0.1), plotAllPeriods=False, cropRect=None, cropFollowsZ=None, timestampKey='time_processing_started',saveCache=True, log=True, adaptivePeriodSearch=False):
     # Load the source images and metadata for all images found at 'path' that match the supplied filename format with indices given by firstImage and numImagesToProcess.
     # We also do a rough estimate the average heart period at the start of the dataset (because that is a useful guide for later sync processing)
     fileList = []
     for i in range(firstImage, firstImage+numImagesToProcess):
         imagePath = (format % (path, i))
         fileList.append(imagePath)
-    return LoadOrCacheImagesFromFileList(fileList, loadImageData, downsampleFactor, frameIndexStart, periodRange, plotAllPeriods, cropRect, cropFollowsZ, timestampKey,saveCache,log=log)
+    return LoadOrCacheImagesFromFileList(fileList, loadImageData, downsampleFactor, frameIndexStart, periodRange, plotAllPeriods, cropRect, cropFollowsZ, timestampKey,saveCache,log=log,adaptivePeriodSearch=adaptivePeriodSearch)
 
 def ImagesToArray(images):
     # Converts a list of image objects into a 3D numpy array
@@ -0,0 +1,142 @@
+'''Logging for the realtime LTU (memoryCC, simpleCC, shifts_global_solution and multifish-ltu-wrapper.py).
+
+Messages go through the standard logging module, to the 'ltu' logger, which writes them to stdout
+(where the GUI picks them up, interleaved with its own output). The level decides how much is written:
+* INFO (the default): one line per update, plus anything unusual
+* DEBUG: everything, including the shifts, drift history, solution and residuals, which all grow with the history
+Large payloads are passed to the logger as arguments (wrapped in Pretty where they used to be pprinted),
+so they are only formatted if the message is actually going to be written.
+
+Unlike a plain logging.StreamHandler, we don't flush stdout after every message: callers call flushOutput() once,
+at the end of each update, so that our output is in the right order relative to the GUI's printf output.
+
+Detailed per-update diagnostics can also be written to a trace file (see enableTrace), one JSON object per line,
+rotated once it reaches a given size, rather than to stdout.'''
+
+# Python Imports
+import os
+import sys
+import json
+import threading
+import logging
+import logging.handlers
+from pprint import pformat
+import numpy as np
+
+logger = logging.getLogger('ltu')
+traceLogger = logging.getLogger('ltu.trace')
+# Trace records only go to the trace file (if there is one), never to stdout
+traceLogger.propagate = False
+traceLogger.setLevel(logging.CRITICAL + 1)
+
+# Added to the trace filename by worker processes, so that each one writes its own trace (see ltu_worker.workerMain)
+traceSuffix = ''
+# Fields (e.g. the fish index) added to every trace record written by the current thread (see setTraceContext)
+_traceContext = threading.local()
+
+
+class StdoutHandler(logging.StreamHandler):
+    # Writes to whatever sys.stdout is at the time (it may be redirected, e.g. to a worker's log file),
+    # and leaves flushing to flushOutput()
+    def __init__(self):
+        logging.StreamHandler.__init__(self)
+        self.written = False
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+    def emit(self, record):
+        logging.StreamHandler.emit(self, record)
+        self.written = True
+
+    def flush(self):
+        pass
+
+
+stdoutHandler = StdoutHandler()
+stdoutHandler.setFormatter(logging.Formatter('%(message)s'))
+if not logger.handlers:
+    logger.addHandler(stdoutHandler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def flushOutput():
+    # Flush stdout, if anything has been logged to it since the last flush
+    if stdoutHandler.written:
+        stdoutHandler.written = False
+        sys.stdout.flush()
+
+
+def setLevel(level):
+    # level may be a logging level, or its name (e.g. 'DEBUG', 'INFO', 'WARNING')
+    if isinstance(level, str):
+        level = level.upper()
+    logger.setLevel(level)
+
+
+def debugEnabled():
+    # For code that has work to do (beyond formatting) to produce its debug output
+    return logger.isEnabledFor(logging.DEBUG)
+
+
+class Pretty(object):
+    # Defers pprint-style formatting of a value until (and unless) a message containing it is written
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return pformat(self.value)
+
+
+def jsonDefault(value):
+    # Conversion of the numpy types (and our list-like containers) that turn up in trace records
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return list(value)
+
+
+class JSONLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': record.created, 'event': record.getMessage(), 'pid': record.process}
+        entry.update(record.trace)
+        return json.dumps(entry, default=jsonDefault)
+
+
+def enableTrace(path, maxBytes=64*1024*1024, backupCount=4):
+    # Write trace records to path (which is rotated once it reaches maxBytes, keeping backupCount old files),
+    # or stop writing them if path is None
+    for handler in list(traceLogger.handlers):
+        traceLogger.removeHandler(handler)
+        handler.close()
+    if path is None:
+        traceLogger.setLevel(logging.CRITICAL + 1)
+        return
+    (base, extension) = os.path.splitext(path)
+    handler = logging.handlers.RotatingFileHandler(base + traceSuffix + extension, maxBytes=maxBytes, backupCount=backupCount)
+    handler.setFormatter(JSONLinesFormatter())
+    traceLogger.addHandler(handler)
+    traceLogger.setLevel(logging.DEBUG)
+
+
+def traceEnabled():
+    # For code that has work to do (beyond converting them to JSON) to gather the fields of its trace records
+    return traceLogger.isEnabledFor(logging.DEBUG)
+
+
+def setTraceContext(**fields):
+    # Set fields to be included in every trace record subsequently written by this thread
+    _traceContext.fields = fields
+
+
+def trace(event, **fields):
+    # Write a record to the trace file (if there is one). The fields are only converted to JSON if it is enabled.
+    if traceLogger.isEnabledFor(logging.DEBUG):
+        traceLogger.debug(event, extra={'trace': dict(getattr(_traceContext, 'fields', {}), **fields)})
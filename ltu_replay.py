@@ -0,0 +1,98 @@
+'''Capture of live LTU sessions, for replaying them later (see replay_ltu.py).
+
+Once a replay directory has been set (see setLTUReplayDirectory in multifish-ltu-wrapper.py), every call that changes
+the LTU state is recorded there, along with its reference frames and its result. A capture is a directory containing two files:
+* frames.bin: the reference frames of every call, one set after another, exactly as they were passed in
+* calls.jsonl: a header line, and then one JSON object per call, giving the function ('call'), the fish ('fishIndex'),
+  its arguments ('args', in order, with the reference frames replaced by {'offset', 'shape', 'dtype'} in frames.bin),
+  the result it returned ('result') and when it was made ('time')
+
+Both files are only ever appended to, and each call's line is written after its frames,
+so a capture that was interrupted part-way through (e.g. by a crash) can still be replayed up to its last complete line.'''
+
+# Python Imports
+import os
+import json
+import time
+import threading
+import numpy as np
+# Local Imports
+from ltu_log import jsonDefault
+
+formatVersion = 1
+
+
+class ReplayRecorder(object):
+
+    def __init__(self, directory, numSamplesPerPeriod):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.framesFile = open(os.path.join(directory, 'frames.bin'), 'ab')
+        self.callsFile = open(os.path.join(directory, 'calls.jsonl'), 'a')
+        # Calls may come from several threads (see processNewReferenceSequences)
+        self.lock = threading.Lock()
+        if self.callsFile.tell() == 0:
+            self.writeLine({'format': 'ltu-replay', 'version': formatVersion, 'numSamplesPerPeriod': numSamplesPerPeriod})
+
+    def writeLine(self, entry):
+        self.callsFile.write(json.dumps(entry, default=jsonDefault) + '\n')
+        self.callsFile.flush()
+
+    def writeFrames(self, frames):
+        # Append a set of reference frames (an array, a list of frames, or anything supporting the buffer protocol) to frames.bin,
+        # and return its description for calls.jsonl
+        if not isinstance(frames, (list, np.ndarray)):
+            frames = np.asarray(frames)
+        offset = self.framesFile.tell()
+        for frame in frames:
+            # One frame at a time, so that a list of frames is never stacked into a single array
+            self.framesFile.write(np.ascontiguousarray(frame).data)
+        self.framesFile.flush()
+        return {'offset': offset, 'shape': (len(frames),) + np.shape(frames[0]), 'dtype': np.asarray(frames[0]).dtype.str}
+
+    def record(self, functionName, fishIndex, args, result=None, framesArg=None):
+        # Record a call, whose args[framesArg] (if framesArg is not None) are its reference frames
+        with self.lock:
+            args = list(args)
+            if framesArg is not None:
+                args[framesArg] = self.writeFrames(args[framesArg])
+            self.writeLine({'call': functionName, 'fishIndex': fishIndex, 'args': args, 'result': result, 'time': time.time()})
+
+    def close(self):
+        with self.lock:
+            self.framesFile.close()
+            self.callsFile.close()
+
+
+class ReplayCapture(object):
+    # Read access to a capture written by ReplayRecorder
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'calls.jsonl')) as f:
+            lines = f.readlines()
+        # Anything after the last complete line is the remains of an interrupted write
+        if (len(lines) > 0) and not lines[-1].endswith('\n'):
+            lines = lines[:-1]
+        self.header = json.loads(lines[0])
+        if self.header.get('format') != 'ltu-replay':
+            raise ValueError('{0} is not an LTU replay capture'.format(directory))
+        self.calls = [json.loads(line) for line in lines[1:]]
+        framesPath = os.path.join(directory, 'frames.bin')
+        self.framesData = None
+        if os.path.getsize(framesPath) > 0:
+            self.framesData = np.memmap(framesPath, dtype='uint8', mode='r')
+
+    def __len__(self):
+        return len(self.calls)
+
+    def frames(self, description):
+        # The reference frames described by an entry in a call's args (memory-mapped, rather than read into memory)
+        dtype = np.dtype(description['dtype'])
+        numBytes = int(np.prod(description['shape'])) * dtype.itemsize
+        data = self.framesData[description['offset']:description['offset'] + numBytes]
+        return data.view(dtype).reshape(description['shape'])
+
+    def args(self, call):
+        # The arguments of a call, with the reference frames filled in
+        return [self.frames(arg) if isinstance(arg, dict) and ('offset' in arg) else arg for arg in call['args']]
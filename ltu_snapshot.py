@@ -0,0 +1,150 @@
+'''Snapshot and restore of the LTU state for a single fish (see multifish-ltu-wrapper.py),
+so that the sync history survives a restart of the interpreter and can be picked up again almost instantly.
+
+A snapshot is a directory containing three files:
+* sequences.bin: the reference sequences, one after another, in the same compact form as the ReferenceHistory holds them
+* sequences.idx: one fixed-size record (recordType) per reference sequence, giving where to find it in sequences.bin
+  along with its period and drift
+* shifts.bin: the shifts, as rows of four float64 values (seq1Index, seq2Index, shift, score)
+
+All three files are only ever appended to, so each update only writes the new reference sequence and its shifts.
+A trim truncates them. The records are written last, so a snapshot interrupted part-way through is still
+a consistent (slightly older) snapshot: anything beyond the last complete record is ignored on restore.
+Restoring only reads the records and shifts. The reference sequences are memory-mapped from sequences.bin,
+and are read from disk when (and if) they are actually needed.'''
+
+# Python Imports
+import os
+import numpy as np
+# Local Imports
+from reference_history import ReferenceHistory, MappedFile, SpilledEntry, SpillFile
+from shift_table import ShiftTable
+
+recordType = np.dtype([('offset', '<u8'),
+                       ('dtype', 'S8'),
+                       ('shape', '<u4', 3),
+                       ('scale', '<f8'),
+                       ('valueOffset', '<f8'),
+                       ('period', '<f8'),
+                       ('drift', '<i8', 2),
+                       ('hasDrift', 'u1'),
+                       ('evicted', 'u1')])
+shiftType = np.dtype('<f8')
+
+
+def truncateFile(path, size):
+    # Truncate path to size bytes, if it is larger than that (creating it if it doesn't exist)
+    with open(path, 'ab') as f:
+        if f.tell() > size:
+            f.truncate(size)
+
+
+class LTUSnapshot(object):
+    # Keeps track of what has already been written to the snapshot directory, so that each write only appends what is new
+
+    def __init__(self):
+        self.directory = None
+        # Offset in sequences.bin of each reference sequence in the snapshot
+        self.offsets = []
+        self.binSize = 0
+        self.numShifts = 0
+
+    def paths(self, directory):
+        return (os.path.join(directory, 'sequences.bin'),
+                os.path.join(directory, 'sequences.idx'),
+                os.path.join(directory, 'shifts.bin'))
+
+    def trim(self, numSequences, numShifts):
+        # The history has been trimmed: anything beyond this in the snapshot is no longer valid,
+        # and will be discarded at the next write
+        if numSequences < len(self.offsets):
+            self.binSize = self.offsets[numSequences]
+            del self.offsets[numSequences:]
+        self.numShifts = min(self.numShifts, numShifts)
+
+    def write(self, directory, resampledSequences, periodHistory, driftHistory, shifts):
+        (binPath, recordsPath, shiftsPath) = self.paths(directory)
+        if (directory != self.directory) or not os.path.isdir(directory):
+            # Start a new snapshot from scratch (including if the old one has been deleted under our feet).
+            # Removing (rather than truncating) the old files means that
+            # anything that still has them memory-mapped keeps its view of the old contents.
+            os.makedirs(directory, exist_ok=True)
+            for path in [recordsPath, shiftsPath, binPath]:
+                if os.path.exists(path):
+                    os.remove(path)
+            self.directory = directory
+            self.offsets = []
+            self.binSize = 0
+            self.numShifts = 0
+        else:
+            # Discard anything that has been trimmed from the history since the last write
+            truncateFile(recordsPath, len(self.offsets) * recordType.itemsize)
+            truncateFile(shiftsPath, self.numShifts * 4 * shiftType.itemsize)
+            truncateFile(binPath, self.binSize)
+
+        # Append the new reference sequences, then their shifts, and finally their records
+        newSequences = range(len(self.offsets), len(resampledSequences))
+        records = np.zeros(len(newSequences), dtype=recordType)
+        with open(binPath, 'ab') as f:
+            for (r, n) in enumerate(newSequences):
+                (stored, scale, valueOffset) = resampledSequences.storedEntry(n)
+                records[r]['offset'] = self.binSize
+                records[r]['period'] = periodHistory[n]
+                records[r]['scale'] = np.nan if scale is None else scale
+                records[r]['valueOffset'] = np.nan if valueOffset is None else valueOffset
+                if n < len(driftHistory):
+                    records[r]['drift'] = driftHistory[n]
+                    records[r]['hasDrift'] = 1
+                if stored is None:
+                    records[r]['evicted'] = 1
+                    records[r]['shape'] = (0,) + tuple(resampledSequences.frameShape)
+                else:
+                    stored = np.ascontiguousarray(stored)
+                    records[r]['dtype'] = stored.dtype.str
+                    records[r]['shape'] = stored.shape
+                    f.write(stored)
+                    padding = -stored.nbytes % SpillFile.alignment
+                    f.write(bytes(padding))
+                    self.binSize += stored.nbytes + padding
+                self.offsets.append(int(records[r]['offset']))
+        shiftArray = np.asarray(shifts, dtype=shiftType).reshape(-1, 4)
+        with open(shiftsPath, 'ab') as f:
+            f.write(np.ascontiguousarray(shiftArray[self.numShifts:]))
+        self.numShifts = len(shiftArray)
+        with open(recordsPath, 'ab') as f:
+            f.write(records)
+
+    def read(self, directory, memoryBudget=None, spillDirectory=None):
+        # Restore the LTU state from the snapshot in directory, and carry on appending to that snapshot from now on.
+        # Returns (resampledSequences, periodHistory, driftHistory, shifts)
+        (binPath, recordsPath, shiftsPath) = self.paths(directory)
+        records = np.fromfile(recordsPath, dtype=recordType, count=os.path.getsize(recordsPath) // recordType.itemsize)
+        shiftArray = np.fromfile(shiftsPath, dtype=shiftType, count=(os.path.getsize(shiftsPath) // (4 * shiftType.itemsize)) * 4).reshape(-1, 4)
+        # Ignore any shifts that were written without their records
+        shiftArray = shiftArray[shiftArray[:, 1] < len(records)]
+
+        mappedFile = MappedFile(binPath)
+        resampledSequences = ReferenceHistory(memoryBudget=memoryBudget, spillDirectory=spillDirectory)
+        for record in records:
+            shape = tuple(record['shape'].tolist())
+            scale = None if np.isnan(record['scale']) else float(record['scale'])
+            valueOffset = None if np.isnan(record['valueOffset']) else float(record['valueOffset'])
+            if record['evicted']:
+                stored = None
+            else:
+                stored = SpilledEntry(mappedFile, int(record['offset']), np.dtype(record['dtype'].decode()), shape)
+            resampledSequences.appendStored(stored, scale, valueOffset, shape[1:])
+        periodHistory = records['period'].tolist()
+        driftHistory = records['drift'][records['hasDrift'] == 1].tolist()
+
+        self.directory = directory
+        self.offsets = records['offset'].tolist()
+        self.binSize = 0
+        if (len(records) > 0):
+            # Anything in sequences.bin after the end of the last reference sequence is incomplete, and will be overwritten
+            self.binSize = self.offsets[-1]
+            if not records[-1]['evicted']:
+                self.binSize += resampledSequences.storedEntry(len(records)-1)[0].nbytes
+                self.binSize += -self.binSize % SpillFile.alignment
+        self.numShifts = len(shiftArray)
+        return (resampledSequences, periodHistory, driftHistory, ShiftTable(shiftArray))
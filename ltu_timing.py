@@ -0,0 +1,113 @@
+'''Per-stage timing of LTU updates (memoryCC.processNewReferenceSequence).
+
+A StageTimer is passed in to each update, which calls begin() at the start, lap(stage) at the end of each stage,
+and end() when it is done. A stage may be lapped several times in one update (e.g. once per historical sequence compared against),
+in which case its times are added together. All this costs a few perf_counter calls per update.
+
+The timer keeps the per-stage (and total) times of the most recent updates, from which stats() gives rolling percentiles,
+and the start time of each stage, from which chromeTraceEvents() gives events for a Chrome trace file
+(load it in chrome://tracing or https://ui.perfetto.dev to see where the time in each update went).
+It also keeps a moving average of the time taken by a single lap of each stage (lapCost),
+which memoryCC uses to project how long an update will take, when it has a latency budget to meet.'''
+
+# Python Imports
+import os
+import json
+import time
+from collections import deque
+import numpy as np
+
+
+class StageTimer(object):
+    # Weight given to the latest lap in the moving average of each stage's lap time
+    lapCostWeight = 0.25
+
+    def __init__(self, historyLength=1000):
+        # historyLength is the number of recent updates to keep times for
+        self.historyLength = historyLength
+        self.reset()
+
+    def reset(self):
+        # Stage name -> deque of its time (in seconds) in each recent update, in order of first appearance
+        self.times = {}
+        self.totals = deque(maxlen=self.historyLength)
+        # (stage, start, duration) for each stage of each recent update, for the Chrome trace
+        self.events = deque(maxlen=self.historyLength * 8)
+        self.numUpdates = 0
+        # Stage name -> moving average of the time (in seconds) taken by a single lap
+        self.lapCosts = {}
+        self._start = None
+
+    def begin(self):
+        self._start = self._last = time.perf_counter()
+        self._current = {}
+
+    def lap(self, stage):
+        # The time since the previous lap (or begin) was spent in stage
+        now = time.perf_counter()
+        self._current[stage] = self._current.get(stage, 0.0) + (now - self._last)
+        self.events.append((stage, self._last, now - self._last))
+        previousCost = self.lapCosts.get(stage, now - self._last)
+        self.lapCosts[stage] = previousCost + self.lapCostWeight * ((now - self._last) - previousCost)
+        self._last = now
+
+    def lapCost(self, stage):
+        # Typical time (in seconds) of a single lap of stage, or None if it has never been timed
+        return self.lapCosts.get(stage)
+
+    def end(self):
+        if self._start is None:
+            return
+        self.totals.append(self._last - self._start)
+        for stage in list(self._current) + [stage for stage in self.times if stage not in self._current]:
+            if stage not in self.times:
+                # Pad so every stage has one entry per update
+                self.times[stage] = deque([0.0] * min(self.numUpdates, self.historyLength), maxlen=self.historyLength)
+            self.times[stage].append(self._current.get(stage, 0.0))
+        self.events.append(('update', self._start, self._last - self._start))
+        self.numUpdates += 1
+        self._start = None
+
+    def stats(self, percentiles=(50, 90, 99)):
+        # For each stage (and 'total'), a dict of the mean, max and given percentiles of its time over the recent updates,
+        # in milliseconds, along with the number of updates they cover
+        result = {}
+        for (stage, times) in list(self.times.items()) + [('total', self.totals)]:
+            if len(times) == 0:
+                continue
+            ms = 1e3 * np.asarray(times)
+            stageStats = {'count': len(ms), 'mean': float(np.mean(ms)), 'max': float(np.max(ms))}
+            for (p, value) in zip(percentiles, np.percentile(ms, percentiles)):
+                stageStats['p{0}'.format(p)] = float(value)
+            result[stage] = stageStats
+        return result
+
+    def chromeTraceEvents(self, tid=0):
+        # Complete ('X') events for the Chrome trace format, with times in microseconds.
+        # tid separates the events from different timers (e.g. one per fish) onto their own rows.
+        pid = os.getpid()
+        return [{'name': stage, 'ph': 'X', 'ts': 1e6 * start, 'dur': 1e6 * duration, 'pid': pid, 'tid': tid}
+                for (stage, start, duration) in self.events]
+
+
+class NullTimer(object):
+    # Stands in for a StageTimer when the caller doesn't want timing
+    def begin(self):
+        pass
+
+    def lap(self, stage):
+        pass
+
+    def lapCost(self, stage):
+        return None
+
+    def end(self):
+        pass
+
+nullTimer = NullTimer()
+
+
+def writeChromeTrace(path, events):
+    # Write events (from chromeTraceEvents) to path as a Chrome trace file
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,274 @@
+'''Out-of-process workers for the LTU (see startLTUWorkers in multifish-ltu-wrapper.py).
+
+Each worker is a separate python process with its own copy of multifish-ltu-wrapper.py, which holds the LTU state
+for the fish assigned to it. The wrapper in the GUI's embedded interpreter then just passes each call on to the right worker,
+so the LTU calculations no longer compete for the GIL with anything else going on there
+(and their output can be sent to a log file rather than interleaving with the GUI's own output).
+Workers can be one per fish (started as new fish appear), or a fixed-size pool with the fish shared out between them.
+
+Calls and results go through a multiprocessing Pipe. The reference frames are too big to pickle through the pipe,
+so they are written into a shared memory segment belonging to the worker, and the worker reads them directly from there.
+If the caller builds the frames in that segment in the first place (see LTUWorker.frameBuffer) then they are not copied at all.
+
+Running this module directly acts as a stand-in for the GUI: it feeds synthetic reference frames for a few fish through the wrapper,
+in-process and then via workers, and checks that both give the same results.'''
+
+# Python Imports
+import os
+import sys
+import time
+import threading
+import traceback
+import importlib.util
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+# Local Imports
+import ltu_log
+from ltu_log import logger
+
+wrapperPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'multifish-ltu-wrapper.py')
+
+
+def loadWrapper():
+    # The wrapper's filename isn't a valid module name, so we have to load it by path
+    spec = importlib.util.spec_from_file_location('multifish_ltu_wrapper', wrapperPath)
+    wrapper = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(wrapper)
+    return wrapper
+
+
+class SharedFrames(object):
+    # Sent through the pipe in place of an array that is held in a shared memory segment
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+def workerMain(connection, logPath=None, workerIndex=0):
+    # Main loop of a worker process: carry out calls to the wrapper until told to stop
+    if logPath is not None:
+        sys.stdout = open(logPath, 'a', buffering=1)
+        sys.stderr = sys.stdout
+    ltu_log.traceSuffix = '.worker{0}'.format(workerIndex)
+    wrapper = loadWrapper()
+    segment = None
+    while True:
+        try:
+            (command, functionName, args) = connection.recv()
+        except EOFError:
+            break
+        if command == 'stop':
+            break
+        try:
+            for (a, arg) in enumerate(args):
+                if isinstance(arg, SharedFrames):
+                    if (segment is None) or (segment.name != arg.name):
+                        # The client has moved on to a new (bigger) segment
+                        if segment is not None:
+                            try:
+                                segment.close()
+                            except BufferError:
+                                # Something is still holding on to the old frames, so leave it mapped
+                                pass
+                        segment = shared_memory.SharedMemory(name=arg.name)
+                    args[a] = np.ndarray(arg.shape, dtype=arg.dtype, buffer=segment.buf)
+            result = getattr(wrapper, functionName)(*args)
+            del args
+            connection.send(('ok', result))
+        except Exception:
+            args = None
+            connection.send(('error', traceback.format_exc()))
+    if segment is not None:
+        segment.close()
+
+
+class LTUWorker(object):
+    # Client side of a single worker process
+
+    def __init__(self, context, logPath=None, workerIndex=0):
+        (self.connection, childConnection) = context.Pipe()
+        self.process = context.Process(target=workerMain, args=(childConnection, logPath, workerIndex), daemon=True)
+        self.process.start()
+        childConnection.close()
+        self.segment = None
+        self.segmentAddress = None
+        # Calls may come from several threads (see processNewReferenceSequences), but the worker handles one at a time
+        self.lock = threading.Lock()
+
+    def frameBuffer(self, shape, dtype):
+        # An array in this worker's shared memory segment. Frames passed to call() in this array are not copied at all.
+        # It is only valid until the next call to frameBuffer (which may need to allocate a bigger segment).
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if (self.segment is None) or (self.segment.size < nbytes):
+            self.releaseSegment()
+            self.segment = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+            self.segmentAddress = np.frombuffer(self.segment.buf, dtype='uint8').__array_interface__['data'][0]
+        return np.ndarray(shape, dtype=dtype, buffer=self.segment.buf)
+
+    def share(self, arg):
+        # Replace an array (or list) of frames with its SharedFrames description, copying it into our segment if necessary
+        if isinstance(arg, list) and (len(arg) > 0) and all(isinstance(frame, np.ndarray) and (frame.shape == arg[0].shape) for frame in arg):
+            frames = self.frameBuffer((len(arg),) + arg[0].shape, arg[0].dtype)
+            for (f, frame) in enumerate(arg):
+                frames[f] = frame
+            arg = frames
+        elif not (isinstance(arg, np.ndarray) and (arg.ndim == 3)):
+            return arg
+        elif (arg.__array_interface__['data'][0] != self.segmentAddress) or not arg.flags['C_CONTIGUOUS']:
+            self.frameBuffer(arg.shape, arg.dtype)[:] = arg
+        return SharedFrames(self.segment.name, arg.shape, arg.dtype.str)
+
+    def call(self, functionName, *args):
+        with self.lock:
+            self.connection.send(('call', functionName, [self.share(arg) for arg in args]))
+            (status, result) = self.connection.recv()
+        if status == 'error':
+            raise RuntimeError('LTU worker failed in {0}:\n{1}'.format(functionName, result))
+        return result
+
+    def releaseSegment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+            self.segment = None
+            self.segmentAddress = None
+
+    def stop(self):
+        with self.lock:
+            try:
+                self.connection.send(('stop', None, None))
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.connection.close()
+            self.releaseSegment()
+
+
+class LTUWorkerPool(object):
+    # The set of workers, and which one is looking after each fish
+
+    def __init__(self, numWorkers=None, pythonExecutable=None, logDirectory=None):
+        # numWorkers: size of the pool, or None for one worker per fish
+        # pythonExecutable: the python to run the workers with (needed when we are embedded in another application,
+        #   since sys.executable is then that application)
+        # logDirectory: where to write the workers' output (None to share our own stdout)
+        self.context = multiprocessing.get_context('spawn')
+        if pythonExecutable is not None:
+            self.context.set_executable(pythonExecutable)
+        self.numWorkers = numWorkers
+        self.logDirectory = logDirectory
+        self.workers = []
+        self.assignment = {}
+        # Calls that apply to every worker, which are repeated for any worker started later
+        self.broadcasts = []
+        self.lock = threading.Lock()
+        for w in range(numWorkers or 0):
+            self.addWorker()
+
+    def addWorker(self):
+        logPath = None
+        if self.logDirectory is not None:
+            logPath = os.path.join(self.logDirectory, 'ltu_worker{0}.log'.format(len(self.workers)))
+        worker = LTUWorker(self.context, logPath, len(self.workers))
+        for (functionName, args) in self.broadcasts:
+            worker.call(functionName, *args)
+        self.workers.append(worker)
+        return worker
+
+    def workerFor(self, fishIndex):
+        # The worker looking after this fish, choosing one (or starting one) if it is new
+        with self.lock:
+            if fishIndex not in self.assignment:
+                numFish = {id(worker): 0 for worker in self.workers}
+                for worker in self.assignment.values():
+                    numFish[id(worker)] += 1
+                idleWorkers = [worker for worker in self.workers if numFish[id(worker)] == 0]
+                if (self.numWorkers is None) and (len(idleWorkers) == 0):
+                    worker = self.addWorker()
+                else:
+                    worker = min(self.workers, key=lambda worker: numFish[id(worker)])
+                self.assignment[fishIndex] = worker
+            return self.assignment[fishIndex]
+
+    def call(self, fishIndex, functionName, *args):
+        return self.workerFor(fishIndex).call(functionName, *args)
+
+    def broadcast(self, functionName, *args):
+        self.broadcasts.append((functionName, args))
+        return [worker.call(functionName, *args) for worker in self.workers]
+
+    def removeFish(self, fishIndex):
+        # Equivalent of removeFishFromOracle: the fish above fishIndex all move down one
+        # (staying with the same worker, which renumbers them in its own oracle)
+        if fishIndex not in self.assignment:
+            logger.info('Fish index %s is not in oracle.', fishIndex)
+        elif (len(self.assignment) == 1):
+            logger.info("We can't delete the only entry in the oracle. Resetting the LTU parameters instead for fish index %s", fishIndex)
+            self.call(fishIndex, 'resetFishInOracle', fishIndex)
+        else:
+            self.assignment.pop(fishIndex).call('dropFishFromOracle', fishIndex)
+            for k in sorted(k for k in self.assignment.keys() if k > fishIndex):
+                worker = self.assignment.pop(k)
+                worker.call('moveFishInOracle', k, k-1)
+                self.assignment[k-1] = worker
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+        self.assignment = {}
+
+
+def syntheticCalls(scenes, numUpdates, rng):
+    # The calls the GUI would make for numUpdates reference frame sets for each fish (one synthetic_data.SceneModel per fish),
+    # as argument tuples for processNewReferenceSequence. Each fish has a slightly different heart period, which wanders
+    # from one update to the next, and drifts by up to a pixel per update.
+    import synthetic_data
+    calls = []
+    cumulativeDrifts = [np.zeros(2) for scene in scenes]
+    for update in range(numUpdates):
+        for (fishIndex, scene) in enumerate(scenes):
+            period = 30 + 3 * np.sin(update / 4.0) + fishIndex
+            drift = [int(d) for d in rng.integers(-1, 2, 2)]
+            cumulativeDrifts[fishIndex] += drift
+            (phases, _) = synthetic_data.HeartPhases(int(period) + 4, period, rng=rng)
+            frames = synthetic_data.RenderFrames(scene, 'brightfield', phases, [cumulativeDrifts[fishIndex]] * len(phases), rng=rng)
+            calls.append((frames, period, drift, 0, 0, 2, fishIndex))
+    return calls
+
+
+if __name__ == '__main__':
+    import argparse
+    import io
+    import contextlib
+    import synthetic_data
+    parser = argparse.ArgumentParser(description='Stand-in for the GUI: run synthetic reference frames through the LTU in-process and via worker processes')
+    parser.add_argument('--fish', type=int, default=3, help='number of fish')
+    parser.add_argument('--updates', type=int, default=20, help='number of reference frame sets per fish')
+    parser.add_argument('--workers', type=int, default=None, help='size of the worker pool (default: one worker per fish)')
+    parser.add_argument('--size', type=int, default=64, help='width and height of the frames')
+    args = parser.parse_args()
+
+    # Generate the reference frames, periods and drifts that the GUI would send us
+    rng = np.random.default_rng(0)
+    scenes = [synthetic_data.SceneModel((args.size, args.size), rng) for fishIndex in range(args.fish)]
+    calls = syntheticCalls(scenes, args.updates, rng)
+
+    results = {}
+    for mode in ['in-process', 'workers']:
+        wrapper = loadWrapper()
+        if mode == 'workers':
+            wrapper.startLTUWorkers(args.workers)
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[mode] = [wrapper.processNewReferenceSequence(*call) for call in calls]
+        elapsed = time.time() - start
+        print('{0}: {1} updates in {2:.2f}s; history lengths {3}'.format(mode, len(calls), elapsed,
+                                                                         [wrapper.numRefFrameSetsInHistory(f) for f in range(args.fish)]))
+        if mode == 'workers':
+            wrapper.stopLTUWorkers()
+    print('Largest difference between in-process and worker results: {0}'.format(np.max(np.abs(np.array(results['in-process']) - np.array(results['workers'])))))
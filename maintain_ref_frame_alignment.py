@@ -119,7 +119,7 @@ def processNewReferenceSequence(rawRefFrames,
     if log:
         pprint(shifts)
 
-    (globalShiftSolution, adjustedShifts, adjacentSolution, residuals, initialAdjacentResiduals) = MakeShiftsSelfConsistent(shifts, len(resampledSequences), numSamplesPerPeriod, knownPhaseIndex, knownPhase)
+    (globalShiftSolution, adjustedShifts, adjacentSolution, residuals, initialAdjacentResiduals) = MakeShiftsSelfConsistent(shifts, len(resampledSequences), numSamplesPerPeriod, knownPhaseIndex, knownPhase, sparse=None)
 
     if log:
         print('solution:')
@@ -5,18 +5,27 @@ This module can correct for known drift between sequences.'''
 
 # Python Imports
 import numpy as np
-from pprint import pprint
-import sys
+import time
 import warnings
 # Local Imports
+import ltu_log
+import ltu_timing
+from ltu_log import logger, Pretty
+import scoring_kernel as sk
 import simpleCC as scc
 import accountForDrift as afd
+import motion_roi as mr
 import shifts_global_solution as sgs
-import plist_wrapper as jPlist
-from image_loading import *
-#from image_saving import *
-from shifts import *
-from shifts_global_solution import *
+from shift_table import ShiftTable
+from reference_history import ReferenceHistory
+# Note that this module is imported by the LTU at startup, so it should only import what the realtime path needs.
+# In particular, avoid image_loading and shifts, which bring in matplotlib, PIL, tifffile, scipy.signal etc.
+
+# Binning factor (in each direction) for the comparisons in a degraded update (see latencyBudget in processNewReferenceSequence)
+degradedBinFactor = 2
+# A local search (see localSearchRadius in processNewReferenceSequence) falls back to scoring every shift
+# if its best score is more than this many times the score of the equivalent comparison in the previous update
+localSearchScoreRatio = 10.0
 
 def processNewReferenceSequence(rawRefFrames,
                                 thisPeriod,
@@ -29,25 +38,69 @@ def processNewReferenceSequence(rawRefFrames,
                                 knownPhase=0,
                                 numSamplesPerPeriod=80,
                                 maxOffsetToConsider=2,
-                                log=True):
+                                log=True,
+                                spectralCache=None,
+                                solverState=None,
+                                timer=None,
+                                latencyBudget=None,
+                                diagnostics=None,
+                                roiTracker=None,
+                                localSearchRadius=None,
+                                scoringCache=None,
+                                embedding=None):
     ''' Adapted from j_postacquisition.maintain_ref_frame_alignment
 
     Inputs:
     * rawRefFrames: a PxMxN numpy array representing the new reference frames
-      (or a list of numpy arrays representing the new reference frames)
+      (or a list of numpy arrays representing the new reference frames,
+      or anything else supporting the buffer protocol with that shape, such as a memoryview - see referenceFramesFromBuffer)
+      * the frames are only read (never copied), while resampling them
     * thisPeriod: the period for rawRefFrames (caller must determine the period)
     * thisDrift: the drift for rawRefFrames, in (x,y) order (caller must determine the drift).
       * if None no drift correction is used
     * resampledSequences: a list of resampled, previous reference frames
+      * this may also be a ReferenceHistory, in which case older entries are spilled or compacted after each update
     * periodHistory: a list of the previous periods for resampledSequences
     * driftHistory: a list of the previous drifts for resampledSequences (in x,y order)
       * if no drift correction is used, this is a dummy variable
     * shifts: a list of shifts previously calculated for resampledSequences
+      * this may also be a ShiftTable, which is updated in place in the same way as a list
     * knownPhaseIndex: the index of resampledSequences for which knownPhase applies
     * knownPhase: the phase (index) we are trying to match in knownPhaseIndex
     * numSamplesPerPeriod: the number of samples to use in resampling
     * maxOffsetToConsider: how far apart historically to make comparisons
       * should be used to prevent comparing sequences that are far apart and have little similarity
+    * spectralCache: a list of cached spectralTerms for resampledSequences (updated in place)
+      * entries are None where nothing is cached; if None, no cache is kept between calls
+    * solverState: an sgs.IncrementalShiftSolver to use instead of solving for the shifts from scratch
+      * it keeps state between calls, so there should be one per history
+    * timer: an ltu_timing.StageTimer to record how long each stage of this update takes
+      (resample, fft, driftCrop, scoring, housekeeping, solve, residuals,
+      and roi, embedding, embeddedScoring, localScoring, binnedScoring or warmStartSolve if they are used)
+    * latencyBudget: the time (in seconds) this update should complete within, or None for no limit
+      * if the recent stage times recorded by timer project that we will overrun, the update is cut down,
+        in this order, until it is projected to fit (see degradationPlan):
+        - 'fewerComparisons': compare against fewer than maxOffsetToConsider historical sequences (at least the previous one)
+        - 'binnedScoring': score the comparisons on frames binned by degradedBinFactor in each direction
+        - 'warmStartSolve': extend the previous solution rather than re-solving (only with a solverState)
+      * this needs a timer (with some recent updates recorded) to make its projections; without one, nothing is cut down
+    * diagnostics: a dict which is updated with details of this update: the 'degradations' applied,
+      'numComparisons', 'projectedTime', 'elapsedTime' and 'latencyBudget' (times in seconds)
+    * roiTracker: a motion_roi.MotionRoI, to only compare the region of the frames where there is motion (i.e. the heart)
+      * it keeps state between calls (and is updated with each new sequence), so there should be one per history
+      * if None, the whole frame is compared
+    * localSearchRadius: if not None, only score the shifts within this many samples (of the scoring resolution)
+      of the shift predicted by the previous solution, rather than every shift (see localShiftScores)
+      * this needs a solverState, since the previous solution is taken from it
+      * the comparison with the previous sequence anchors the predictions, so it is scored by a coarse-to-fine search instead
+      * comparisons are scored in full anyway if the local minimum is at the edge of the window, or its score is anomalous
+    * scoringCache: a list of the cached sequences that localShiftScores compares, for resampledSequences (updated in place)
+      * like spectralCache: entries are None where nothing is cached; if None, no cache is kept between calls
+    * embedding: a frame_embedding.FrameEmbedding, to compare sequences using their projections onto a small basis
+      rather than their pixels (sequences it can't embed, e.g. because they have drifted too far, are compared as usual)
+      * the parts of the overlap that its basis doesn't cover (strips along the edges of the frame) are still compared pixel by pixel
+        (using the FFTs of just those edges, which it keeps), so the scores are over the same region, and on the same scale, as without it
+      * it keeps state between calls (and is updated with each new sequence), so there should be one per history
 
     Outputs:
     * resampledSequences: updated list of resampled reference frames
@@ -58,9 +111,16 @@ def processNewReferenceSequence(rawRefFrames,
     * globalShiftSolution[-1]: roll factor for latest reference frames
     * residuals: residuals on least squares solution'''
 
-    # Deal with rawRefFrames type
-    if type(rawRefFrames) is list:
-        rawRefFrames = np.vstack(rawRefFrames)
+    updateStart = time.perf_counter()
+    if timer is None:
+        timer = ltu_timing.nullTimer
+    timer.begin()
+
+    # Deal with rawRefFrames type.
+    # A list of frames is used as it is: resampling only ever needs individual frames, so there is no need to stack them.
+    # Anything else (e.g. a memoryview) is viewed as an array, without copying.
+    if not isinstance(rawRefFrames, (list, np.ndarray)):
+        rawRefFrames = np.asarray(rawRefFrames)
 
     # Check that the reference frames have a consistent shape
     for f in range(1, len(rawRefFrames)):
@@ -68,8 +128,8 @@ def processNewReferenceSequence(rawRefFrames,
             # There is a shape mismatch.
             if log:
                 # Return an error message and code to indicate the problem.
-                print('Error: There is shape mismatch within the new reference frames. Frame 0: {0}; Frame {1}: {2}'.format(rawRefFrames[0].shape, f, rawRefFrames[f].shape))
-            sys.stdout.flush()
+                logger.error('Error: There is shape mismatch within the new reference frames. Frame 0: %s; Frame %d: %s', rawRefFrames[0].shape, f, rawRefFrames[f].shape)
+            ltu_log.flushOutput()
             return (resampledSequences,
                     periodHistory,
                     driftHistory,
@@ -78,12 +138,12 @@ def processNewReferenceSequence(rawRefFrames,
                     None)
     # And that shape is compatible with the history that we already have
     if len(resampledSequences) > 1:
-        if rawRefFrames[0].shape != resampledSequences[0][0].shape:
+        if rawRefFrames[0].shape != historyFrameShape(resampledSequences):
             # There is a shape mismatch.
             if log:
                 # Return an error message and code to indicate the problem.
-                print('Error: There is shape mismatch with historical reference frames. Old shape: {0}; New shape: {1}'.format(resampledSequences[0][0].shape, rawRefFrames[0].shape))
-            sys.stdout.flush()
+                logger.error('Error: There is shape mismatch with historical reference frames. Old shape: %s; New shape: %s', historyFrameShape(resampledSequences), rawRefFrames[0].shape)
+            ltu_log.flushOutput()
             return (resampledSequences,
                     periodHistory,
                     driftHistory,
@@ -92,12 +152,14 @@ def processNewReferenceSequence(rawRefFrames,
                     None)
 
     if log:
-        print('Using new reference frames with XY shape: {0}'.format(rawRefFrames[0].shape))
+        logger.debug('Using new reference frames with XY shape: %s', rawRefFrames[0].shape)
 
-    # Add latest reference frames to our sequence set
+    # Add latest reference frames to our sequence set.
+    # Resampling produces the only full-size copy of the frames, and we make it in the type the history stores it as.
     thisResampledSequence = scc.resampleImageSection(rawRefFrames,
                                                      thisPeriod,
-                                                     numSamplesPerPeriod)
+                                                     numSamplesPerPeriod,
+                                                     dtype=historyType(resampledSequences))
     resampledSequences.append(thisResampledSequence)
     periodHistory.append(thisPeriod)
     if thisDrift is not None:
@@ -110,80 +172,212 @@ def processNewReferenceSequence(rawRefFrames,
     else:
         if log:
             warnings.warn('No drift correction is being applied. This will seriously impact phase locking.',stacklevel=3)
+    timer.lap('resample')
+
+    # Find where the motion is in the new sequence
+    frameShape = thisResampledSequence.shape[1:]
+    cumulativeDrift = driftHistory[-1] if (thisDrift is not None) else [0, 0]
+    if roiTracker is not None:
+        roiTracker.update(thisResampledSequence, cumulativeDrift)
+        timer.lap('roi')
+    if embedding is not None:
+        embedding.addSequence(len(resampledSequences)-1, thisResampledSequence, cumulativeDrift, numSamplesPerPeriod)
+        timer.lap('embedding')
 
     # Update our shifts array.
     # Compare the current sequence with recent previous ones
     if log:
-        print(f'Drift history: {driftHistory}')
+        # This grows with the history, so is only formatted if it is actually going to be logged
+        logger.debug('Drift history: %s', driftHistory)
+    if spectralCache is None:
+        # Caller is not keeping a cache, so just use one for the duration of this call
+        spectralCache = []
+    syncSpectralCache(resampledSequences, spectralCache)
+    if scoringCache is None:
+        scoringCache = []
+    syncSpectralCache(resampledSequences, scoringCache)
+
+    # Work out whether we need to cut down this update to stay within our latency budget
+    numComparisons = min(maxOffsetToConsider, len(resampledSequences)-1)
+    (binnedScoring, warmStartSolve, projectedTime) = (False, False, None)
+    if latencyBudget is not None:
+        (numComparisons, binnedScoring, warmStartSolve, projectedTime) = degradationPlan(timer,
+                                                                                         latencyBudget - (time.perf_counter() - updateStart),
+                                                                                         numComparisons,
+                                                                                         solverState is not None)
+
+    newShifts = []
+    localSearchFallbacks = 0
     if (len(resampledSequences) > 1):
-        # Compare this new sequence against other recent ones
-        firstOne = max(0, len(resampledSequences) - maxOffsetToConsider - 1)
-        for i in range(firstOne, len(resampledSequences)-1):
+        # Compare this new sequence against the most recent ones.
+        # Each comparison is between the regions of the two sequences that line up once the drift between them is accounted for
+        # (and that are inside the region of interest, if we have one - see comparisonRects).
+        newTile = sequenceTile(roiTracker, frameShape, cumulativeDrift)
+        newIndex = len(resampledSequences)-1
+        # The FFT of the new sequence is calculated once (when first needed) and then cached for future comparisons,
+        # and the historical sequences should already have their FFTs cached from previous calls.
+        newTerms = None
+        # With a local search, the shifts are predicted from the previous solution, relative to the shift to the previous sequence.
+        # That one is found first, with no prediction (see localShiftScores).
+        previousSolution = None
+        if (localSearchRadius is not None) and not binnedScoring and (solverState is not None):
+            if (solverState.solution is not None) and (len(solverState.solution) == newIndex):
+                previousSolution = solverState.solution
+                # The scores of the comparisons made by the previous update, by distance, to spot anomalous local minima
+                previousScores = {j - i: score for (i, j, shift, score) in shifts[-maxOffsetToConsider:] if j == newIndex-1}
+        firstOne = len(resampledSequences) - numComparisons - 1
+        comparisons = list(range(firstOne, newIndex))
+        if isinstance(resampledSequences, ReferenceHistory):
+            # A history restored from a snapshot written by an older version may have entries with no pixel data
+            # (see ReferenceHistory.isEvicted). We can't compare against those, so they just get no shift to the new sequence.
+            comparisons = [i for i in comparisons if not resampledSequences.isEvicted(i)]
+            if (newIndex-1) not in comparisons:
+                previousSolution = None
+        if previousSolution is not None:
+            comparisons = comparisons[-1:] + comparisons[:-1]
+        for i in comparisons:
             if log:
-                print('---', i, len(resampledSequences)-1, '---')
-            if thisDrift is None:
-                alignment1, alignment2, rollFactor, score = scc.crossCorrelationRolling(resampledSequences[i][:numSamplesPerPeriod],
-                                                                                        thisResampledSequence[:numSamplesPerPeriod],
-                                                                                        numSamplesPerPeriod,
-                                                                                        numSamplesPerPeriod)
-            else:
-                # apply drift correction first
+                logger.debug('--- %d %d ---', i, newIndex)
+            drift = None
+            historicalDrift = [0, 0]
+            if thisDrift is not None:
                 drift = [driftHistory[-1][0] - driftHistory[i][0],
                          driftHistory[-1][1] - driftHistory[i][1]]
-                seq1, seq2 = afd.matchFrames(resampledSequences[i],
-                                             resampledSequences[-1],
-                                             drift)
-                print(f'Drift correcting ({i}): {driftHistory[-1]}, {driftHistory[i]}. New shapes {seq1.shape}, {seq2.shape}')
-                alignment1, alignment2, rollFactor, score = scc.crossCorrelationRolling(seq1,
-                                                                                        seq2,
-                                                                                        numSamplesPerPeriod,
-                                                                                        numSamplesPerPeriod)
-            shifts.append((i,
-                           len(resampledSequences)-1,
-                           rollFactor % numSamplesPerPeriod,
-                           score))
+                historicalDrift = driftHistory[i]
+            (rect1, rect2) = comparisonRects(frameShape, drift, newTile)
+            stage = 'scoring'
+            scores = None
+            if (embedding is not None) and embedding.canCompare(i, newIndex):
+                # Compare the projections of the frames onto the embedding's basis, rather than the frames themselves,
+                # over the same region (in absolute coordinates) as the pixels would be compared
+                absoluteRect = [rect1[0] - int(historicalDrift[1]), rect1[1] - int(historicalDrift[1]),
+                                rect1[2] - int(historicalDrift[0]), rect1[3] - int(historicalDrift[0])]
+                scores = embedding.shiftScores(i, newIndex, numSamplesPerPeriod, absoluteRect)
+                stage = 'embeddedScoring'
+            if (scores is None) and binnedScoring:
+                # Lower resolution comparison, since we are short of time
+                (terms1, terms2) = binnedSpectralTerms(resampledSequences, spectralCache, i, thisResampledSequence, rect1, rect2, numSamplesPerPeriod)
+                # Binning adds together degradedBinFactor^2 pixels, so we scale the scores back down
+                # to keep them comparable with full-resolution ones (which matters, since they are used as weights in the solve)
+                scores = scc.crossCorrelationScoresFromSpectra(*terms1, *terms2) / degradedBinFactor**2
+                stage = 'binnedScoring'
+            elif (scores is None) and (previousSolution is not None):
+                seq1 = cachedScoringSequence(resampledSequences, scoringCache, i, numSamplesPerPeriod, rect1,
+                                             sequenceTile(roiTracker, frameShape, historicalDrift))
+                seq2 = cachedScoringSequence(resampledSequences, scoringCache, newIndex, numSamplesPerPeriod, rect2, newTile)
+                predictedShift = None
+                if i != newIndex-1:
+                    predictedShift = newShifts[0][2] + previousSolution[newIndex-1] - previousSolution[i]
+                scores = localShiftScores(seq1, seq2, predictedShift, localSearchRadius, numSamplesPerPeriod, previousScores.get(newIndex - i))
+                stage = 'localScoring'
+                if scores is None:
+                    localSearchFallbacks += 1
+                    if log:
+                        logger.debug('Local search failed for (%d, %d): falling back to scoring every shift', i, newIndex)
+            if scores is None:
+                if newTerms is None:
+                    cachedSpectralTerms(resampledSequences, spectralCache, newIndex, numSamplesPerPeriod, newTile, newTile)
+                    newTerms = spectralCache[-1]
+                    timer.lap('fft')
+                # The FFT is along the time axis only, so cropping the spectra in XY
+                # is equivalent to cropping the frames before calculating their FFTs.
+                seq1, e1 = cachedSpectralTerms(resampledSequences, spectralCache, i, numSamplesPerPeriod, rect1,
+                                               sequenceTile(roiTracker, frameShape, historicalDrift))
+                seq2, e2 = croppedSpectralTerms(newTerms, rect2)
+                if log and (thisDrift is not None):
+                    logger.debug('Drift correcting (%d): %s, %s. New shapes %s, %s', i, driftHistory[-1], driftHistory[i], seq1.shape, seq2.shape)
+                timer.lap('driftCrop')
+                scores = scc.crossCorrelationScoresFromSpectra(seq1, e1, seq2, e2)
+            alignment1, alignment2, rollFactor, score = scc.alignmentFromScores(scores,
+                                                                                numSamplesPerPeriod,
+                                                                                numSamplesPerPeriod)
+            newShifts.append((i,
+                              newIndex,
+                              rollFactor % numSamplesPerPeriod,
+                              score))
+            timer.lap(stage)
+        # Keep the new shifts in order, whichever order they were scored in
+        newShifts.sort()
+        for shift in newShifts:
+            shifts.append(shift)
+
+    # Only the most recent sequences will be compared against the next one we receive,
+    # so there is no need to keep hold of the FFTs for anything older than that.
+    # The window moves on by one each call, so there is only ever one entry to discard.
+    if len(spectralCache) > maxOffsetToConsider:
+        spectralCache[len(spectralCache) - maxOffsetToConsider - 1] = None
+        scoringCache[len(scoringCache) - maxOffsetToConsider - 1] = None
+    if embedding is not None:
+        embedding.release(len(resampledSequences) - maxOffsetToConsider)
+    # Likewise, the pixel data for anything older can be moved out of memory
+    if isinstance(resampledSequences, ReferenceHistory):
+        resampledSequences.releaseOldEntries(maxOffsetToConsider)
 
     if log:
-        pprint(shifts)
+        logger.debug('%s', Pretty(shifts))
+    timer.lap('housekeeping')
 
     # Linear regression for making historical shifts self consistent
+    solveOptions = {}
+    if solverState is not None:
+        solveForShifts = solverState.solve
+        if warmStartSolve:
+            solveOptions['maxPasses'] = 0
+    else:
+        solveForShifts = sgs.MakeShiftsSelfConsistent
     try:
-        (globalShiftSolution, adjustedShifts, adjacentSolution, residuals, initialAdjacentResiduals) = sgs.MakeShiftsSelfConsistent(shifts,
-                                                                                                                                    len(resampledSequences),
-                                                                                                                                    numSamplesPerPeriod,
-                                                                                                                                    knownPhaseIndex,
-                                                                                                                                    knownPhase,
-                                                                                                                                    log)
+        (globalShiftSolution, adjustedShifts, adjacentSolution, residuals, initialAdjacentResiduals) = solveForShifts(shifts,
+                                                                                                                     len(resampledSequences),
+                                                                                                                     numSamplesPerPeriod,
+                                                                                                                     knownPhaseIndex,
+                                                                                                                     knownPhase,
+                                                                                                                     log,
+                                                                                                                     **solveOptions)
     except:
-        print('Exception occurred during MakeShiftsSelfConsistent()')
-        print(f'Input shifts {shifts}')
-        print(f'Params {len(resampledSequences)}, {numSamplesPerPeriod}, {knownPhaseIndex}, {knownPhase}, {log}')
-        sys.stdout.flush()      # Flush stdout so we can see all the information that led up to the point it went wrong
+        logger.error('Exception occurred during MakeShiftsSelfConsistent()')
+        logger.error('Input shifts %s', shifts)
+        logger.error('Params %d, %d, %s, %s, %s', len(resampledSequences), numSamplesPerPeriod, knownPhaseIndex, knownPhase, log)
+        ltu_log.flushOutput()      # Flush stdout so we can see all the information that led up to the point it went wrong
         raise
-        
+    timer.lap('warmStartSolve' if warmStartSolve else 'solve')
+
     if log:
-        print('solution:')
-        pprint(globalShiftSolution)
+        logger.debug('solution:\n%s', Pretty(globalShiftSolution))
 
     # Calculate the residuals on the final solution - this is primarily useful for debugging
+    # Only the shifts to the newest sequence contribute, and those are the ones we have just added.
     residuals = np.zeros([len(globalShiftSolution), ])
-    for i in range(len(globalShiftSolution)-1):
-        for shift in shifts:
-            if shift[1] == shifts[-1][1] and shift[0] == i:
-                residuals[i] = globalShiftSolution[-1] - globalShiftSolution[i] - shift[2]
-                break
+    for (i, j, shift, score) in newShifts:
+        residuals[i] = globalShiftSolution[-1] - globalShiftSolution[i] - shift
         while residuals[i] > (numSamplesPerPeriod/2):
             residuals[i] = residuals[i]-numSamplesPerPeriod
         while residuals[i] < -(numSamplesPerPeriod/2):
             residuals[i] = residuals[i]+numSamplesPerPeriod
 
     if log:
-        print('residuals:')
-        pprint(residuals)
-        print('Reference Frame rolling by: {0}'.format(globalShiftSolution[-1]))
+        logger.debug('residuals:\n%s', Pretty(residuals))
+        logger.info('Reference Frame rolling by: %s', globalShiftSolution[-1])
+    # Diagnostics for this update only (so their size doesn't grow with the history).
+    # The fields are gathered before trace() gets to check whether there is a trace file, so we check first.
+    if ltu_log.traceEnabled():
+        ltu_log.trace('update', numSequences=len(resampledSequences), period=thisPeriod, drift=thisDrift,
+                      newShifts=newShifts, rollFactor=globalShiftSolution[-1], residuals=[residuals[i] for (i, j, shift, score) in newShifts])
 
     # Ensure correct sequencing between python print calls and printf calls from the C code that is calling us
-    sys.stdout.flush()
+    ltu_log.flushOutput()
+    timer.lap('residuals')
+    timer.end()
+
+    if diagnostics is not None:
+        diagnostics.clear()
+        diagnostics.update({'degradations': [name for (name, applied) in [('fewerComparisons', numComparisons < min(maxOffsetToConsider, len(resampledSequences)-1)),
+                                                                            ('binnedScoring', binnedScoring),
+                                                                            ('warmStartSolve', warmStartSolve)] if applied],
+                            'numComparisons': numComparisons,
+                            'localSearchFallbacks': localSearchFallbacks,
+                            'projectedTime': projectedTime,
+                            'elapsedTime': time.perf_counter() - updateStart,
+                            'latencyBudget': latencyBudget})
 
     # Note for developers:
     # there are two other return statements in this function
@@ -194,37 +388,257 @@ def processNewReferenceSequence(rawRefFrames,
             globalShiftSolution[-1],
             residuals)
 
+def syncSpectralCache(resampledSequences, spectralCache):
+    # Make spectralCache the same length as resampledSequences (in place).
+    # Missing entries are filled with None, and will be calculated on demand.
+    del spectralCache[len(resampledSequences):]
+    spectralCache.extend([None] * (len(resampledSequences) - len(spectralCache)))
+
+def cachedSpectralTerms(resampledSequences, spectralCache, i, numSamplesPerPeriod, rect=None, tile=None):
+    # Return the spectralTerms for resampledSequences[i], cropped to rect (see croppedSpectralTerms; None for the whole frame).
+    # If they are not already cached for a region containing rect, we calculate (and cache) them for the region tile
+    # (which should contain rect; None for the whole frame).
+    # Cache entries are (fft, energy, region), where region is the part of the frame ([X1,X2,Y1,Y2]) that they cover.
+    frameShape = historyFrameShape(resampledSequences)
+    fullFrame = [0, frameShape[0], 0, frameShape[1]]
+    rect = fullFrame if rect is None else rect
+    tile = fullFrame if tile is None else tile
+    if (spectralCache[i] is None) or not mr.boxContains(spectralCache[i][2], rect):
+        if not mr.boxContains(tile, rect):
+            tile = mr.boxUnion([tile, rect])
+        # Note that crossCorrelationRolling has always been called with its default numSamplesPerPeriod here,
+        # so the scoring may resample to a different length to the history (we preserve that behaviour)
+        sequence = resampledSequences[i][:, tile[0]:tile[1], tile[2]:tile[3]]
+        spectralCache[i] = scc.spectralTerms(sequence, numSamplesPerPeriod) + (tile,)
+    return croppedSpectralTerms(spectralCache[i], rect)
+
+def croppedSpectralTerms(terms, rect):
+    # (fft, energy) from a spectral cache entry (see cachedSpectralTerms), cropped to rect ([X1,X2,Y1,Y2] in frame coordinates)
+    (fft, energy, region) = terms
+    (r0, r1, c0, c1) = (rect[0] - region[0], rect[1] - region[0], rect[2] - region[2], rect[3] - region[2])
+    return (fft[:, r0:r1, c0:c1], energy[r0:r1, c0:c1])
+
+def sequenceTile(roiTracker, frameShape, cumulativeDrift):
+    # The region of interest ([X1,X2,Y1,Y2]) in the frames of a sequence with the given cumulative drift:
+    # the motion region if we are tracking one (and it is in the frame), otherwise the whole frame
+    fullFrame = [0, frameShape[0], 0, frameShape[1]]
+    if roiTracker is None:
+        return fullFrame
+    tile = roiTracker.frameBox(frameShape, cumulativeDrift)
+    if mr.boxArea(tile) == 0:
+        return fullFrame
+    return tile
+
+def comparisonRects(frameShape, drift, newTile):
+    # The regions ([X1,X2,Y1,Y2]) of a historical sequence and of the new sequence to compare, given the drift between them (or None)
+    # and the region of interest in the new sequence. They line up exactly as accountForDrift.matchFrames would line them up.
+    (rect1, rect2) = afd.matchRects(frameShape, frameShape, [0, 0] if drift is None else drift)
+    # Row r of rect1 lines up with row r+dy of rect2, and likewise for columns
+    (dy, dx) = (rect2[0] - rect1[0], rect2[2] - rect1[2])
+    roiRect = mr.boxIntersection(rect2, newTile)
+    if mr.boxArea(roiRect) == 0:
+        # The region of interest has drifted out of the overlap, so fall back to the whole of it
+        return (rect1, rect2)
+    return (mr.boxIntersection(roiRect, roiRect, offset=(-dy, -dx)), roiRect)
+
+def cachedScoringSequence(resampledSequences, scoringCache, i, numSamplesPerPeriod, rect, tile):
+    # Return resampledSequences[i] resampled as the scoring does (see scc.scoringSequence), cropped to rect ([X1,X2,Y1,Y2]).
+    # If it is not already cached for a region containing rect, we calculate (and cache) it for the region tile.
+    # Cache entries are (sequence, region), like those of cachedSpectralTerms.
+    if (scoringCache[i] is None) or not mr.boxContains(scoringCache[i][1], rect):
+        if not mr.boxContains(tile, rect):
+            tile = mr.boxUnion([tile, rect])
+        sequence = resampledSequences[i][:, tile[0]:tile[1], tile[2]:tile[3]]
+        scoringCache[i] = (np.ascontiguousarray(scc.scoringSequence(sequence, numSamplesPerPeriod), dtype='float'), tile)
+    (sequence, region) = scoringCache[i]
+    return sequence[:, rect[0]-region[0]:rect[1]-region[0], rect[2]-region[2]:rect[3]-region[2]]
+
+def localShiftScores(seq1, seq2, predictedShift, radius, numSamplesPerPeriod, expectedScore):
+    # Scores for comparing seq1 and seq2 (from cachedScoringSequence) at just the shifts within radius of predictedShift
+    # (in units of numSamplesPerPeriod), scored directly rather than by FFT. This costs O(radius) passes over the pixels,
+    # rather than the O(S log S) of the FFTs (for S samples per period), so if every comparison succeeds, no FFTs are needed at all.
+    # If predictedShift is None, we find the shift by a coarse-to-fine search instead (see scc.pyramidScores).
+    # Returns None if the result can't be trusted, and all the shifts should be scored instead:
+    # if the minimum is at the edge of the window (so the true minimum may be outside it), or if its score is
+    # more than localSearchScoreRatio times expectedScore (the score at this distance last time, if known).
+    if predictedShift is None:
+        scores = scc.pyramidScores(seq1, seq2)
+    else:
+        # The scores are at the scoring resolution, which may not be numSamplesPerPeriod (see cachedSpectralTerms)
+        centre = int(np.round(predictedShift * len(seq1) / numSamplesPerPeriod)) % len(seq1)
+        scores = scc.windowScores(seq1, seq2, centre, radius)
+        if not scc.minimumInsideWindow(scores):
+            return None
+    if (expectedScore is None) or (np.min(scores) > localSearchScoreRatio * expectedScore):
+        return None
+    return scores
+
+def degradationPlan(timer, remainingTime, numComparisons, canWarmStart):
+    # Decide how to cut down an update with numComparisons comparisons still to do, so that it is projected to take
+    # no more than remainingTime (in seconds), based on the typical cost of each stage recorded by timer.
+    # Returns (numComparisons, binnedScoring, warmStartSolve, projectedTime)
+    fftCost = timer.lapCost('fft')
+    compareCost = timer.lapCost('scoring')
+    if (numComparisons == 0) or (fftCost is None) or (compareCost is None):
+        # Nothing to cut down, or no idea how long anything takes yet
+        return (numComparisons, False, False, None)
+    compareCost += (timer.lapCost('driftCrop') or 0)
+    # A binned comparison has no full-resolution FFT to do, and everything else is degradedBinFactor^2 smaller
+    binnedCost = timer.lapCost('binnedScoring') or ((fftCost + compareCost) / degradedBinFactor**2)
+    solveCost = timer.lapCost('solve') or 0
+    warmStartCost = timer.lapCost('warmStartSolve') or 0
+    otherCost = (timer.lapCost('housekeeping') or 0) + (timer.lapCost('residuals') or 0)
+
+    def projectedTime(n, binned, warmStart):
+        return ((n * binnedCost) if binned else (fftCost + n * compareCost)) + (warmStartCost if warmStart else solveCost) + otherCost
+
+    def mostComparisons(binned, warmStart):
+        # The most comparisons that fit (but always at least the previous sequence, which the solve relies on)
+        n = numComparisons
+        while (n > 1) and (projectedTime(n, binned, warmStart) > remainingTime):
+            n -= 1
+        return n
+
+    (binned, warmStart) = (False, False)
+    n = mostComparisons(binned, warmStart)
+    if (projectedTime(n, binned, warmStart) > remainingTime) and (binnedCost < fftCost + compareCost):
+        binned = True
+        n = mostComparisons(binned, warmStart)
+    if (projectedTime(n, binned, warmStart) > remainingTime) and canWarmStart:
+        warmStart = True
+        n = mostComparisons(binned, warmStart)
+    return (n, binned, warmStart, projectedTime(n, binned, warmStart))
+
+def binnedSpectralTerms(resampledSequences, spectralCache, i, thisResampledSequence, rect1, rect2, numSamplesPerPeriod):
+    # spectralTerms of resampledSequences[i] cropped to rect1 and of the new sequence cropped to rect2 (see comparisonRects),
+    # binned by degradedBinFactor, for a quick low resolution comparison.
+    # We don't calculate the full-resolution FFT of the new sequence (that is what we don't have time for),
+    # but bin its frames instead. Binning commutes with the temporal FFT, so we can bin the cached FFT
+    # for resampledSequences[i] if we have it, and otherwise we treat it the same way as the new sequence.
+    if (spectralCache[i] is not None) and mr.boxContains(spectralCache[i][2], rect1):
+        fft1 = sk.binSpatially(croppedSpectralTerms(spectralCache[i], rect1)[0], degradedBinFactor)
+        terms1 = (fft1, scc.spectralEnergy(fft1))
+    else:
+        source1 = resampledSequences[i][:, rect1[0]:rect1[1], rect1[2]:rect1[3]]
+        terms1 = scc.spectralTerms(sk.binSpatially(source1, degradedBinFactor), numSamplesPerPeriod)
+    source2 = thisResampledSequence[:, rect2[0]:rect2[1], rect2[2]:rect2[3]]
+    terms2 = scc.spectralTerms(sk.binSpatially(source2, degradedBinFactor), numSamplesPerPeriod)
+    return (terms1, terms2)
+
+def referenceFramesFromBuffer(buffer, shape, dtype='uint8'):
+    # View a single contiguous buffer (anything supporting the buffer protocol, e.g. bytes, a memoryview or an array)
+    # as reference frames of the given shape (numFrames, height, width), without copying it
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def historyType(resampledSequences):
+    # The type that new entries in the reference history should be resampled to
+    if isinstance(resampledSequences, ReferenceHistory) and (resampledSequences.dtype == np.dtype('float32')):
+        # The history would only convert them to float32 anyway
+        return 'float32'
+    return 'float'
+
+def historyFrameShape(resampledSequences):
+    # Shape of a single frame in the reference history
+    if isinstance(resampledSequences, ReferenceHistory):
+        # No need to fetch (and possibly decode) a whole entry
+        return resampledSequences.frameShape
+    return resampledSequences[0][0].shape
+
 def RoIForReferenceHistory(resampledSequences):
     # This fuction has been relocated from j_postacquisition/maintain_ref_frame_alignment given this is the only function called by the LTU
     # Return the shape of the reference history.
     # We presume all have the same size (caller really should ensure this, or we will run into major problems!)
     if (len(resampledSequences) == 0):
         return (-1, -1)
-    return resampledSequences[0][0].image.shape
+    return historyFrameShape(resampledSequences)
 
 def trimLTUHistory(resampledSequences,
                     periodHistory,
                     driftHistory,
                     shifts,
-                    trimToLength):
+                    trimToLength,
+                    spectralCache=None,
+                    solverState=None,
+                    scoringCache=None,
+                    embedding=None):
+    # spectralCache and scoringCache (if provided) are trimmed in place, since their entries beyond trimToLength are no longer valid,
+    # as is embedding (its basis is kept, though).
+    # solverState (if provided) is reset, so that the next update does a full solve for the trimmed shifts.
     assert(len(resampledSequences) >= trimToLength)
-    print(f"Trimming from initial sequence length {len(resampledSequences)} ({len(shifts)} shifts)")
-    print(shifts)
+    logger.info('Trimming from initial sequence length %d (%d shifts)', len(resampledSequences), len(shifts))
+    logger.debug('%s', shifts)
     resampledSequences = resampledSequences[:trimToLength]
     periodHistory = periodHistory[:trimToLength]
     driftHistory = driftHistory[:trimToLength]
-    shifts = shifts.copy()
-    for n in range(len(shifts))[::-1]:
-        i,j,_,_ = shifts[n]
-        if j >= trimToLength:
-            del shifts[n]
-    print(f"Trimmed to sequence length {len(resampledSequences)} ({len(shifts)} shifts)")
-    print(shifts)
+    if isinstance(shifts, ShiftTable):
+        shifts = shifts.copy()
+        shifts.trim(trimToLength)
+    else:
+        shifts = [shift for shift in shifts if shift[1] < trimToLength]
+    if spectralCache is not None:
+        del spectralCache[trimToLength:]
+    if scoringCache is not None:
+        del scoringCache[trimToLength:]
+    if embedding is not None:
+        embedding.trim(trimToLength)
+    if solverState is not None:
+        solverState.reset()
+    logger.info('Trimmed to sequence length %d (%d shifts)', len(resampledSequences), len(shifts))
+    logger.debug('%s', shifts)
+    ltu_log.trace('trim', trimToLength=trimToLength, numShifts=len(shifts))
     # Ensure correct sequencing between python print calls and printf calls from the C code that is calling us
-    sys.stdout.flush()
+    ltu_log.flushOutput()
     return resampledSequences,periodHistory,driftHistory,shifts
 
+def checkTrimUnderMemoryBudget(numUpdates=8, trimToLength=7):
+    # Regression check: with a memory budget so small that everything outside the comparison window is pushed out of memory,
+    # trimming the history and then carrying on must still work (the next update compares against entries from before the trim)
+    import synthetic_data
+    history = ReferenceHistory(memoryBudget=1)
+    (periodHistory, driftHistory, shifts) = ([], [], [])
+    (frames, _, _, _) = synthetic_data.SyntheticSequence(40 * (numUpdates + 1), (32, 32), period=30.0, seed=0)
+    for n in range(numUpdates + 1):
+        if n == numUpdates:
+            (history, periodHistory, driftHistory, shifts) = trimLTUHistory(history, periodHistory, driftHistory, shifts, trimToLength)
+        (history, periodHistory, driftHistory, shifts, rollFactor, residuals) = processNewReferenceSequence(frames[40*n:40*n+34], 30.0, [0, 0],
+                                                                                                           history, periodHistory, driftHistory, shifts,
+                                                                                                           numSamplesPerPeriod=60, maxOffsetToConsider=3, log=False)
+    assert(len(history) == trimToLength + 1)
+    assert(all(not history.isEvicted(n) for n in range(len(history))))
+    print('Trim under a memory budget: OK')
+
+def checkEmbeddingAgainstPixels(numUpdates=30, numComponents=8, shiftTolerance=0.25, scoreTolerance=0.2):
+    # Comparing sequences using a FrameEmbedding should find shifts within shiftTolerance (in samples) of those found by comparing
+    # their pixels, with scores (which are the weights in the solve) within a fraction scoreTolerance of the pixel-based ones.
+    # The sequences drift, so the basis doesn't cover all of the overlap between them.
+    import synthetic_data
+    from frame_embedding import FrameEmbedding
+    rng = np.random.default_rng(0)
+    scene = synthetic_data.SceneModel((64, 64), rng)
+    (updates, cumulativeDrift) = ([], np.zeros(2))
+    for n in range(numUpdates):
+        drift = [int(d) for d in rng.integers(-1, 2, 2)]
+        cumulativeDrift += drift
+        (phases, _) = synthetic_data.HeartPhases(34, 30.0, rng=rng)
+        updates.append((synthetic_data.RenderFrames(scene, 'brightfield', phases, [cumulativeDrift] * len(phases), rng=rng), drift))
+    results = []
+    for embedding in [None, FrameEmbedding(numComponents)]:
+        (history, periodHistory, driftHistory, shifts) = ([], [], [], [])
+        for (frames, drift) in updates:
+            (history, periodHistory, driftHistory, shifts, rollFactor, residuals) = processNewReferenceSequence(frames, 30.0, drift,
+                                                                                                               history, periodHistory, driftHistory, shifts,
+                                                                                                               numSamplesPerPeriod=60, maxOffsetToConsider=5,
+                                                                                                               log=False, embedding=embedding)
+        results.append(np.array([(shift, score) for (i, j, shift, score) in shifts]))
+    shiftDifference = np.max(np.abs((results[1][:, 0] - results[0][:, 0] + 30) % 60 - 30))
+    scoreDifference = np.max(np.abs(results[1][:, 1] / results[0][:, 1] - 1))
+    assert(shiftDifference < shiftTolerance), shiftDifference
+    assert(scoreDifference < scoreTolerance), scoreDifference
+    print('Embedded scoring against pixels: OK (largest differences: shift {0:.3f}, score {1:.1%})'.format(shiftDifference, scoreDifference))
+
 if __name__ == '__main__':
+    checkTrimUnderMemoryBudget()
+    checkEmbeddingAgainstPixels()
     print('Running toy example...This is STILL BROKEN')
     numStacks = 10
     stackLength = 10
@@ -0,0 +1,96 @@
+'''Automatic region of interest for the LTU, based on where the reference frames are moving.
+
+Only the beating heart carries any phase information, but it typically fills only a small part of the reference frames,
+and the rest just adds noise and cost to the cross-correlation. MotionRoI finds the bounding box of the pixels
+whose intensity varies over each new reference sequence (its temporal variance), and memoryCC then only correlates
+the pixels inside that box (see roiTracker in memoryCC.processNewReferenceSequence).
+
+The box is kept in absolute coordinates: frame coordinates minus the cumulative drift of the sequence
+(so that the same point on the fish has the same absolute coordinates in every sequence, exactly as accountForDrift.matchFrames
+lines them up). It is stable rather than following every new sequence: it grows straight away if there is motion outside it,
+but only shrinks once the motion has stayed well inside it for a number of consecutive sequences.'''
+
+# Python Imports
+from collections import deque
+import numpy as np
+
+
+class MotionRoI(object):
+
+    def __init__(self, threshold=0.1, margin=4, shrinkAfter=10, shrinkFraction=0.8):
+        # threshold: pixels count as moving if their temporal variance is more than this fraction of the way
+        #   from the typical (median) variance to the peak variance
+        # margin: number of pixels to add around the moving region
+        # shrinkAfter, shrinkFraction: the box only shrinks once this many consecutive sequences have had all their motion
+        #   inside a box of less than shrinkFraction of its area
+        self.threshold = threshold
+        self.margin = margin
+        self.shrinkFraction = shrinkFraction
+        self.recentBoxes = deque(maxlen=shrinkAfter)
+        # Current box in absolute coordinates, as [X1,X2,Y1,Y2] (see accountForDrift.matchRects), or None if no motion seen yet
+        self.box = None
+
+    def motionBox(self, frames):
+        # Bounding box (in frame coordinates, including the margin) of the moving pixels in frames (of order TXY),
+        # or None if nothing is moving
+        variance = np.var(frames, axis=0)
+        typical = np.median(variance)
+        # A high percentile rather than the maximum, so that a few hot pixels don't set the scale
+        peak = np.percentile(variance, 99.5)
+        if not (peak > typical):
+            return None
+        moving = variance > typical + self.threshold * (peak - typical)
+        # Ignore rows and columns with only a single (probably noisy) moving pixel
+        rows = np.nonzero(np.count_nonzero(moving, axis=1) > 1)[0]
+        columns = np.nonzero(np.count_nonzero(moving, axis=0) > 1)[0]
+        if (len(rows) == 0) or (len(columns) == 0):
+            return None
+        return [max(0, rows[0] - self.margin), min(variance.shape[0], rows[-1] + 1 + self.margin),
+                max(0, columns[0] - self.margin), min(variance.shape[1], columns[-1] + 1 + self.margin)]
+
+    def update(self, frames, cumulativeDrift):
+        # Update the box for a new reference sequence (with cumulative drift in (x,y) order), and return it
+        frameBox = self.motionBox(frames)
+        if frameBox is None:
+            return self.box
+        (dx, dy) = (int(cumulativeDrift[0]), int(cumulativeDrift[1]))
+        candidate = [frameBox[0] - dy, frameBox[1] - dy, frameBox[2] - dx, frameBox[3] - dx]
+        self.recentBoxes.append(candidate)
+        if self.box is None:
+            self.box = candidate
+        elif not boxContains(self.box, candidate):
+            # Grow straight away, so we never miss any motion
+            self.box = boxUnion([self.box, candidate])
+        elif len(self.recentBoxes) == self.recentBoxes.maxlen:
+            recent = boxUnion(self.recentBoxes)
+            if boxArea(recent) < self.shrinkFraction * boxArea(self.box):
+                self.box = recent
+        return self.box
+
+    def frameBox(self, frameShape, cumulativeDrift):
+        # The box in the frame coordinates of a sequence with the given cumulative drift (clipped to the frame),
+        # or the whole frame if we have no box
+        if self.box is None:
+            return [0, frameShape[0], 0, frameShape[1]]
+        return boxIntersection(self.box, [-int(cumulativeDrift[1]), frameShape[0] - int(cumulativeDrift[1]),
+                                          -int(cumulativeDrift[0]), frameShape[1] - int(cumulativeDrift[0])],
+                               offset=(int(cumulativeDrift[1]), int(cumulativeDrift[0])))
+
+
+def boxArea(box):
+    return max(0, box[1] - box[0]) * max(0, box[3] - box[2])
+
+
+def boxContains(outer, inner):
+    return (outer[0] <= inner[0]) and (inner[1] <= outer[1]) and (outer[2] <= inner[2]) and (inner[3] <= outer[3])
+
+
+def boxUnion(boxes):
+    boxes = list(boxes)
+    return [min(b[0] for b in boxes), max(b[1] for b in boxes), min(b[2] for b in boxes), max(b[3] for b in boxes)]
+
+
+def boxIntersection(box1, box2, offset=(0, 0)):
+    # Intersection of two boxes, moved by offset (rows, columns). It may be empty (see boxArea).
+    return [max(box1[0], box2[0]) + offset[0], min(box1[1], box2[1]) + offset[0],
+            max(box1[2], box2[2]) + offset[1], min(box1[3], box2[3]) + offset[1]]
@@ -1,11 +1,25 @@
-import sys,os,glob
+import sys,os,glob,shutil
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import memoryCC as mcc
+import scoring_kernel as sk
+import shifts_global_solution as sgs
+import ltu_log
+from ltu_log import logger
+from shift_table import ShiftTable
+from reference_history import ReferenceHistory
+from ltu_snapshot import LTUSnapshot
+from ltu_timing import StageTimer, writeChromeTrace
+from motion_roi import MotionRoI
+from frame_embedding import FrameEmbedding
+from ltu_replay import ReplayRecorder
 
 
 # ===================================================================================
 # Global Vars
 # ===================================================================================
 # log is actually never set by the obj C side.
+# How much is actually logged is controlled by the level of the 'ltu' logger instead (see setLTULogLevel).
 global log
 log = True
 
@@ -13,6 +27,43 @@ log = True
 global numSamplesPerPeriod
 numSamplesPerPeriod = 60
 
+# Directory where older reference sequences are spilled to disk (see setLTUSpillDirectory). None keeps them all in memory.
+global LTUSpillDirectory
+LTUSpillDirectory = None
+
+# Directory where the LTU state is snapshotted after every update (see setLTUSnapshotDirectory). None disables snapshots.
+global LTUSnapshotDirectory
+LTUSnapshotDirectory = None
+
+# Time (in seconds) each update should complete within (see setLTULatencyBudget). None for no limit.
+global LTULatencyBudget
+LTULatencyBudget = None
+
+# Whether to only compare the moving part of the reference frames (see setLTUMotionRoI)
+global LTUMotionRoI
+LTUMotionRoI = False
+
+# Number of samples either side of the predicted shift to score (see setLTULocalSearchRadius). None scores every shift.
+global LTULocalSearchRadius
+LTULocalSearchRadius = None
+
+# Number of components of the basis the reference frames are projected onto for comparison (see setLTUFrameEmbedding).
+# None compares the frames themselves.
+global LTUFrameEmbedding
+LTUFrameEmbedding = None
+
+# Where every LTU call is being recorded (see setLTUReplayDirectory). None when not recording.
+global LTUReplayRecorder
+LTUReplayRecorder = None
+
+# Thread pool for updating several fish at once (see processNewReferenceSequences)
+global LTUThreadPool
+LTUThreadPool = None
+
+# Worker processes that the LTU calls are passed on to (see startLTUWorkers). None runs everything in this process.
+global LTUWorkers
+LTUWorkers = None
+
 # ===================================================================================
 # The Multifish Oracle and Helper Functions
 # ===================================================================================
@@ -26,13 +77,40 @@ fishIndex = 0 ("0"). This means you can still record a timelapse for a single fi
 '''
 
 # blank dict of LTU parameters that we only ever copy from and never update.
+# spectralCache holds the FFTs of recent resampledSequences (see memoryCC) and is only ever used on the python side,
+# as is scoringCache, which holds the copies of them used for a local search (see setLTULocalSearchRadius).
 LTUParameterDict = { 'resampledSequences' : [],
                      'periodHistory' : [],
                      'driftHistory' : [],
-                     'shifts' : []}
+                     'shifts' : [],
+                     'spectralCache' : [],
+                     'scoringCache' : []}
+
+def newLTUParameterDict(memoryBudget=None):
+    # Each entry needs its own lists: memoryCC appends to them in place,
+    # so sharing the lists in LTUParameterDict would mix up the histories of different fish.
+    parameterDict = {keys : list(LTUParameterDict[keys]) for keys in LTUParameterDict.keys()}
+    # The reference history is kept in a compact ReferenceHistory store, with an optional memory budget in bytes
+    parameterDict['resampledSequences'] = ReferenceHistory(LTUParameterDict['resampledSequences'], memoryBudget=memoryBudget,
+                                                           spillDirectory=LTUSpillDirectory)
+    # The shifts are kept in a ShiftTable, which behaves like the list of tuples but is array-backed
+    parameterDict['shifts'] = ShiftTable(LTUParameterDict['shifts'])
+    # The state of the incremental shift solver is kept alongside the history (again, only on the python side)
+    parameterDict['solverState'] = sgs.IncrementalShiftSolver()
+    # ...as is a record of what has already been written to this fish's snapshot
+    parameterDict['snapshot'] = LTUSnapshot()
+    # ...and the timings of recent updates (see getLTUTimingStats)
+    parameterDict['timer'] = StageTimer()
+    # ...and the details of the most recent update (see getLastLTUUpdateInfo)
+    parameterDict['lastUpdateInfo'] = {}
+    # ...and the region of the frames where the heart is moving (only used if LTUMotionRoI is set)
+    parameterDict['motionRoi'] = MotionRoI()
+    # ...and the basis for comparing the frames in compressed form (only if LTUFrameEmbedding is set)
+    parameterDict['frameEmbedding'] = None if LTUFrameEmbedding is None else FrameEmbedding(LTUFrameEmbedding)
+    return parameterDict
 
 # the nested dict / oracle containing the LTU parameters for multiple fish. There will always be an entry with key "0"
-multifishOracle = {0 : dict(LTUParameterDict)}
+multifishOracle = {0 : newLTUParameterDict()}
 
 # helper functions that are not called by the LTU App
 def isFishProfileInOracle(fishIndex):
@@ -40,11 +118,15 @@ def isFishProfileInOracle(fishIndex):
 
 def addFishToOracle(fishIndex):
     if (isFishProfileInOracle(fishIndex) == False):
-        multifishOracle[fishIndex] = dict(LTUParameterDict)
+        multifishOracle[fishIndex] = newLTUParameterDict()
 
 def removeFishFromOracle(fishIndex):
     # removing a fish from the oracle removes the entry at that key but also decrements the key number by one to match the behaviour of the spimGUI obj C side
     # im mostly just going to copy the logic of the SpimApplication.removeFish method
+    if LTUReplayRecorder is not None:
+        LTUReplayRecorder.record('removeFishFromOracle', fishIndex, [fishIndex])
+    if LTUWorkers is not None:
+        return LTUWorkers.removeFish(fishIndex)
     fishIndices = sorted(keys for keys in multifishOracle.keys())
     maxFishIndex = max(fishIndices)
     numFishInOracle = len(fishIndices)
@@ -52,45 +134,64 @@ def removeFishFromOracle(fishIndex):
         # This fish index is not in the oracle. That is not necessarily a problem,
         # it may just mean that no sync has been performed for that fish, even though
         # the fish was defined within the Spim GUI.
-        print(f"Fish index {fishIndex} is not in oracle.")
+        logger.info('Fish index %s is not in oracle.', fishIndex)
     elif (numFishInOracle == 1):
         # there is only one fish in the oracle. If all rules have been followed this will be index 0
-        print(f"We can't delete the only entry in the oracle. Resetting the LTU parameters instead for fish index {fishIndex}")
+        logger.info("We can't delete the only entry in the oracle. Resetting the LTU parameters instead for fish index %s", fishIndex)
         assert(fishIndex == 0)
-        updateLTUParameters([],[],[],[], fishIndex)
+        resetFishInOracle(fishIndex)
     elif (fishIndex == maxFishIndex):
         # if its the final entry we want to remove just delete it
-        del multifishOracle[fishIndex]
+        dropFishFromOracle(fishIndex)
     else:
-        # shuffle all the entries down by updating each entry with the LTU parameters from the entry above and deleting the final entry
+        # shuffle all the entries down by moving each entry above to the index below (including its python-side state).
         # again we're relying on nothing fishy happening and that there are continuous indices from fishIndex to maxIndex
+        dropFishFromOracle(fishIndex)
         for k in range(fishIndex, maxFishIndex,1):
-            updateLTUParameters(*getLTUParameters(k+1), k)
-        # delete final entry because there is no successor to update LTUparameters from.
-        del multifishOracle[maxFishIndex]
+            moveFishInOracle(k+1, k)
+
+def dropFishFromOracle(fishIndex):
+    # Delete the entry for this fish (and its snapshot, if any)
+    multifishOracle.pop(fishIndex, None)
+    if LTUSnapshotDirectory is not None:
+        shutil.rmtree(snapshotDirectoryForFish(fishIndex), ignore_errors=True)
+
+def moveFishInOracle(fromIndex, toIndex):
+    # Renumber a fish, moving its snapshot (if any) to match
+    multifishOracle[toIndex] = multifishOracle.pop(fromIndex)
+    if LTUSnapshotDirectory is not None:
+        snapshotLTUState(toIndex)
+        shutil.rmtree(snapshotDirectoryForFish(fromIndex), ignore_errors=True)
 
 def updateLTUParameters(resampledSequences, periodHistory, driftHistory,  shifts, fishIndex):
+    # Only the history parameters are replaced. Anything else in the entry (e.g. the spectralCache) is kept,
+    # so it is up to the caller to make sure that stays consistent with the history (memoryCC does this for us).
     if(isFishProfileInOracle(fishIndex) == True):
         parameterDict = {   'resampledSequences' : resampledSequences,
                             'periodHistory' : periodHistory,
                             'driftHistory' : driftHistory,
                             'shifts' : shifts
                          }
-        multifishOracle[fishIndex] = parameterDict
+        multifishOracle[fishIndex].update(parameterDict)
     else:
-        print(f'Fish Index {fishIndex} is not in oracle. Will add new entry and update parameters')
+        logger.info('Fish Index %s is not in oracle. Will add new entry and update parameters', fishIndex)
         addFishToOracle(fishIndex)
         updateLTUParameters(resampledSequences, periodHistory, driftHistory, shifts, fishIndex)
 
 def getLTUParameters(fishIndex):
     if (isFishProfileInOracle(fishIndex) == True):
-        ltuTuple = (multifishOracle[fishIndex][keys] for keys in ['resampledSequences', 'periodHistory','driftHistory', 'shifts'])
+        ltuTuple = tuple(multifishOracle[fishIndex][keys] for keys in ['resampledSequences', 'periodHistory','driftHistory', 'shifts'])
     else:
-        print(f'Fish Index {fishIndex} is not in oracle. Will add new entry and return requested parameters')
+        logger.info('Fish Index %s is not in oracle. Will add new entry and return requested parameters', fishIndex)
         addFishToOracle(fishIndex)
         ltuTuple = getLTUParameters(fishIndex)
     return ltuTuple
 
+def getLTUState(fishIndex, key):
+    # Returns the python-side state (e.g. 'spectralCache' or 'solverState') that we keep alongside the LTU parameters
+    addFishToOracle(fishIndex)
+    return multifishOracle[fishIndex][key]
+
 
 # ===================================================================================
 # Wrapper functions for the MemoryCC module
@@ -102,27 +203,357 @@ combine with new data coming in from the Obj C side and pass to the old MemoryCC
 '''
 
 def processNewReferenceSequence(rawFrames, thisPeriod, thisDrift,  knownPhaseIndex,knownPhase, maxOffsetToConsider, fishIndex = 0):
-    
+    if LTUWorkers is not None:
+        shiftSolution = LTUWorkers.call(fishIndex, 'processNewReferenceSequence', rawFrames, thisPeriod, thisDrift, knownPhaseIndex, knownPhase, maxOffsetToConsider, fishIndex)
+    else:
+        shiftSolution = updateLTUForFish(rawFrames, thisPeriod, thisDrift, knownPhaseIndex, knownPhase, maxOffsetToConsider, fishIndex)
+    if LTUReplayRecorder is not None:
+        LTUReplayRecorder.record('processNewReferenceSequence', fishIndex,
+                                 [rawFrames, thisPeriod, thisDrift, knownPhaseIndex, knownPhase, maxOffsetToConsider, fishIndex],
+                                 result=shiftSolution, framesArg=0)
+    return shiftSolution
+
+def updateLTUForFish(rawFrames, thisPeriod, thisDrift, knownPhaseIndex, knownPhase, maxOffsetToConsider, fishIndex):
+    # The in-process part of processNewReferenceSequence
     ltuParameters = getLTUParameters(fishIndex)
+    ltu_log.setTraceContext(fishIndex=fishIndex)
     # we never actually use the residuals that get returned. Only the shiftSolution actually need by the LTU helper app
-    resampledSequences, periodHistory, driftHistory, shifts, shiftSolution, _ = mcc.processNewReferenceSequence(rawFrames, thisPeriod, thisDrift, *ltuParameters, knownPhaseIndex, knownPhase, numSamplesPerPeriod, maxOffsetToConsider)
+    resampledSequences, periodHistory, driftHistory, shifts, shiftSolution, _ = mcc.processNewReferenceSequence(rawFrames, thisPeriod, thisDrift, *ltuParameters, knownPhaseIndex, knownPhase, numSamplesPerPeriod, maxOffsetToConsider, log,
+                                                                                                                spectralCache=getLTUState(fishIndex, 'spectralCache'),
+                                                                                                                solverState=getLTUState(fishIndex, 'solverState'),
+                                                                                                                timer=getLTUState(fishIndex, 'timer'),
+                                                                                                                latencyBudget=LTULatencyBudget,
+                                                                                                                diagnostics=getLTUState(fishIndex, 'lastUpdateInfo'),
+                                                                                                                roiTracker=getLTUState(fishIndex, 'motionRoi') if LTUMotionRoI else None,
+                                                                                                                localSearchRadius=LTULocalSearchRadius,
+                                                                                                                scoringCache=getLTUState(fishIndex, 'scoringCache'),
+                                                                                                                embedding=getLTUState(fishIndex, 'frameEmbedding'))
     updateLTUParameters(resampledSequences, periodHistory, driftHistory, shifts, fishIndex)
+    if LTUSnapshotDirectory is not None:
+        snapshotLTUState(fishIndex)
     return shiftSolution
 
+def processNewReferenceBuffer(buffer, shape, dtype, thisPeriod, thisDrift, knownPhaseIndex, knownPhase, maxOffsetToConsider, fishIndex = 0):
+    # Same as processNewReferenceSequence, but for reference frames held in a single contiguous buffer
+    # (anything supporting the buffer protocol, e.g. a memoryview) of the given shape (numFrames, height, width) and dtype (e.g. 'uint8').
+    # The frames are used directly from the buffer, rather than being copied into a new array first.
+    rawFrames = mcc.referenceFramesFromBuffer(buffer, shape, dtype)
+    return processNewReferenceSequence(rawFrames, thisPeriod, thisDrift, knownPhaseIndex, knownPhase, maxOffsetToConsider, fishIndex)
+
+def processNewReferenceSequences(rawFramesList, thisPeriods, thisDrifts, knownPhaseIndex, knownPhase, maxOffsetToConsider, fishIndices):
+    # Batch version of processNewReferenceSequence, for new reference frames from several fish at once.
+    # The inputs are lists with one entry per fish in fishIndices (each fish may only appear once).
+    # knownPhaseIndex, knownPhase and maxOffsetToConsider may also be single values that apply to every fish.
+    # The fish are updated concurrently in a thread pool (the FFTs and lstsq release the GIL),
+    # so this takes about as long as the slowest fish rather than the sum of them all.
+    # The cores are shared out between the fish being updated at once, rather than each of their FFTs using all of them.
+    # Returns a list of the shift solutions, in the same order as fishIndices.
+    assert(len(set(fishIndices)) == len(fishIndices))
+    numFish = len(fishIndices)
+    def perFish(value):
+        return list(value) if isinstance(value, (list, tuple)) else [value] * numFish
+    # Make sure every fish has an entry before we start, so the threads never modify the oracle itself
+    for fishIndex in fishIndices:
+        addFishToOracle(fishIndex)
+    # (the thread pool has one thread per core)
+    fftWorkersPerFish = max(1, sk.fftWorkers // max(1, min(numFish, os.cpu_count() or 1)))
+    def update(*args):
+        with sk.limitFFTWorkers(fftWorkersPerFish):
+            return processNewReferenceSequence(*args)
+    return list(getLTUThreadPool().map(update, rawFramesList, thisPeriods, thisDrifts,
+                                       perFish(knownPhaseIndex), perFish(knownPhase), perFish(maxOffsetToConsider), fishIndices))
+
+def getLTUThreadPool():
+    # The thread pool used by processNewReferenceSequences, created the first time it is needed
+    global LTUThreadPool
+    if LTUThreadPool is None:
+        LTUThreadPool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='LTU')
+    return LTUThreadPool
+
 def trimLTUHistory(trimToLength, fishIndex = 0):
+    if LTUReplayRecorder is not None:
+        LTUReplayRecorder.record('trimLTUHistory', fishIndex, [trimToLength, fishIndex])
+    if LTUWorkers is not None:
+        return LTUWorkers.call(fishIndex, 'trimLTUHistory', trimToLength, fishIndex)
     ltuParameters = getLTUParameters(fishIndex)
-    returnTuple = mcc.trimLTUHistory(*ltuParameters, trimToLength)
+    ltu_log.setTraceContext(fishIndex=fishIndex)
+    returnTuple = mcc.trimLTUHistory(*ltuParameters, trimToLength,
+                                     spectralCache=getLTUState(fishIndex, 'spectralCache'),
+                                     solverState=getLTUState(fishIndex, 'solverState'),
+                                     scoringCache=getLTUState(fishIndex, 'scoringCache'),
+                                     embedding=getLTUState(fishIndex, 'frameEmbedding'))
+    getLTUState(fishIndex, 'snapshot').trim(len(returnTuple[0]), len(returnTuple[3]))
     updateLTUParameters(*returnTuple,fishIndex)
+    if LTUSnapshotDirectory is not None:
+        snapshotLTUState(fishIndex)
 
 def RoIForReferenceHistory(fishIndex = 0):
     # this function only needs a reference to resampledSequences so I'm not going to call the updater
     # The tuple (-1,-1) is returned if the length of resampledSequences we pass in is zero.
     # If the fish index doesn't exist then I think we should still create an entry in the oracle then recall the function.
     # This will still return (-1,-1) back to the obj C side BUT we wont crash by reading a non existent entry in the oracle.
+    if LTUWorkers is not None:
+        return LTUWorkers.call(fishIndex, 'RoIForReferenceHistory', fishIndex)
     ltuParameters = getLTUParameters(fishIndex)
     roi = mcc.RoIForReferenceHistory(ltuParameters[0])
     return roi
 
+def setLTUMemoryBudget(memoryBudget, fishIndex = 0):
+    # Limit the reference history for this fish to memoryBudget bytes of pixel data (None for no limit).
+    # Once it is exceeded, older reference sequences are stored less precisely and eventually discarded (see ReferenceHistory).
+    # The reference sequences that are still needed for comparisons are never affected.
+    if LTUWorkers is not None:
+        return LTUWorkers.call(fishIndex, 'setLTUMemoryBudget', memoryBudget, fishIndex)
+    resampledSequences, _, _, _ = getLTUParameters(fishIndex)
+    resampledSequences.memoryBudget = memoryBudget
+    return 1
+
+def setLTUSpillDirectory(directory):
+    # Move reference sequences that are no longer being compared against out of memory, into a memory-mapped file
+    # in this directory (one file per fish, deleted when no longer needed). They are read back from disk if they are needed again,
+    # e.g. after trimLTUHistory. None keeps them all in memory. Applies to all fish, including any added later.
+    global LTUSpillDirectory
+    LTUSpillDirectory = directory
+    if LTUWorkers is not None:
+        LTUWorkers.broadcast('setLTUSpillDirectory', directory)
+    for keys in multifishOracle.keys():
+        multifishOracle[keys]['resampledSequences'].spillDirectory = directory
+    return 1
+
+def setLTUNumSamplesPerPeriod(samplesPerPeriod):
+    # Set the number of samples per period that the reference sequences are resampled to. SyncControllerPythonInterface never
+    # changes this, but a replay (see replay_ltu) has to match whatever it was when the capture was recorded.
+    # It should be set before any reference frames arrive, since the history is only comparable with sequences resampled the same way.
+    global numSamplesPerPeriod
+    numSamplesPerPeriod = samplesPerPeriod
+    if LTUWorkers is not None:
+        LTUWorkers.broadcast('setLTUNumSamplesPerPeriod', samplesPerPeriod)
+    return 1
+
+def setLTULatencyBudget(latencyBudget):
+    # Set the time (in seconds) each update should complete within, so it finishes before the next stack starts (None for no limit).
+    # If an update is projected to overrun, it is cut down (see memoryCC.processNewReferenceSequence), and getLastLTUUpdateInfo reports how.
+    # Applies to all fish, including any added later.
+    global LTULatencyBudget
+    LTULatencyBudget = latencyBudget
+    if LTUWorkers is not None:
+        LTUWorkers.broadcast('setLTULatencyBudget', latencyBudget)
+    return 1
+
+def getLastLTUUpdateInfo(fishIndex = 0):
+    # Details of the most recent update for this fish: a dict with the 'degradations' applied to meet the latency budget
+    # (a list, empty if the update was done in full), 'numComparisons', 'localSearchFallbacks' (see setLTULocalSearchRadius),
+    # 'projectedTime', 'elapsedTime' and 'latencyBudget'
+    if LTUWorkers is not None:
+        return LTUWorkers.call(fishIndex, 'getLastLTUUpdateInfo', fishIndex)
+    return dict(getLTUState(fishIndex, 'lastUpdateInfo'))
+
+def setLTUMotionRoI(enabled):
+    # Only compare the part of the reference frames where there is motion (i.e. the heart), rather than the whole frame.
+    # The region is found automatically for each fish, from the variance over each new reference sequence (see motion_roi),
+    # and only the pixels inside it are FFTed and correlated. Applies to all fish, including any added later.
+    global LTUMotionRoI
+    LTUMotionRoI = bool(enabled)
+    if LTUWorkers is not None:
+        LTUWorkers.broadcast('setLTUMotionRoI', enabled)
+    return 1
+
+def getLTUMotionRoI(fishIndex = 0):
+    # The region of the frames currently being compared for this fish, as [X1,X2,Y1,Y2] in the frame coordinates of
+    # the most recent reference sequence, or None if we have no history (or setLTUMotionRoI is off, in which case it is the whole frame)
+    if LTUWorkers is not None:
+        return LTUWorkers.call(fishIndex, 'getLTUMotionRoI', fishIndex)
+    resampledSequences, _, driftHistory, _ = getLTUParameters(fishIndex)
+    if len(resampledSequences) == 0:
+        return None
+    cumulativeDrift = driftHistory[-1] if len(driftHistory) > 0 else [0, 0]
+    roiTracker = getLTUState(fishIndex, 'motionRoi') if LTUMotionRoI else None
+    return [int(x) for x in mcc.sequenceTile(roiTracker, mcc.historyFrameShape(resampledSequences), cumulativeDrift)]
+
+def setLTULocalSearchRadius(radius):
+    # Only score the shifts within radius samples of the shift predicted from the previous solution, rather than all of them
+    # (None to score them all). Comparisons where that looks unreliable are still scored in full
+    # (see memoryCC.localShiftScores), and getLastLTUUpdateInfo reports how many. Applies to all fish, including any added later.
+    global LTULocalSearchRadius
+    LTULocalSearchRadius = radius
+    if LTUWorkers is not None:
+        LTUWorkers.broadcast('setLTULocalSearchRadius', radius)
+    return 1
+
+def setLTUFrameEmbedding(numComponents):
+    # Compare reference sequences using the projections of their frames onto a basis of numComponents principal components
+    # (of the recent reference frames, kept up to date for each fish - see frame_embedding), rather than all of their pixels.
+    # None compares the pixels. Sequences that can't be projected (because they have drifted too far) are still compared pixel by pixel.
+    # Applies to all fish, including any added later. Any existing basis is discarded, so it starts again from the next update.
+    global LTUFrameEmbedding
+    LTUFrameEmbedding = numComponents
+    if LTUWorkers is not None:
+        LTUWorkers.broadcast('setLTUFrameEmbedding', numComponents)
+    for keys in multifishOracle.keys():
+        multifishOracle[keys]['frameEmbedding'] = None if numComponents is None else FrameEmbedding(numComponents)
+    return 1
+
+def getLTUMemoryFootprint(fishIndex = 0):
+    # Return the number of bytes of LTU state currently held in memory for this fish:
+    # the reference history, the cached FFTs (and scoring copies) of recent reference sequences, and the shifts.
+    # Anything spilled to disk (see setLTUSpillDirectory) is not included.
+    if LTUWorkers is not None:
+        return LTUWorkers.call(fishIndex, 'getLTUMemoryFootprint', fishIndex)
+    resampledSequences, _, _, shifts = getLTUParameters(fishIndex)
+    footprint = resampledSequences.nbytes + np.asarray(shifts).nbytes
+    for cached in getLTUState(fishIndex, 'spectralCache'):
+        if cached is not None:
+            # (the last entry of each is the region of the frame that the FFT covers)
+            footprint += sum(terms.nbytes for terms in cached[:2])
+    for cached in getLTUState(fishIndex, 'scoringCache'):
+        if cached is not None:
+            footprint += cached[0].nbytes
+    if getLTUState(fishIndex, 'frameEmbedding') is not None:
+        footprint += getLTUState(fishIndex, 'frameEmbedding').nbytes
+    return int(footprint)
+
+
+# ===================================================================================
+# Snapshot and restore of the LTU state
+# ===================================================================================
+'''
+Once a snapshot directory has been set, the LTU state for each fish is written to its own subdirectory after every update
+(see ltu_snapshot for the format). Each update only appends the new data, so this is cheap.
+After a restart, restoreLTUState / restoreMultifishOracle pick up where we left off. The reference sequences are memory-mapped
+rather than loaded, so restoring is quick however long the history is.
+'''
+
+def snapshotDirectoryForFish(fishIndex):
+    return os.path.join(LTUSnapshotDirectory, 'fish{0}'.format(fishIndex))
+
+def setLTUSnapshotDirectory(directory):
+    # Set the directory for snapshots (None to stop taking them)
+    global LTUSnapshotDirectory
+    LTUSnapshotDirectory = directory
+    if LTUWorkers is not None:
+        LTUWorkers.broadcast('setLTUSnapshotDirectory', directory)
+    return 1
+
+def snapshotLTUState(fishIndex = 0):
+    # Bring the snapshot for this fish up to date. This happens automatically after every update,
+    # but can also be called explicitly (e.g. after first setting the snapshot directory).
+    if LTUWorkers is not None:
+        return LTUWorkers.call(fishIndex, 'snapshotLTUState', fishIndex)
+    if LTUSnapshotDirectory is None:
+        logger.warning('No LTU snapshot directory has been set')
+        return 0
+    getLTUState(fishIndex, 'snapshot').write(snapshotDirectoryForFish(fishIndex), *getLTUParameters(fishIndex))
+    return 1
+
+def restoreLTUState(fishIndex = 0):
+    # Replace the LTU state for this fish with its snapshot, and return the number of reference sequences restored.
+    # Any memory budget and spill directory settings are kept.
+    if LTUWorkers is not None:
+        return LTUWorkers.call(fishIndex, 'restoreLTUState', fishIndex)
+    directory = snapshotDirectoryForFish(fishIndex)
+    if (LTUSnapshotDirectory is None) or not os.path.isdir(directory):
+        logger.warning('No LTU snapshot to restore for fish index %s', fishIndex)
+        return 0
+    memoryBudget = None
+    if isFishProfileInOracle(fishIndex):
+        memoryBudget = multifishOracle[fishIndex]['resampledSequences'].memoryBudget
+    parameterDict = newLTUParameterDict(memoryBudget)
+    ltuParameters = parameterDict['snapshot'].read(directory, memoryBudget, LTUSpillDirectory)
+    multifishOracle[fishIndex] = parameterDict
+    updateLTUParameters(*ltuParameters, fishIndex)
+    return len(ltuParameters[0])
+
+def restoreMultifishOracle():
+    # Restore every fish that has a snapshot, returning the number of fish restored
+    if LTUSnapshotDirectory is None:
+        logger.warning('No LTU snapshot directory has been set')
+        return 0
+    fishIndices = sorted(int(name[len('fish'):]) for name in os.listdir(LTUSnapshotDirectory) if name.startswith('fish'))
+    for fishIndex in fishIndices:
+        restoreLTUState(fishIndex)
+    return len(fishIndices)
+
+
+# ===================================================================================
+# Replay capture
+# ===================================================================================
+'''
+Once a replay directory has been set, every call that changes the LTU state (processNewReferenceSequence and its variants,
+trimLTUHistory, resetRefFrameHistory and removeFishFromOracle) is recorded there, along with its reference frames and result
+(see ltu_replay for the format). replay_ltu.py can then feed the session back through the LTU, e.g. to benchmark changes to it
+on a real overnight session, and check that they still give the same results.
+'''
+
+def setLTUReplayDirectory(directory):
+    # Start recording to a replay capture in directory (appending to any capture already there), or stop recording if directory is None.
+    # Recording happens in this process, even when the calls are passed on to worker processes.
+    global LTUReplayRecorder
+    if LTUReplayRecorder is not None:
+        LTUReplayRecorder.close()
+    LTUReplayRecorder = None
+    if directory is not None:
+        LTUReplayRecorder = ReplayRecorder(directory, numSamplesPerPeriod)
+    return 1
+
+
+# ===================================================================================
+# Logging
+# ===================================================================================
+'''
+Our output goes through the 'ltu' logger (see ltu_log), rather than being printed, so the amount of output can be controlled.
+At the default level (INFO) each update logs a single line. At DEBUG it also logs the shifts, drift history, solution and residuals,
+which all grow with the history and so get slower and slower to format over a long timelapse.
+Per-update diagnostics can instead be written to a rotating JSON-lines trace file, which stays a fixed size per update.
+'''
+
+def setLTULogLevel(level):
+    # level is a logging level name ('DEBUG', 'INFO', 'WARNING', 'ERROR') or number
+    if LTUWorkers is not None:
+        LTUWorkers.broadcast('setLTULogLevel', level)
+    ltu_log.setLevel(level)
+    return 1
+
+def setLTUTraceFile(path, maxBytes = 64*1024*1024, backupCount = 4):
+    # Write a trace record for every update to path (None to stop). The file is rotated once it reaches maxBytes,
+    # keeping backupCount old files. Each worker process (see startLTUWorkers) writes its own file, named after the worker.
+    if LTUWorkers is not None:
+        LTUWorkers.broadcast('setLTUTraceFile', path, maxBytes, backupCount)
+    ltu_log.enableTrace(path, maxBytes, backupCount)
+    return 1
+
+
+# ===================================================================================
+# Timing
+# ===================================================================================
+'''
+Every update records how long each of its stages took (resample, fft, driftCrop, scoring, housekeeping, solve, residuals; see ltu_timing).
+getLTUTimingStats gives rolling percentiles of these over the recent updates for a fish,
+and writeLTUTimingTrace writes them out as a Chrome trace file, with one row per fish.
+'''
+
+def getLTUTimingStats(fishIndex = 0):
+    # Returns a dict with an entry for each stage (and 'total'), each a dict of 'count', 'mean', 'max', 'p50', 'p90' and 'p99',
+    # with the times in milliseconds
+    if LTUWorkers is not None:
+        return LTUWorkers.call(fishIndex, 'getLTUTimingStats', fishIndex)
+    return getLTUState(fishIndex, 'timer').stats()
+
+def getLTUTimingEvents(fishIndex = 0):
+    # The recent stage timings for this fish as Chrome trace events
+    if LTUWorkers is not None:
+        return LTUWorkers.call(fishIndex, 'getLTUTimingEvents', fishIndex)
+    return getLTUState(fishIndex, 'timer').chromeTraceEvents(tid=fishIndex)
+
+def writeLTUTimingTrace(path, fishIndices = None):
+    # Write the recent stage timings for these fish (default: all of them) to path as a Chrome trace file
+    if fishIndices is None:
+        fishIndices = sorted(multifishOracle.keys() if LTUWorkers is None else LTUWorkers.assignment.keys())
+    events = []
+    for fishIndex in fishIndices:
+        events.extend(getLTUTimingEvents(fishIndex))
+    writeChromeTrace(path, events)
+    return 1
+
 
 # ===================================================================================
 # Additional functions used by the LTU app
@@ -136,20 +567,84 @@ So these functions are implemented here and are called by the Obj C side. The Ob
 
 def numRefFrameSetsInHistory(fishIndex = 0):
     # Return number of sets of reference sequences in the list of resampledSequences
+    if LTUWorkers is not None:
+        return LTUWorkers.call(fishIndex, 'numRefFrameSetsInHistory', fishIndex)
     resampledSequences ,_ ,_, _= getLTUParameters(fishIndex)
     return len(resampledSequences)
 
 def resetRefFrameHistory(fishIndex = 0):
-    # set the parameters for that entry in the oracle to an empty list
-    updateLTUParameters([],[],[],[], fishIndex)
+    # set the parameters for that entry in the oracle to an empty list.
+    # This replaces the whole entry, so the spectralCache and solverState are discarded along with the history.
+    # The memory budget is a setting rather than part of the history, so that is kept.
+    if LTUReplayRecorder is not None:
+        LTUReplayRecorder.record('resetRefFrameHistory', fishIndex, [fishIndex])
+    if LTUWorkers is not None:
+        return LTUWorkers.call(fishIndex, 'resetRefFrameHistory', fishIndex)
+    resetFishInOracle(fishIndex)
+
+def resetFishInOracle(fishIndex):
+    # Replace the entry for this fish with an empty one (and snapshot that, if need be).
+    # Unlike resetRefFrameHistory, this is not recorded, so that callers that are recorded themselves can use it.
+    memoryBudget = None
+    if isFishProfileInOracle(fishIndex):
+        memoryBudget = multifishOracle[fishIndex]['resampledSequences'].memoryBudget
+    multifishOracle[fishIndex] = newLTUParameterDict(memoryBudget)
+    if LTUSnapshotDirectory is not None:
+        snapshotLTUState(fishIndex)
 
 def resetMultifishOracle():
     # set parameters for each entry in the oracle to an empty list but NOT delete them
-    for keys in multifishOracle.keys():
+    fishIndices = multifishOracle.keys() if LTUWorkers is None else LTUWorkers.assignment.keys()
+    for keys in list(fishIndices):
         resetRefFrameHistory(keys)
 
 def clearMultifishOracle():
     # delete every entry in the oracle EXCPEPT the "0" entry. 
     # The parameters for this entry are just reset to empty lists.
-    for keys in multifishOracle.keys():
+    # We work down from the highest index (and iterate over a copy of the keys) since removeFishFromOracle modifies the oracle.
+    fishIndices = multifishOracle.keys() if LTUWorkers is None else LTUWorkers.assignment.keys()
+    for keys in sorted(fishIndices, reverse=True):
         removeFishFromOracle(keys)
+
+
+# ===================================================================================
+# Worker processes
+# ===================================================================================
+'''
+Optionally, the LTU calculations can be run in separate worker processes (see ltu_worker), rather than in the embedded interpreter.
+The functions above keep exactly the same signatures: while the workers are running they just pass each call on
+to the worker looking after that fish. The reference frames are passed through shared memory rather than being copied through the pipe.
+'''
+
+def startLTUWorkers(numWorkers = None, pythonExecutable = None, logDirectory = None):
+    # Start passing LTU calls on to worker processes: numWorkers of them, or one per fish if None.
+    # pythonExecutable is the python to run the workers with (sys.executable is the GUI itself when we are embedded).
+    # logDirectory is where the workers write their output (None to share our own stdout).
+    # If a snapshot directory has been set, the workers pick up the existing history from the snapshots.
+    global LTUWorkers
+    import ltu_worker
+    if LTUWorkers is not None:
+        stopLTUWorkers()
+    workers = ltu_worker.LTUWorkerPool(numWorkers, pythonExecutable, logDirectory)
+    workers.broadcast('setLTUNumSamplesPerPeriod', numSamplesPerPeriod)
+    workers.broadcast('setLTUSpillDirectory', LTUSpillDirectory)
+    workers.broadcast('setLTUSnapshotDirectory', LTUSnapshotDirectory)
+    if LTUSnapshotDirectory is not None:
+        for fishIndex in multifishOracle.keys():
+            snapshotLTUState(fishIndex)
+    LTUWorkers = workers
+    if LTUSnapshotDirectory is not None:
+        restoreMultifishOracle()
+    return 1
+
+def stopLTUWorkers():
+    # Stop the worker processes and go back to running the LTU in this process.
+    # If a snapshot directory has been set, we pick up the workers' history from the snapshots.
+    global LTUWorkers
+    if LTUWorkers is None:
+        return 1
+    LTUWorkers.stop()
+    LTUWorkers = None
+    if LTUSnapshotDirectory is not None:
+        restoreMultifishOracle()
+    return 1
@@ -0,0 +1,208 @@
+'''Bounded-memory store for the resampled reference sequences kept by the LTU (resampledSequences in memoryCC).
+ReferenceHistory behaves like the list it replaces (len, indexing, slicing, iteration, append),
+but holds each entry in a compact type rather than float64:
+* float32, which halves the memory and is far more precise than the (integer) camera data it came from
+* uint16 with a per-entry scale and offset, which halves it again
+Entries are returned as float32 arrays, and are only widened to float64 inside the scoring kernel.
+
+A memory budget (in bytes) can be set. Once the store exceeds it, the oldest entries are first compacted to uint16,
+and then, if necessary, spilled to disk (see below - in the system's temporary directory, if no spill directory has been set).
+The most recent entries are never touched, since those are the ones the next update compares against
+(the caller says how many to keep, see enforceMemoryBudget). Old entries are only needed again if the history
+is trimmed back to them, but then they are needed, so nothing is ever discarded altogether.
+(Snapshots written by older versions may still contain entries whose pixel data was discarded - see isEvicted.)
+
+Alternatively, a spill directory can be set. Entries outside the comparison window are then moved
+to an append-only file in that directory (one per store), and read back through np.memmap if they are ever needed again,
+so the operating system only pages in the parts that are actually used. RAM use then stays flat however long the history gets.
+The file is deleted once nothing refers to it any more.'''
+
+# Python Imports
+import os
+import tempfile
+from collections import namedtuple
+import numpy as np
+
+
+# An entry that is held in a file (a SpillFile, or a MappedFile such as an LTU snapshot) rather than in memory
+SpilledEntry = namedtuple('SpilledEntry', ['spillFile', 'offset', 'dtype', 'shape'])
+
+
+class MappedFile(object):
+    # A file containing entries, which we read through np.memmap.
+    # We keep hold of a single mapping of the whole file (only remapping if it has grown since),
+    # so entries stay readable even if the file is later removed or replaced.
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+
+    def read(self, entry):
+        end = entry.offset + int(np.prod(entry.shape)) * np.dtype(entry.dtype).itemsize
+        if (self._map is None) or (len(self._map) < end):
+            self._map = np.memmap(self.path, dtype='uint8', mode='r')
+        return self._map[entry.offset:end].view(entry.dtype).reshape(entry.shape)
+
+
+class SpillFile(MappedFile):
+    # Append-only file of entries spilled from a ReferenceHistory (and any stores sliced from it)
+    alignment = 8
+
+    def __init__(self, directory):
+        (handle, path) = tempfile.mkstemp(prefix='ltu_history_', suffix='.bin', dir=directory)
+        MappedFile.__init__(self, path)
+        self._file = os.fdopen(handle, 'wb')
+        self.size = 0
+
+    def write(self, array):
+        array = np.ascontiguousarray(array)
+        offset = self.size
+        self._file.write(array)
+        # Pad so every entry starts on an aligned offset
+        padding = -array.nbytes % self.alignment
+        self._file.write(bytes(padding))
+        self._file.flush()
+        self.size += array.nbytes + padding
+        return SpilledEntry(self, offset, array.dtype, array.shape)
+
+    def __del__(self):
+        try:
+            self._file.close()
+            os.remove(self.path)
+        except (OSError, AttributeError):
+            pass
+
+
+class ReferenceHistory(object):
+
+    def __init__(self, sequences=(), dtype='float32', memoryBudget=None, spillDirectory=None):
+        # dtype is the type new entries are stored as ('float32' or 'uint16')
+        # memoryBudget is the maximum number of bytes of pixel data to hold (None for no limit)
+        # spillDirectory is where to put the spill file (None to keep everything in memory,
+        #   unless the memory budget forces entries out to the system's temporary directory)
+        self.dtype = np.dtype(dtype)
+        self.memoryBudget = memoryBudget
+        self.spillDirectory = spillDirectory
+        self._spillFile = None
+        # Every entry before this index has already been spilled (or evicted)
+        self._firstInMemory = 0
+        self._entries = []
+        self._scales = []
+        self._offsets = []
+        self._frameShape = None
+        for sequence in sequences:
+            self.append(sequence)
+
+    @staticmethod
+    def _encode(sequence, dtype):
+        # Returns (stored array, scale, offset) for a float array
+        if dtype == np.dtype('uint16'):
+            offset = float(np.min(sequence))
+            scale = (float(np.max(sequence)) - offset) / 65535.0
+            if scale == 0:
+                scale = 1.0
+            return (np.rint((sequence - offset) / scale).astype('uint16'), scale, offset)
+        return (np.asarray(sequence, dtype=dtype), None, None)
+
+    def append(self, sequence):
+        (stored, scale, offset) = self._encode(sequence, self.dtype)
+        self.appendStored(stored, scale, offset, stored.shape[1:])
+
+    def appendStored(self, stored, scale, offset, frameShape):
+        # Append an entry that is already in stored form: an array (in our dtype, or uint16 with scale and offset),
+        # a SpilledEntry, or None for an entry whose pixel data was discarded (by an older version, see isEvicted)
+        if self._frameShape is None:
+            self._frameShape = tuple(frameShape)
+        self._entries.append(stored)
+        self._scales.append(scale)
+        self._offsets.append(offset)
+
+    def storedEntry(self, n):
+        # Entry n in stored form, as (array or None if evicted, scale, offset). Spilled entries are read back from disk.
+        entry = self._entries[n]
+        if isinstance(entry, SpilledEntry):
+            entry = entry.spillFile.read(entry)
+        return (entry, self._scales[n], self._offsets[n])
+
+    @property
+    def frameShape(self):
+        # Shape of a single frame in the history, or None if nothing has been added yet
+        return self._frameShape
+
+    def entryBytes(self, n):
+        # Bytes of pixel data held in memory for entry n
+        entry = self._entries[n]
+        return entry.nbytes if isinstance(entry, np.ndarray) else 0
+
+    @property
+    def nbytes(self):
+        # Bytes of pixel data currently held in memory
+        return sum(self.entryBytes(n) for n in range(len(self._entries)))
+
+    def isEvicted(self, n):
+        # Whether entry n has no pixel data. We never discard pixel data ourselves,
+        # but older versions did, and their snapshots can still be restored.
+        return self._entries[n] is None
+
+    def compact(self, n):
+        # Convert entry n to uint16 (if it isn't already, or no longer in memory)
+        entry = self._entries[n]
+        if isinstance(entry, np.ndarray) and (entry.dtype != np.dtype('uint16')):
+            (self._entries[n], self._scales[n], self._offsets[n]) = self._encode(entry, np.dtype('uint16'))
+
+    def spill(self, n):
+        # Move entry n out of memory and into our spill file (created in the temporary directory if we have no spill directory)
+        entry = self._entries[n]
+        if isinstance(entry, np.ndarray):
+            if self._spillFile is None:
+                self._spillFile = SpillFile(self.spillDirectory)
+            self._entries[n] = self._spillFile.write(entry)
+
+    def releaseOldEntries(self, keepRecent):
+        # Called after each update: the keepRecent most recent entries will be compared against the next one,
+        # but anything older can be spilled to disk (if we have a spill directory) and/or compacted to meet our memory budget.
+        if self.spillDirectory is not None:
+            for n in range(self._firstInMemory, len(self._entries) - keepRecent):
+                self.spill(n)
+            self._firstInMemory = max(self._firstInMemory, len(self._entries) - keepRecent)
+        self.enforceMemoryBudget(keepRecent)
+
+    def enforceMemoryBudget(self, keepRecent):
+        # Bring the store within its memory budget, without touching the keepRecent most recent entries.
+        # We compact the oldest entries first, and only spill them to disk once everything eligible has been compacted.
+        # Nothing is ever discarded, since a later trim (see memoryCC.trimLTUHistory) can bring any entry back into use.
+        if self.memoryBudget is None:
+            return
+        eligible = range(max(0, len(self._entries) - keepRecent))
+        total = self.nbytes
+        for reduce in [self.compact, self.spill]:
+            for n in eligible:
+                if total <= self.memoryBudget:
+                    return
+                total -= self.entryBytes(n)
+                reduce(n)
+                total += self.entryBytes(n)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            # New store sharing our (unchanging) entries
+            result = ReferenceHistory(dtype=self.dtype, memoryBudget=self.memoryBudget, spillDirectory=self.spillDirectory)
+            result._spillFile = self._spillFile
+            result._entries = self._entries[n]
+            result._scales = self._scales[n]
+            result._offsets = self._offsets[n]
+            result._frameShape = self._frameShape
+            return result
+        # Spilled entries are paged in from disk on demand
+        (entry, scale, offset) = self.storedEntry(n)
+        if entry is None:
+            raise LookupError('Reference history entry {0} has no pixel data (it was discarded by an older version)'.format(n))
+        if scale is None:
+            return entry
+        return entry.astype('float32') * np.float32(scale) + np.float32(offset)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
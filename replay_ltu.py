@@ -0,0 +1,125 @@
+'''Replay a captured LTU session (see ltu_replay and setLTUReplayDirectory in multifish-ltu-wrapper.py) through the LTU.
+
+The calls are fed through a fresh copy of multifish-ltu-wrapper.py one after another, as fast as possible,
+and we report the latency of each kind of call, the memory used, and whether the shift solutions still match the recorded ones.
+The LTU settings can be changed for the replay (e.g. --latency-budget or --embedding), to see how they affect the speed and results.
+It exits with a non-zero status if any solution differs from the recorded one by more than --tolerance (unless --no-check is given),
+so it can be used to check that a change to the LTU doesn't change its results:
+    python replay_ltu.py /path/to/capture'''
+
+# Python Imports
+import sys
+import time
+import resource
+import argparse
+import numpy as np
+# Local Imports
+import ltu_replay
+import ltu_worker
+
+
+def ReplaySession(capture, wrapper, limit=None, tolerance=1e-6, quiet=True):
+    # Feed the calls in capture (an ltu_replay.ReplayCapture) through wrapper, returning a dict of:
+    # * 'latencies': function name -> list of the time (in seconds) each call took
+    # * 'footprints': fish index -> LTU memory footprint (in bytes) after each update for that fish (see getLTUMemoryFootprint)
+    # * 'differences': the difference between the replayed and recorded solution for each update
+    #   (except those where only one of them is None - see SolutionDifference - which just count as mismatches)
+    # * 'mismatches': (call number, fish index, recorded, replayed) for each update whose solution differs by more than tolerance
+    import io
+    import contextlib
+    results = {'latencies': {}, 'footprints': {}, 'differences': [], 'mismatches': []}
+    calls = capture.calls if limit is None else capture.calls[:limit]
+    for (n, call) in enumerate(calls):
+        args = capture.args(call)
+        function = getattr(wrapper, call['call'])
+        with contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+            start = time.perf_counter()
+            result = function(*args)
+            elapsed = time.perf_counter() - start
+        results['latencies'].setdefault(call['call'], []).append(elapsed)
+        if call['call'] == 'processNewReferenceSequence':
+            fishIndex = call['fishIndex']
+            results['footprints'].setdefault(fishIndex, []).append(wrapper.getLTUMemoryFootprint(fishIndex))
+            difference = SolutionDifference(call['result'], result)
+            if difference is not None:
+                results['differences'].append(difference)
+            if (difference is None) or not (difference <= tolerance):
+                results['mismatches'].append((n, fishIndex, call['result'], result))
+    return results
+
+
+def SolutionDifference(recorded, replayed):
+    # Difference between a recorded and a replayed solution. processNewReferenceSequence returns None when it can't produce
+    # a solution (e.g. the frames are the wrong shape, or there isn't enough history yet): if both are None they match
+    # (a difference of 0), but if only one is, the replay has diverged, and we return None.
+    if (recorded is None) and (replayed is None):
+        return 0.0
+    if (recorded is None) or (replayed is None):
+        return None
+    return abs(replayed - recorded)
+
+
+def PeakRSS():
+    # Peak resident set size (in bytes) of this process and of any (finished) child processes, e.g. LTU workers
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a captured LTU session, reporting latency, memory and any change in the results')
+    parser.add_argument('capture', help='directory containing the capture (see setLTUReplayDirectory)')
+    parser.add_argument('--limit', type=int, default=None, help='only replay this many calls')
+    parser.add_argument('--tolerance', type=float, default=1e-6, help='largest acceptable difference from the recorded shift solutions')
+    parser.add_argument('--no-check', action='store_true', help="don't fail if the solutions differ from the recorded ones")
+    parser.add_argument('--workers', type=int, default=None, help='run the LTU in this many worker processes (0 for one per fish)')
+    parser.add_argument('--latency-budget', type=float, default=None, help='latency budget in seconds (see setLTULatencyBudget)')
+    parser.add_argument('--motion-roi', action='store_true', help='only compare the moving region of the frames (see setLTUMotionRoI)')
+    parser.add_argument('--local-search-radius', type=int, default=None, help='see setLTULocalSearchRadius')
+    parser.add_argument('--embedding', type=int, default=None, help='number of components to compare in (see setLTUFrameEmbedding)')
+    parser.add_argument('--timing-trace', default=None, help='write a Chrome trace of the stage timings to this file')
+    parser.add_argument('--verbose', action='store_true', help="show the LTU's own output")
+    args = parser.parse_args()
+
+    capture = ltu_replay.ReplayCapture(args.capture)
+    wrapper = ltu_worker.loadWrapper()
+    if args.workers is not None:
+        wrapper.startLTUWorkers(args.workers or None)
+    if capture.header.get('numSamplesPerPeriod') is not None:
+        wrapper.setLTUNumSamplesPerPeriod(capture.header['numSamplesPerPeriod'])
+    wrapper.setLTULatencyBudget(args.latency_budget)
+    wrapper.setLTUMotionRoI(args.motion_roi)
+    wrapper.setLTULocalSearchRadius(args.local_search_radius)
+    wrapper.setLTUFrameEmbedding(args.embedding)
+
+    print('Replaying {0} calls from {1}'.format(len(capture) if args.limit is None else min(args.limit, len(capture)), args.capture))
+    start = time.perf_counter()
+    results = ReplaySession(capture, wrapper, args.limit, args.tolerance, quiet=not args.verbose)
+    elapsed = time.perf_counter() - start
+    print('Replayed in {0:.2f}s'.format(elapsed))
+
+    print('Latency (ms):')
+    for (functionName, latencies) in results['latencies'].items():
+        ms = 1e3 * np.asarray(latencies)
+        (p50, p90, p99) = np.percentile(ms, [50, 90, 99])
+        print('  {0:28s} n={1:<6d} mean {2:8.2f}  p50 {3:8.2f}  p90 {4:8.2f}  p99 {5:8.2f}  max {6:8.2f}'.format(functionName, len(ms), np.mean(ms), p50, p90, p99, np.max(ms)))
+    print('Memory:')
+    for (fishIndex, footprints) in sorted(results['footprints'].items()):
+        print('  fish {0}: LTU footprint final {1:.1f} MB, peak {2:.1f} MB'.format(fishIndex, footprints[-1] / 1e6, max(footprints) / 1e6))
+    if args.timing_trace is not None:
+        wrapper.writeLTUTimingTrace(args.timing_trace)
+    if args.workers is not None:
+        # (so that the workers' peak memory is included below)
+        wrapper.stopLTUWorkers()
+    (selfRSS, childRSS) = PeakRSS()
+    print('  peak RSS {0:.1f} MB (workers {1:.1f} MB)'.format(selfRSS / 1e6, childRSS / 1e6))
+
+    differences = results['differences']
+    if len(differences) > 0:
+        print('Largest difference from the recorded solutions: {0}'.format(np.max(differences)))
+    for (n, fishIndex, recorded, replayed) in results['mismatches'][:10]:
+        print('  call {0} (fish {1}): recorded {2}, replayed {3}'.format(n, fishIndex, recorded, replayed))
+    if len(results['mismatches']) > 0:
+        numUpdates = sum(len(footprints) for footprints in results['footprints'].values())
+        print('{0} of {1} solutions differ by more than {2}'.format(len(results['mismatches']), numUpdates, args.tolerance))
+    sys.exit(1 if (len(results['mismatches']) > 0) and not args.no_check else 0)
@@ -0,0 +1,82 @@
+'''Vectorized kernel for resampling a sequence of frames to a fixed number of samples per heartbeat period.
+Shared by simpleCC.resampleImageSection (realtime LTU) and periods.ResampleImageSection (offline analysis).
+All the interpolation positions and weights are calculated as arrays, and the output is then produced
+by gathering and blending the frames for many output samples at once (see blendFrames).'''
+
+# Python Imports
+import numpy as np
+
+# Number of pixels blendFrames blends at once when writing into an output array. Blending the whole sequence at once
+# is limited by memory bandwidth (and is several times slower for full-size frames), so we keep the temporaries small
+# enough to stay in cache. Frames too big to blend more than one at a time are just blended one by one.
+blendBlockPixels = 2**14
+
+
+def resamplingPositions(period, numSamplesPerPeriod, numOutputSamples, wrapLength, anomalous=None):
+    '''Frame indices and interpolation weights for uniformly resampling a sequence.
+    Output sample i lies at (i / numSamplesPerPeriod) * period, and is interpolated between
+    frames beforeIndex[i] and afterIndex[i], with weight remainder[i] given to the latter.
+
+    Inputs:
+    * period: the period of the sequence (in frames)
+    * numSamplesPerPeriod: the number of output samples per period
+    * numOutputSamples: the total number of output samples
+    * wrapLength: afterIndex is taken modulo this value (which may be a non-integer period)
+    * anomalous: optional boolean array marking frames (e.g. laser flashes) that should not be used.
+      Interpolation then uses the nearest non-anomalous frames either side instead.
+      If the first or last frame is anomalous and there is no alternative then the anomaly is retained.
+
+    Outputs:
+    * beforeIndex, afterIndex: integer arrays of frame indices
+    * remainder: array of interpolation weights, in the range [0, 1)'''
+    desiredPos = (np.arange(numOutputSamples) / float(numSamplesPerPeriod)) * period
+    beforePos = desiredPos.astype('int')
+    afterPos = beforePos + 1
+    if anomalous is not None:
+        # For every frame, find the nearest non-anomalous frame at or before it (or frame 0 if there is none),
+        # and the nearest non-anomalous frame at or after it (or the last frame if there is none)
+        anomalous = np.asarray(anomalous, dtype='bool')
+        numFrames = len(anomalous)
+        frameNumbers = np.arange(numFrames)
+        lastGood = np.maximum.accumulate(np.where(anomalous, 0, frameNumbers))
+        nextGood = np.minimum.accumulate(np.where(anomalous, numFrames-1, frameNumbers)[::-1])[::-1]
+        beforePos = lastGood[beforePos]
+        afterPos = nextGood[np.minimum(afterPos, numFrames-1)]
+    remainder = (desiredPos - beforePos) / (afterPos - beforePos).astype('float')
+    afterIndex = (afterPos % wrapLength).astype('int')
+    return beforePos, afterIndex, remainder
+
+
+def blendFrames(frames, beforeIndex, afterIndex, remainder, out=None):
+    '''Linear interpolation between frames[beforeIndex] and frames[afterIndex] for every output sample at once.
+    frames may be any array (or array-like) whose first axis is time, and of any numeric type.
+    Returns a float array with one entry along the first axis per output sample.
+
+    If out is given, the result is written into out (converting it to out's type as an assignment would), and out is returned.
+    frames can then also be any sequence of frames (e.g. a list of 2D arrays, or a view of a buffer), which is blended
+    one output frame at a time without first being gathered into a single array. An array of small frames (e.g. cropped
+    to a region of interest) is instead blended a block of output frames at a time (see blendBlockPixels), to save
+    the overhead of blending them one by one. Either way, the only full-size allocation is out itself.'''
+    if (out is not None) and ((not isinstance(frames, np.ndarray)) or (frames[0].size * 2 > blendBlockPixels)):
+        for (k, (before, after, weight)) in enumerate(zip(beforeIndex, afterIndex, remainder)):
+            out[k] = frames[before] * (1 - weight) + frames[after] * weight
+        return out
+    frames = np.asarray(frames)
+    weights = remainder.reshape((-1,) + (1,) * (frames.ndim - 1))
+    if out is None:
+        result = np.take(frames, beforeIndex, axis=0) * (1 - weights)
+        result += np.take(frames, afterIndex, axis=0) * weights
+        return result
+    blockSize = max(1, blendBlockPixels // max(1, frames[0].size))
+    inPlace = (out.dtype == np.result_type(frames, weights))
+    for start in range(0, len(beforeIndex), blockSize):
+        block = slice(start, start + blockSize)
+        if inPlace:
+            np.multiply(np.take(frames, beforeIndex[block], axis=0), 1 - weights[block], out=out[block])
+            out[block] += np.take(frames, afterIndex[block], axis=0) * weights[block]
+        else:
+            # (blended at the full precision and then converted, as the frame-by-frame blend above does)
+            result = np.take(frames, beforeIndex[block], axis=0) * (1 - weights[block])
+            result += np.take(frames, afterIndex[block], axis=0) * weights[block]
+            out[block] = result
+    return out
@@ -0,0 +1,145 @@
+'''Shared kernel for scoring every relative time shift between two image sequences.
+The score is the sum-squared-differences for each (cyclic) shift, evaluated as a cross-correlation using FFTs.
+This is used both by the realtime LTU (simpleCC, memoryCC) and by the offline analysis (shifts.GetShifts).
+Our image data is always real, so we use real-to-complex transforms, which roughly halves the cost and memory of the FFTs.'''
+
+# Python Imports
+import os
+import threading
+import contextlib
+import numpy as np
+
+# Choose an FFT backend at import time. In order of preference:
+# * pyfftw (through its scipy.fft interface), with its plan cache enabled so plans are reused between calls
+# * scipy.fft, which can spread each transform across several threads and keeps its own cache of plans
+# * numpy.fft, which is always available (single threaded)
+# The choice can be forced by setting LTU_FFT_BACKEND to 'pyfftw', 'scipy' or 'numpy',
+# and the number of threads by setting LTU_FFT_WORKERS.
+fftWorkers = int(os.environ.get('LTU_FFT_WORKERS', os.cpu_count() or 1))
+# Overrides fftWorkers for the current thread (see limitFFTWorkers)
+_threadSettings = threading.local()
+_requestedBackend = os.environ.get('LTU_FFT_BACKEND', None)
+fftBackend = 'numpy.fft'
+_fft = np.fft
+if _requestedBackend in (None, 'pyfftw'):
+    try:
+        import pyfftw
+        import pyfftw.interfaces.scipy_fft as _fft
+        pyfftw.interfaces.cache.enable()
+        fftBackend = 'pyfftw'
+    except ImportError:
+        pass
+if (fftBackend == 'numpy.fft') and (_requestedBackend in (None, 'scipy')):
+    try:
+        import scipy.fft as _fft
+        fftBackend = 'scipy.fft'
+    except ImportError:
+        pass
+
+
+@contextlib.contextmanager
+def limitFFTWorkers(numWorkers):
+    '''Use at most numWorkers threads for each FFT made by the current thread, within the with block.
+    For when several threads are making FFTs at once (e.g. the LTU updating several fish in a thread pool),
+    so that between them they don't start more threads than there are cores.'''
+    previous = getattr(_threadSettings, 'fftWorkers', None)
+    _threadSettings.fftWorkers = max(1, min(numWorkers, fftWorkers))
+    try:
+        yield
+    finally:
+        _threadSettings.fftWorkers = previous
+
+
+def workersForThisThread():
+    workers = getattr(_threadSettings, 'fftWorkers', None)
+    return fftWorkers if workers is None else workers
+
+
+def rfft(a, axis=0):
+    '''Real-to-complex FFT along one axis, using the selected backend.'''
+    if fftBackend == 'numpy.fft':
+        return np.fft.rfft(a, axis=axis)
+    return _fft.rfft(a, axis=axis, workers=workersForThisThread())
+
+
+def irfft(a, n, axis=0):
+    '''Inverse of rfft, for an original length of n along the transformed axis.'''
+    if fftBackend == 'numpy.fft':
+        return np.fft.irfft(a, n, axis=axis)
+    return _fft.irfft(a, n, axis=axis, workers=workersForThisThread())
+
+
+def spectralTerms(seq):
+    '''Real FFT along the time axis (axis 0) and the per-pixel energy summed over time.
+    seq may be of order TXY or T(XY), and of any numeric type (it is widened to float64 here).
+    These are the only terms scoresFromSpectra needs from each sequence,
+    so they can be cached for a sequence that will be compared more than once.'''
+    seq = np.asarray(seq, dtype='float')
+    return rfft(seq, axis=0), np.sum(seq*seq, axis=0)
+
+
+def binSpatially(a, factor):
+    '''Sum a (of order TXY) over blocks of factor x factor pixels, discarding any incomplete blocks at the edges.
+    This is linear, so binning the rfft of a sequence gives the rfft of the binned sequence.'''
+    (numT, height, width) = np.shape(a)
+    height -= height % factor
+    width -= width % factor
+    # Adding strided views is much quicker than reshaping and summing over the block axes
+    result = np.array(a[:, 0:height:factor, 0:width:factor], dtype=np.result_type(a, np.float32))
+    for dy in range(factor):
+        for dx in range(factor):
+            if (dy, dx) != (0, 0):
+                result += a[:, dy:height:factor, dx:width:factor]
+    return result
+
+
+def energyFromSpectrum(fft, numSamples):
+    '''The per-pixel energy summed over time (as returned by spectralTerms), recovered from the rfft using Parseval's theorem.
+    numSamples is the length of the original sequence along the time axis.'''
+    # Every frequency except zero (and the Nyquist frequency, for even numSamples) stands for a conjugate pair
+    weights = np.full(len(fft), 2.0)
+    weights[0] = 1.0
+    if (numSamples % 2 == 0):
+        weights[-1] = 1.0
+    return np.tensordot(weights, fft.real**2 + fft.imag**2, axes=(0, 0)) / numSamples
+
+
+def scoresFromSpectra(fft1, energy1, fft2, energy2, numSamples):
+    '''Sum-squared-differences scores for every relative shift, given the spectralTerms of each sequence.
+    numSamples is the length of the sequences along the time axis (which cannot be inferred from the rfft).
+    The arrays may have been cropped in XY, provided both are cropped consistently.
+    The spatial sum is taken before the inverse FFT, so only a single length-T transform is needed.'''
+    spatialAxes = tuple(range(1, np.ndim(fft1)))
+    cross = np.sum(np.conj(fft1) * fft2, axis=spatialAxes)
+    return np.sum(energy1) + np.sum(energy2) - 2 * irfft(cross, numSamples)
+
+
+def windowedScores(seq1, seq2, shifts):
+    '''Scores (as returned by shiftScores) for just the given shifts, calculated directly in the time domain.
+    Each one costs a single pass over the pixels, so this is cheaper than the FFTs when only a few shifts are needed.
+    The shifts should be close together (e.g. a window around an expected shift), since all the shifts between them are evaluated.'''
+    numSamples = len(seq1)
+    if len(shifts) == 0:
+        return np.zeros(0)
+    # The SSD is expanded into the energies and a cross term, cross[k] = sum over t of seq1[t].seq2[t+k].
+    # The cross terms for a run of consecutive shifts are accumulated one time sample at a time, as a product of seq1[t]
+    # with the block of rows of seq2 that it lines up with; consecutive blocks overlap, so they stay in cache.
+    # The sequences may be cropped views, so we only copy a frame of seq1 at a time, and the rows of seq2 in a single gather.
+    offsets = (np.asarray(shifts, dtype='int') - shifts[0]) % numSamples
+    first = int(shifts[0]) % numSamples
+    span = int(np.max(offsets)) + 1
+    rows = np.asarray(seq2)[(first + np.arange(numSamples + span - 1)) % numSamples]
+    rows = np.reshape(np.asarray(rows, dtype='float'), (len(rows), -1))
+    cross = np.zeros(span)
+    energy = np.vdot(rows[:numSamples], rows[:numSamples])
+    for t in range(numSamples):
+        frame = np.asarray(seq1[t], dtype='float').ravel()
+        cross += rows[t:t+span] @ frame
+        energy += frame @ frame
+    return energy - 2 * cross[offsets]
+
+
+def shiftScores(seq1, seq2):
+    '''Scores for two sequences of the same shape, where scores[k] is the sum-squared-difference
+    between seq1 and seq2 after rolling seq2 back by k samples.'''
+    return scoresFromSpectra(*spectralTerms(seq1), *spectralTerms(seq2), len(seq1))
@@ -0,0 +1,105 @@
+'''Columnar store for the relative shifts between reference sequences.
+Each shift is a row of (seq1Index, seq2Index, shift, score), as in the list-of-tuples 'shifts'
+used throughout memoryCC and shifts_global_solution. The rows are kept in a single preallocated array
+(one contiguous column per field) that doubles in size as it fills up, so appending is cheap
+and filtering or solving works on the arrays directly rather than looping over tuples in Python.
+
+ShiftTable also behaves like the list it replaces (len, indexing, iteration, append, copy, repr),
+so existing code that treats 'shifts' as a list of tuples keeps working unchanged.'''
+
+# Python Imports
+import numpy as np
+
+
+class ShiftTable(object):
+    initialCapacity = 64
+
+    def __init__(self, shifts=()):
+        # shifts may be a list of (seq1Index, seq2Index, shift, score) tuples, an Nx4 array, or another ShiftTable
+        shiftArray = np.asarray(shifts, dtype='float').reshape(-1, 4)
+        self._length = len(shiftArray)
+        self._data = np.zeros((max(self.initialCapacity, self._length), 4), order='F')
+        self._data[:self._length] = shiftArray
+        # Map from (seq1Index, seq2Index) to the row holding that shift (see lookup).
+        # It is only built when it is first needed, and discarded when rows are removed, so trimming stays cheap.
+        self._index = None
+
+    # Column views (these are only valid until the table is next modified)
+    @property
+    def i(self):
+        return self._data[:self._length, 0].astype('int')
+
+    @property
+    def j(self):
+        return self._data[:self._length, 1].astype('int')
+
+    @property
+    def shift(self):
+        return self._data[:self._length, 2]
+
+    @property
+    def score(self):
+        return self._data[:self._length, 3]
+
+    def __array__(self, dtype=None, copy=None):
+        # Nx4 array of the rows, as used by shifts_global_solution.ShiftArray
+        if copy:
+            return np.array(self._data[:self._length], dtype=dtype)
+        return np.asarray(self._data[:self._length], dtype=dtype)
+
+    def append(self, shift):
+        (i, j, shiftValue, score) = shift
+        if (self._length == len(self._data)):
+            grown = np.zeros((2 * len(self._data), 4), order='F')
+            grown[:self._length] = self._data[:self._length]
+            self._data = grown
+        self._data[self._length] = (i, j, shiftValue, score)
+        if self._index is not None:
+            self._index[(int(i), int(j))] = self._length
+        self._length += 1
+
+    def extend(self, shifts):
+        for shift in shifts:
+            self.append(shift)
+
+    def trim(self, trimToLength):
+        # Remove (in place) every shift involving a sequence index of trimToLength or more
+        keep = self._data[:self._length, 1] < trimToLength
+        kept = self._data[:self._length][keep]
+        self._length = len(kept)
+        self._data[:self._length] = kept
+        self._index = None
+
+    def withMaxRange(self, maxRange):
+        # New table containing only the shifts between sequences at most maxRange apart
+        return ShiftTable(self._data[:self._length][self.j <= self.i + maxRange])
+
+    def lookup(self, i, j):
+        # The shift between sequences i and j as a tuple (the most recent, if there are duplicates), or None if there isn't one
+        if self._index is None:
+            self._index = {(i, j): n for (n, (i, j)) in enumerate(zip(self.i.tolist(), self.j.tolist()))}
+        n = self._index.get((i, j))
+        if n is None:
+            return None
+        return self[n]
+
+    def copy(self):
+        return ShiftTable(self)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return ShiftTable(self._data[:self._length][n])
+        if (n < -self._length) or (n >= self._length):
+            raise IndexError('ShiftTable index out of range')
+        (i, j, shift, score) = self._data[n % self._length].tolist()
+        return (int(i), int(j), shift, score)
+
+    def __iter__(self):
+        return iter(zip(self.i.tolist(), self.j.tolist(), self.shift.tolist(), self.score.tolist()))
+
+    def __repr__(self):
+        # Same as the equivalent list, so that logging output is unchanged
+        return repr(list(self))
@@ -8,6 +8,7 @@ from math import log, sqrt, sin
 import scipy.signal, scipy.ndimage
 import sys, time, warnings
 from tqdm import *
+import scoring_kernel as sk
 
 def ScoreSequences(sec1, sec2, window1=None, window2=None):
     # Utility function that returns a score for the level of correlation between two sequences
@@ -74,23 +75,13 @@ def ShiftScoresForSequences(seqA, seqB, numSamplesPerPeriod, window1=None, windo
         # depending on how exactly I handle it.
         
         # First form a pair of arrays from the image data
-        t1 = time.time()
         a = MakeArrayFromSequence(seqA[0:numSamplesPerPeriod], window1)
         b = MakeArrayFromSequence(seqB[0:numSamplesPerPeriod], window2)
-        t2 = time.time()
-        # Now calculate the cross-correlation
-        #        temp = np.conj(np.fft.rfft(a, axis=0)) * np.fft.rfft(b, axis=0)
-        temp = np.conj(np.fft.fft(a, axis=0)) * np.fft.fft(b, axis=0)
-        t3 = time.time()
-        #temp2 = np.fft.irfft(temp, len(a[:,0]), axis=0)
-        temp2 = np.fft.ifft(temp, axis=0)
-        t4 = time.time()
+        # Now calculate the cross-correlation, using the real-input FFT kernel shared with the realtime code.
         # This is mathematically equivalent to the sum-squared-differences.
-        # I have left it like this for ease of comparison, but note that the first two terms
-        # are constants that have no effect on the result. (They shouldn't take long to evaluate though)
-        scores = np.sum(a*a) + np.sum(b*b) - 2 * np.sum(np.real(temp2), axis=1)
-        t5 = time.time()
-        #print('time breakdown', t2-t1, t3-t2, t4-t3, t5-t4)
+        # Note that the energy terms in the scores are constants that have no effect on the result.
+        # (They shouldn't take long to evaluate though)
+        scores = sk.shiftScores(a, b)
     else:
         # I tried this to see how it performs, but doing it this way round is not really any faster
         t1 = time.time()
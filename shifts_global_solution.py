@@ -1,9 +1,26 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import sys
+import ltu_log
+from ltu_log import logger, debugEnabled
+from shift_table import ShiftTable
 from math import log, sqrt, sin
 
-def SolveForShifts(shifts, numSequences, knownPhaseIndex, knownPhase):
+# When MakeShiftsSelfConsistent is asked to choose (sparse=None), problems with more sequences than this are solved
+# as a sparse system of equations. M has a row for every shift and a column for every sequence, but only two nonzero values
+# in each row, so for offline analysis of a long timelapse the dense matrix would be far too big to hold in memory.
+# The realtime LTU always uses the dense solver (the default), however long its history gets.
+sparseSolverThreshold = 1000
+
+def ShiftArray(shifts):
+    # Return 'shifts' as an Nx4 array, with columns (seq1Index, seq2Index, shift, score).
+    # Accepts the usual list of tuples, or an array that is already in this form (which is not copied).
+    return np.asarray(shifts, dtype='float').reshape(-1, 4)
+
+def ShiftList(shiftArray):
+    # Inverse of ShiftArray: the list-of-tuples form, with integer sequence indices
+    return list(zip(shiftArray[:, 0].astype('int').tolist(), shiftArray[:, 1].astype('int').tolist(),
+                    shiftArray[:, 2].tolist(), shiftArray[:, 3].tolist()))
+
+def SolveForShifts(shifts, numSequences, knownPhaseIndex, knownPhase, sparse=False, initialGuess=None):
     # Build a matrix/vector describing the system of equations Mx = a
     # This expects an input of 'shifts' consisting of tuplets of (seq1Index, seq2Index, shift, score)
     # and an integer giving the number of sequences
@@ -11,104 +28,352 @@ def SolveForShifts(shifts, numSequences, knownPhaseIndex, knownPhase):
     # Score NEEDS TO BE DOCUMENTED
     # Note that this function forces the absolute phase of the first sequence
     # to be equal to phaseForFirstSequence.
-    M = np.zeros((len(shifts)+1, numSequences))
-    a = np.zeros(len(shifts)+1)
-    w = a.copy()
-    for n in range(len(shifts)):
-        (i, j, shift, score) = shifts[n]
-        M[n, i] = -1
-        M[n, j] = 1
-        a[n] = shift
-        w[n] = 1.0 / score
-    M[len(shifts), knownPhaseIndex] = 1
-    a[len(shifts)] = knownPhase
-    w[len(shifts)] = 1
+    # If sparse is True then we solve the system iteratively (see SolveSparseSystem),
+    # starting from initialGuess if one is provided.
+    shiftArray = ShiftArray(shifts)
+    numShifts = len(shiftArray)
+    i = shiftArray[:, 0].astype('int')
+    j = shiftArray[:, 1].astype('int')
+    a = np.append(shiftArray[:, 2], knownPhase)
+    w = np.append(1.0 / shiftArray[:, 3], 1)
 
     # I tried Liebling's weighted least squares formula and couldn't seem to get it to work.
     # This is one from http://stackoverflow.com/questions/19624997/understanding-scipys-least-square-function-with-irls
-    Mw = M * np.sqrt(w[:,np.newaxis])
     aw = a * np.sqrt(w)
+    if sparse:
+        return SolveSparseSystem(i, j, np.sqrt(w), aw, numSequences, knownPhaseIndex, initialGuess)
+
+    M = np.zeros((numShifts+1, numSequences))
+    M[np.arange(numShifts), i] = -1
+    M[np.arange(numShifts), j] = 1
+    M[numShifts, knownPhaseIndex] = 1
+    Mw = M * np.sqrt(w[:,np.newaxis])
     try:
         (selfConsistentShifts, residuals, rank, s) = np.linalg.lstsq(Mw, aw)
     except:
-        print("Exception during np.linalg.lstsq")
-        print("Inputs as printed after exception:")
-        print(Mw)
-        print(aw)
-        print("Finished listing inputs", flush=True)
+        logger.error('Exception during np.linalg.lstsq')
+        logger.error('Inputs as printed after exception:\n%s\n%s', Mw, aw)
+        logger.error('Finished listing inputs')
+        ltu_log.flushOutput()
         raise
     return (selfConsistentShifts, residuals)
 
-def SolveWithMaxRange(shifts, numSequences, maxRange, knownPhaseIndex, knownPhase, log=True):
-    shiftsToUse = []
-    for n in range(len(shifts)):
-        (i, j, shift, score) = shifts[n]
-        if (j <= i+maxRange):
-            shiftsToUse.append(shifts[n])
+def SolveSparseSystem(i, j, sqrtW, aw, numSequences, knownPhaseIndex, initialGuess=None):
+    # Sparse equivalent of the lstsq solve in SolveForShifts, for the weighted system of equations Mw x = aw.
+    # The last element of sqrtW and aw is for the known phase constraint.
+    # Mw is built directly in CSR form, and solved using LSMR.
+    # The columns are scaled to unit norm first, because sequences that appear in many constraints
+    # (or with very different weights) otherwise make LSMR converge extremely slowly.
+    # For the same reason it is worth providing a good initialGuess where one is available.
+    numShifts = len(i)
+    indices = np.append(np.stack([i, j], axis=1).ravel(), knownPhaseIndex)
+    data = np.append(np.stack([-sqrtW[:-1], sqrtW[:-1]], axis=1).ravel(), sqrtW[-1])
+    indptr = np.append(np.arange(0, 2*numShifts+1, 2), 2*numShifts+1)
+    # Imported here rather than at the top, because scipy.sparse is slow to import and only the offline analysis needs it:
+    # the realtime LTU never uses the sparse solver (see MakeShiftsSelfConsistent)
+    import scipy.sparse, scipy.sparse.linalg
+    Mw = scipy.sparse.csr_matrix((data, indices, indptr), shape=(numShifts+1, numSequences))
+
+    columnNorms = np.sqrt(np.bincount(indices, weights=data**2, minlength=numSequences))
+    unconstrained = (columnNorms == 0)
+    columnNorms[unconstrained] = 1
+    A = Mw @ scipy.sparse.diags(1.0 / columnNorms)
+    if initialGuess is None:
+        y0 = None
+    else:
+        y0 = np.where(unconstrained, 0, initialGuess) * columnNorms
+    result = scipy.sparse.linalg.lsmr(A, aw, atol=1e-14, btol=1e-14, maxiter=10*numSequences+1000, x0=y0)
+    if (result[1] == 7):
+        logger.warning('Warning: sparse shift solution did not converge within %d iterations', result[2])
+    selfConsistentShifts = result[0] / columnNorms
+    r = aw - Mw @ selfConsistentShifts
+    return (selfConsistentShifts, np.array([np.dot(r, r)]))
+
+def AdjacentShiftEstimate(shifts, numSequences, knownPhaseIndex, knownPhase):
+    # Estimate the solution by accumulating the (weighted mean) shift between each pair of adjacent sequences.
+    # If every pair of adjacent sequences has a shift, this is the exact solution when using only adjacent shifts,
+    # so it makes a good initial guess for the iterative solver.
+    shiftArray = ShiftArray(shifts)
+    i = shiftArray[:, 0].astype('int')
+    j = shiftArray[:, 1].astype('int')
+    adjacent = (j == i+1)
+    w = 1.0 / shiftArray[adjacent, 3]
+    totalWeight = np.bincount(j[adjacent], weights=w, minlength=numSequences)
+    totalShift = np.bincount(j[adjacent], weights=w*shiftArray[adjacent, 2], minlength=numSequences)
+    steps = np.where(totalWeight > 0, totalShift / np.where(totalWeight > 0, totalWeight, 1), 0)
+    estimate = np.cumsum(steps)
+    return estimate - estimate[knownPhaseIndex] + knownPhase
+
+def SolveWithMaxRange(shifts, numSequences, maxRange, knownPhaseIndex, knownPhase, log=True, sparse=False, initialGuess=None):
+    shiftTable = shifts if isinstance(shifts, ShiftTable) else ShiftTable(shifts)
+    shiftsToUse = ShiftArray(shiftTable.withMaxRange(maxRange))
     if log:
-        print('Solving using', len(shiftsToUse), 'of', len(shifts), 'constraints (max range', maxRange, ')')
-    return SolveForShifts(shiftsToUse, numSequences, knownPhaseIndex, knownPhase)
+        logger.debug('Solving using %d of %d constraints (max range %d )', len(shiftsToUse), len(shifts), maxRange)
+    return SolveForShifts(shiftsToUse, numSequences, knownPhaseIndex, knownPhase, sparse, initialGuess)
+
+def AdjustShiftArray(shifts, partialShiftSolution, periods, warnUpTo=65536):
+    # Array version of AdjustShiftsToMatchSolution, returning the adjusted shifts as an Nx4 array (see ShiftArray)
+    shiftArray = ShiftArray(shifts)
+    i = shiftArray[:, 0].astype('int')
+    j = shiftArray[:, 1].astype('int')
+    if (np.ndim(periods) > 0) and (len(periods) > 1):
+        period = np.asarray(periods, dtype='float')[i]
+    else:
+        period = np.reshape(periods, -1)[0]
+    adjusted = AdjustedShiftValues(i, j, shiftArray[:, 2], partialShiftSolution, period)
+    excluded = np.isnan(adjusted)
+
+    # Exclude any shifts we aren't sure how to adjust (yet).
+    # Hopefully things may become clearer as we refine our estimated overall solution
+    warn = excluded & (j-i <= warnUpTo)
+    if np.any(warn):
+        expectedWrappedShift = (partialShiftSolution[j[warn]] - partialShiftSolution[i[warn]]) % np.broadcast_to(period, j.shape)[warn]
+        for (e, iw, jw, shift, score) in zip(expectedWrappedShift.tolist(), i[warn].tolist(), j[warn].tolist(), shiftArray[warn, 2].tolist(), shiftArray[warn, 3].tolist()):
+            logger.warning('major discrepancy between approx expected value %s and actual value %s for %s (distance %d score %s )', e, shift, (iw, jw), jw-iw, score)
+
+    adjustedShifts = shiftArray[~excluded].copy()
+    adjustedShifts[:, 2] = adjusted[~excluded]
+    return adjustedShifts
 
 def AdjustShiftsToMatchSolution(shifts, partialShiftSolution, periods, warnUpTo=65536):
     # Now adjust the longer-distance shifts so they match our initial solution
-    adjustedShifts = []
-    singleNumber = isinstance(periods, int)
-    if sys.version_info < (3,0):
-        singleNumber = singleNumber or isinstance(periods, long) # Additional option, but long only exists under python2
-    if singleNumber or len(periods)==1:
-        period = periods
-    for n in range(len(shifts)):
-        (i, j, shift, score) = shifts[n]
-        if type(periods) is list and len(periods)>1:
-            period = periods[i]
-        expectedWrappedShift = (partialShiftSolution[j] - partialShiftSolution[i]) % period
-        periodPart = (partialShiftSolution[j] - partialShiftSolution[i]) - expectedWrappedShift
-        discrepancy = expectedWrappedShift - shift
-        if (abs(discrepancy) < (period / 4.0)):
-            # If discrepancy is small (positive or negative)
-            # then add an appropriate number of periods to make it work
-            adjustedShift = shift + periodPart
-        elif (abs(discrepancy) > (3 * period / 4.0)):
-            # Values look consistent, but cross a phase boundary
-            if (expectedWrappedShift < shift):
-                adjustedShift = shift + (periodPart - period)
-            else:
-                adjustedShift = shift + (periodPart + period)
-        else:
-            if (j-i <= warnUpTo):
-                print ('major discrepancy between approx expected value', expectedWrappedShift, 'and actual value', shift, 'for', (i, j), '(distance', j-i, 'score', score, ')')
-            # Exclude this shift because we aren't sure how to adjust it (yet)
-            # Hopefully things may become clearer as we refine our estimated overall solution
-            adjustedShift = None
-
-        if (adjustedShift is not None):
-            adjustedShifts.append((i, j, adjustedShift, score))
-    return adjustedShifts
+    # periods may be a single number, or a list with one value per sequence
+    return ShiftList(AdjustShiftArray(shifts, partialShiftSolution, periods, warnUpTo))
 
-def MakeShiftsSelfConsistent(shifts, numSequences, period, knownPhaseIndex=0, knownPhase=0, log=True):
+def MakeShiftsSelfConsistent(shifts, numSequences, period, knownPhaseIndex=0, knownPhase=0, log=True, sparse=False):
     # Given a set of what we think are the optimum relative time-shifts between different sequences
     # (both adjacent sequences, and some that are further apart), work out a global self-consistent solution.
     # The longer jumps serve to protect against gradual accumulation of random error in the absolute global phase,
     # which would creep in if we only ever considered the relative shifts of adjacent sequences.
+    # sparse selects the sparse iterative solver (see SolveSparseSystem) rather than dense lstsq.
+    # Offline callers should pass sparse=None, to use it for more than sparseSolverThreshold sequences.
+    # It defaults to False so that the realtime LTU (memoryCC, IncrementalShiftSolver) keeps the dense solver's behaviour.
+    if sparse is None:
+        sparse = (numSequences > sparseSolverThreshold)
+    shiftArray = ShiftArray(shifts)
 
     # First solve just using the shifts between adjacent slices (no phase wrapping)
     # TODO: add a more comprehensive comment here explaining the modulo-2pi issues that make the
     # shift problem a little bit awkward.
-    (adjacentShiftSolution, adjacentResiduals) = SolveWithMaxRange(shifts, numSequences, 1, knownPhaseIndex, knownPhase, log)
+    initialGuess = AdjacentShiftEstimate(shiftArray, numSequences, knownPhaseIndex, knownPhase) if sparse else None
+    (adjacentShiftSolution, adjacentResiduals) = SolveWithMaxRange(shiftArray, numSequences, 1, knownPhaseIndex, knownPhase, log, sparse, initialGuess)
     # Adjust the longer shifts to be consistent with the adjacent shift values
     # Don't warn about long-distance discrepancies, because those are fairly inevitable initially
-    adjacentShifts = AdjustShiftsToMatchSolution(shifts, adjacentShiftSolution, period, warnUpTo=64)
+    adjustedShifts = AdjustShiftArray(shiftArray, adjacentShiftSolution, period, warnUpTo=64)
 
     if log:
-        print('Done first stage')
+        logger.debug('Done first stage')
 
     # Now look for a solution that satisfies longer-range shifts as well.
     # If necessary, we could make a new adjustment of the shifts and repeat.
     # On a subsequent iteration we would have an improved estimate that might help us
     # decide which way to adjust long-range shifts that were initially unclear
-    adjustedShifts = list(adjacentShifts)
+    shiftSolution = adjacentShiftSolution
     for r in [32, 128, 512, 2048]:
-        (shiftSolution, residuals) = SolveWithMaxRange(adjustedShifts, numSequences, r, knownPhaseIndex, knownPhase, log)
-        adjustedShifts = AdjustShiftsToMatchSolution(shifts, shiftSolution, period)
+        (shiftSolution, residuals) = SolveWithMaxRange(adjustedShifts, numSequences, r, knownPhaseIndex, knownPhase, log, sparse, shiftSolution)
+        adjustedShifts = AdjustShiftArray(shiftArray, shiftSolution, period)
+
+    return (shiftSolution, ShiftList(adjustedShifts), adjacentShiftSolution, residuals, adjacentResiduals)
+
+def AdjustedShiftValues(i, j, shift, partialShiftSolution, period):
+    # Vectorized equivalent of the adjustment made in AdjustShiftsToMatchSolution,
+    # for arrays of sequence indices i and j and their measured shifts.
+    # period may be a single number, or an array with one value per shift.
+    # Returns an array of adjusted shifts, with NaN for any shift we aren't sure how to adjust (yet).
+    difference = partialShiftSolution[j] - partialShiftSolution[i]
+    expectedWrappedShift = difference % period
+    periodPart = difference - expectedWrappedShift
+    discrepancy = np.abs(expectedWrappedShift - shift)
+    adjustedShifts = np.full(np.shape(shift), np.nan)
+    # If discrepancy is small (positive or negative) then add an appropriate number of periods to make it work
+    adjustedShifts = np.where(discrepancy < (period / 4.0), shift + periodPart, adjustedShifts)
+    # Values look consistent, but cross a phase boundary
+    crossesBoundary = (discrepancy > (3 * period / 4.0))
+    adjustedShifts = np.where(crossesBoundary & (expectedWrappedShift < shift), shift + (periodPart - period), adjustedShifts)
+    adjustedShifts = np.where(crossesBoundary & (expectedWrappedShift >= shift), shift + (periodPart + period), adjustedShifts)
+    return adjustedShifts
+
+class IncrementalShiftSolver(object):
+    # Incremental version of MakeShiftsSelfConsistent, for the realtime LTU.
+    # There, each call only appends a few new shifts (between the newest sequence and its recent predecessors)
+    # to the shifts from the previous call, but MakeShiftsSelfConsistent starts from scratch every time,
+    # which gets slower and slower as the history grows over a long timelapse.
+    #
+    # Instead, we keep the weighted normal matrix M^T W M between calls, in banded form
+    # (every shift only links sequences that are a short distance apart, so the matrix is banded).
+    # Newly-appended shifts are added to it as rank-one updates. If a shift has to be excluded, we rebuild
+    # the matrix rather than subtracting its contribution, to avoid any accumulation of rounding errors.
+    # The phase-unwrapping passes are warm-started from the previous solution, rather than from
+    # a fresh solution based on adjacent shifts only. Each pass solves for a correction to the current solution
+    # (which keeps the right hand side small and so is well conditioned even when the solution has grown large),
+    # and we stop as soon as the adjusted shifts stop changing and the correction is negligible.
+    # Each call then costs O(numSequences * bandwidth^2), rather than being cubic in the history length.
+    #
+    # We fall back to a full MakeShiftsSelfConsistent if the shifts are not an extension of the ones we saw last time
+    # (e.g. after the history was trimmed or reset - the caller should also call reset() in those cases).
+    # For the shifts used by the LTU (which are all well within the shortest maxRange of MakeShiftsSelfConsistent)
+    # the solution is the same as the full solve, to within numerical precision.
+    maxRange = 2048
+    maxPasses = 8
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Discard all state, so that the next call to solve() does a full solve
+        self.settings = None
+        self.numSequences = 0
+        self.lastShift = None
+        self.i = np.zeros(0, dtype='int')
+        self.j = np.zeros(0, dtype='int')
+        self.shift = np.zeros(0)
+        self.weight = np.zeros(0)
+        # The adjusted value of each shift, as used in the current solution (NaN if excluded)
+        self.applied = np.zeros(0)
+        # Upper banded storage of M^T W M for the shifts that are not excluded (see scipy.linalg.solveh_banded)
+        self.band = np.zeros((1, 0))
+        self.solution = None
+        self.adjacentSolution = None
+
+    def solve(self, shifts, numSequences, period, knownPhaseIndex=0, knownPhase=0, log=True, maxPasses=None):
+        # Same inputs and outputs as MakeShiftsSelfConsistent.
+        # maxPasses limits the number of passes (default: self.maxPasses). With maxPasses=0 the new sequences are just
+        # appended to the previous solution using their adjacent shifts (the warm start), which is almost free;
+        # the new shifts are then taken into account by the next call. A full solve is still done if we can't warm start.
+        if maxPasses is None:
+            maxPasses = self.maxPasses
+        settings = (period, knownPhaseIndex, knownPhase)
+        numSeen = len(self.shift)
+        if ((self.solution is None) or (settings != self.settings) or (numSequences <= self.numSequences)
+                or (len(shifts) < numSeen) or (numSeen > 0 and tuple(shifts[numSeen-1]) != self.lastShift)):
+            return self.fullSolve(shifts, numSequences, period, knownPhaseIndex, knownPhase, log)
+
+        # Extend our arrays to cover the new sequences and shifts
+        newShifts = ShiftArray(shifts[numSeen:])
+        newI = newShifts[:, 0].astype('int')
+        newJ = newShifts[:, 1].astype('int')
+        numNewSequences = numSequences - self.numSequences
+
+        # Warm start: extend the previous solution using the adjacent shift to each new sequence
+        # (which is how the first stage of MakeShiftsSelfConsistent would have estimated it)
+        solution = np.append(self.solution, np.zeros(numNewSequences))
+        adjacentSolution = np.append(self.adjacentSolution, np.zeros(numNewSequences))
+        for n in range(self.numSequences, numSequences):
+            adjacent = np.where((newI == n-1) & (newJ == n))[0]
+            if (len(adjacent) != 1):
+                # We can't warm start without an unambiguous adjacent shift
+                return self.fullSolve(shifts, numSequences, period, knownPhaseIndex, knownPhase, log)
+            solution[n] = solution[n-1] + newShifts[adjacent[0], 2]
+            adjacentSolution[n] = adjacentSolution[n-1] + newShifts[adjacent[0], 2]
+
+        self.i = np.append(self.i, newI)
+        self.j = np.append(self.j, newJ)
+        self.shift = np.append(self.shift, newShifts[:, 2])
+        self.weight = np.append(self.weight, 1.0 / newShifts[:, 3])
+        self.applied = np.append(self.applied, np.full(len(newShifts), np.nan))
+        self.band = np.append(self.band, np.zeros((self.band.shape[0], numNewSequences)), axis=1)
+        self.numSequences = numSequences
+        self.lastShift = tuple(shifts[-1])
+
+        # Imported here rather than at the top, so that it isn't loaded until the first incremental solve
+        # (it is not needed at all unless the LTU is keeping a solver state), which keeps interpreter startup quick
+        import scipy.linalg
+        # Alternate between adjusting shifts to match the current solution and re-solving, until nothing changes
+        p = -1
+        for p in range(maxPasses):
+            adjusted = self.adjustedShifts(solution, period)
+            wasIncluded = ~np.isnan(self.applied)
+            included = ~np.isnan(adjusted)
+            unchanged = np.array_equal(adjusted[included], self.applied[included]) and np.array_equal(included, wasIncluded)
+            if np.any(wasIncluded & ~included):
+                self.buildNormalMatrix(included, knownPhaseIndex)
+            else:
+                self.addToNormalMatrix(included & ~wasIncluded)
+            self.applied = adjusted
+            try:
+                correction = scipy.linalg.solveh_banded(self.band, self.gradient(solution, knownPhaseIndex, knownPhase))
+            except (np.linalg.LinAlgError, ValueError):
+                # e.g. the shifts no longer link every sequence together. lstsq copes better with that.
+                if log:
+                    logger.info('Incremental solve failed - falling back to full solve')
+                return self.fullSolve(shifts, numSequences, period, knownPhaseIndex, knownPhase, log)
+            solution = solution + correction
+            if unchanged and (np.max(np.abs(correction)) < 1e-9 * period):
+                break
+        if log and debugEnabled():
+            # (counting the constraints is a pass over all of them, so is only done if it is going to be logged)
+            logger.debug('Incremental solve using %d of %d constraints ( %d passes )', np.count_nonzero(~np.isnan(self.applied)), len(self.applied), p+1)
+        self.solution = solution
+        self.adjacentSolution = adjacentSolution
+
+        # Report any new shifts we weren't able to use
+        adjusted = self.adjustedShifts(solution, period)
+        for n in np.where(np.isnan(adjusted[numSeen:]))[0] + numSeen:
+            logger.warning('major discrepancy between approx expected value %s and actual value %s for %s (distance %d score %s )', (solution[self.j[n]] - solution[self.i[n]]) % period, self.shift[n], (self.i[n], self.j[n]), self.j[n]-self.i[n], 1.0/self.weight[n])
+        return (solution, self.shiftList(adjusted), adjacentSolution, self.residuals(solution, knownPhaseIndex, knownPhase), np.zeros(0))
+
+    def fullSolve(self, shifts, numSequences, period, knownPhaseIndex, knownPhase, log):
+        # Solve from scratch using MakeShiftsSelfConsistent, and then set up our state to match its final solution
+        result = MakeShiftsSelfConsistent(shifts, numSequences, period, knownPhaseIndex, knownPhase, log)
+        (shiftSolution, adjustedShifts, adjacentShiftSolution, residuals, adjacentResiduals) = result
+        self.reset()
+        self.settings = (period, knownPhaseIndex, knownPhase)
+        self.numSequences = numSequences
+        if (len(shifts) > 0):
+            allShifts = ShiftArray(shifts)
+            self.i = allShifts[:, 0].astype('int')
+            self.j = allShifts[:, 1].astype('int')
+            self.shift = allShifts[:, 2]
+            self.weight = 1.0 / allShifts[:, 3]
+            self.lastShift = tuple(shifts[-1])
+        self.applied = self.adjustedShifts(shiftSolution, period)
+        self.buildNormalMatrix(~np.isnan(self.applied), knownPhaseIndex)
+        self.solution = shiftSolution
+        self.adjacentSolution = adjacentShiftSolution
+        return result
+
+    def adjustedShifts(self, solution, period):
+        adjusted = AdjustedShiftValues(self.i, self.j, self.shift, solution, period)
+        adjusted[self.j > self.i + self.maxRange] = np.nan
+        return adjusted
+
+    def buildNormalMatrix(self, rows, knownPhaseIndex):
+        # Build M^T W M from scratch for the selected shifts (and the known phase)
+        self.band = np.zeros((1, self.numSequences))
+        self.band[0, knownPhaseIndex] = 1
+        self.addToNormalMatrix(rows)
+
+    def addToNormalMatrix(self, rows):
+        # Rank-one updates to M^T W M for each of the selected shifts
+        i = self.i[rows]
+        j = self.j[rows]
+        w = self.weight[rows]
+        if (len(i) > 0) and (np.max(j - i) >= self.band.shape[0]):
+            # Need more superdiagonals in our banded storage
+            extraRows = np.max(j - i) - self.band.shape[0] + 1
+            self.band = np.append(np.zeros((extraRows, self.band.shape[1])), self.band, axis=0)
+        u = self.band.shape[0] - 1
+        np.add.at(self.band, (u, i), w)
+        np.add.at(self.band, (u, j), w)
+        np.add.at(self.band, (u - (j - i), j), -w)
+
+    def gradient(self, solution, knownPhaseIndex, knownPhase):
+        # M^T W r, where r are the residuals of the current solution (for the shifts that are not excluded)
+        use = ~np.isnan(self.applied)
+        wr = self.weight[use] * (self.applied[use] - (solution[self.j[use]] - solution[self.i[use]]))
+        g = np.zeros(self.numSequences)
+        np.add.at(g, self.i[use], -wr)
+        np.add.at(g, self.j[use], wr)
+        g[knownPhaseIndex] += knownPhase - solution[knownPhaseIndex]
+        return g
+
+    def shiftList(self, adjusted):
+        # Adjusted shifts in the same list-of-tuples form as returned by AdjustShiftsToMatchSolution
+        use = ~np.isnan(adjusted)
+        return list(zip(self.i[use].tolist(), self.j[use].tolist(), adjusted[use].tolist(), (1.0 / self.weight[use]).tolist()))
 
-    return (shiftSolution, adjustedShifts, adjacentShiftSolution, residuals, adjacentResiduals)
+    def residuals(self, solution, knownPhaseIndex, knownPhase):
+        # Weighted sum of squared residuals, as lstsq would report it
+        use = ~np.isnan(self.applied)
+        r = solution[self.j[use]] - solution[self.i[use]] - self.applied[use]
+        return np.array([np.sum(self.weight[use] * r**2) + (solution[knownPhaseIndex] - knownPhase)**2])
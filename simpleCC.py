@@ -3,8 +3,17 @@ This module includes all necessary functions.'''
 
 # Python Imports
 import numpy as np
-from scipy.interpolate import interpn
-
+# Local Imports
+import scoring_kernel as sk
+import resampling
+from ltu_log import logger
+
+# Settings for the coarse-to-fine (pyramid) search in crossCorrelationRolling:
+# the coarse level is binned by pyramidBinFactor in X and Y and by pyramidTimeFactor in time,
+# and then shifts within pyramidRefineRadius of its best shift are scored at full resolution
+pyramidBinFactor = 2
+pyramidTimeFactor = 2
+pyramidRefineRadius = 2
 
 def threePointTriangularMinimum(y1, y2, y3):
     # Fit an even V to three points at x=-1, x=0 and x=+1
@@ -20,16 +29,99 @@ def threePointTriangularMinimum(y1, y2, y3):
 def crossCorrelationScores(seq1,
                            seq2):
     '''Calculates cross correlation scores for two numpy arrays of order TXY'''
-    # Calculate cross-correlation from JT codes
-    temp = np.conj(np.fft.fft(seq1, axis=0)) * np.fft.fft(seq2, axis=0)
-    temp2 = np.fft.ifft(temp, axis=0)
+    # Calculate cross-correlation from JT codes (now shared with the offline code in scoring_kernel)
+    return sk.shiftScores(seq1, seq2)
+
+
+def pyramidScores(seq1,
+                  seq2,
+                  binFactor=None,
+                  timeFactor=None,
+                  refineRadius=None):
+    '''Coarse-to-fine equivalent of crossCorrelationScores, for two numpy arrays of order TXY.
+    All shifts are scored on a spatially and temporally binned copy of the sequences, and then only the shifts around the best of those
+    are scored at full resolution. Shifts that were not scored at full resolution are given a score of infinity.
+    The window is extended if necessary, so that the minimum always has both its neighbours scored (which minimumScores needs for its V-fit).'''
+    binFactor = pyramidBinFactor if binFactor is None else binFactor
+    timeFactor = pyramidTimeFactor if timeFactor is None else timeFactor
+    refineRadius = pyramidRefineRadius if refineRadius is None else refineRadius
+    numSamples = len(seq1)
+    if min(np.shape(seq1)[1:]) < binFactor:
+        binFactor = 1
+    if numSamples % timeFactor != 0:
+        # Shifts of the binned sequences must correspond to whole shifts of the full ones
+        timeFactor = 1
+
+    # Coarse level: bin both sequences (summing in time as well as space), and score every shift between them
+    coarse1 = sk.binSpatially(seq1, binFactor)
+    coarse2 = sk.binSpatially(seq2, binFactor)
+    coarseShape = (numSamples // timeFactor, timeFactor) + coarse1.shape[1:]
+    coarseScores = crossCorrelationScores(coarse1.reshape(coarseShape).sum(axis=1), coarse2.reshape(coarseShape).sum(axis=1))
+    centre = np.argmin(coarseScores) * timeFactor
+
+    # Fine level: score the shifts around the coarse minimum directly, moving the window on until the minimum is inside it
+    scores = windowScores(seq1, seq2, centre, refineRadius)
+    while not minimumInsideWindow(scores):
+        scores = windowScores(seq1, seq2, np.argmin(scores), refineRadius, scores)
+    return scores
 
-    scores = np.sum(seq1*seq1) + np.sum(seq2*seq2) - 2 * np.sum(np.real(temp2),
-                                                                axis=1)
 
+def windowScores(seq1,
+                 seq2,
+                 centre,
+                 radius,
+                 scores=None):
+    '''Scores (as from crossCorrelationScores) for just the shifts within radius of centre, scored directly (see scoring_kernel.windowedScores).
+    They are filled in to scores, which is returned. If scores is None, a new array is used, in which every other shift has a score of infinity.
+    Shifts that already have a score are not rescored.'''
+    numSamples = len(seq1)
+    if scores is None:
+        scores = np.full(numSamples, np.inf)
+    window = sorted(set((int(centre) + d) % numSamples for d in range(-radius, radius+1)))
+    window = [k for k in window if scores[k] == np.inf]
+    scores[window] = sk.windowedScores(seq1, seq2, window)
     return scores
 
 
+def minimumInsideWindow(scores):
+    '''Whether both neighbours of the minimum in scores (from windowScores) have been scored,
+    so it is a genuine local minimum and minimumScores can V-fit it.'''
+    minPos = np.argmin(scores)
+    return (scores[minPos-1] < np.inf) and (scores[(minPos+1) % len(scores)] < np.inf)
+
+
+def spectralTerms(seq,
+                  period,
+                  numSamplesPerPeriod=80):
+    '''Temporal FFT and per-pixel energy for a numpy array of order TXY.
+    These are the only terms crossCorrelationScores needs from each sequence,
+    so they can be cached for a sequence that will be compared more than once.
+    The sequence is resampled exactly as it would be by crossCorrelationRolling.'''
+    return sk.spectralTerms(scoringSequence(seq, period, numSamplesPerPeriod))
+
+
+def scoringSequence(seq,
+                    period,
+                    numSamplesPerPeriod=80):
+    '''A numpy array of order TXY, resampled exactly as it would be by crossCorrelationRolling before it is scored.'''
+    if period != numSamplesPerPeriod:
+        seq = resampleImageSection(seq, period, numSamplesPerPeriod)
+    return seq[:numSamplesPerPeriod]
+
+
+def spectralEnergy(fft, numSamplesPerPeriod=80):
+    '''The energy term that spectralTerms would return alongside fft (which may have been cropped or binned in XY).
+    numSamplesPerPeriod must match the value that was passed to spectralTerms.'''
+    return sk.energyFromSpectrum(fft, numSamplesPerPeriod)
+
+
+def crossCorrelationScoresFromSpectra(fft1, energy1, fft2, energy2, numSamplesPerPeriod=80):
+    '''Equivalent to crossCorrelationScores, given the spectralTerms of each sequence.
+    numSamplesPerPeriod must match the value that was passed to spectralTerms.
+    The arrays may have been cropped in XY, provided both are cropped consistently.'''
+    return sk.scoresFromSpectra(fft1, energy1, fft2, energy2, numSamplesPerPeriod)
+
+
 def minimumScores(scores,
                   useV=True):
     '''Calculates the minimum position and value in a list of scores.
@@ -54,6 +146,8 @@ def minimumScores(scores,
 def matchSequenceSlicing(seq1,
                          seq2):
     '''Take two sequences and resample them to match the longer sequence.'''
+    # Only imported when needed, since the realtime LTU doesn't use this and scipy.interpolate is slow to import
+    from scipy.interpolate import interpn
     newLength = max(len(seq1), len(seq2))
 
     x = np.arange(0.0, seq1.shape[1])
@@ -76,21 +170,19 @@ def matchSequenceSlicing(seq1,
 
 def resampleImageSection(seq1,
                          thisPeriod,
-                         newLength):
-    '''Modified version of j_postacquisition.periods.ResampleImageSection'''
-
-    result = np.zeros([newLength, seq1.shape[1], seq1.shape[2]], 'float')
-    for i in range(newLength):
-        desiredPos = (i / float(newLength)) * thisPeriod
-        beforePos = int(desiredPos)
-        afterPos = beforePos + 1
-        remainder = (desiredPos - beforePos) / float(afterPos - beforePos)
-
-        before = seq1[beforePos]
-        after = seq1[int(afterPos % thisPeriod)]
-        result[i] = before * (1 - remainder) + after * remainder
-
-    return result
+                         newLength,
+                         dtype='float'):
+    '''Modified version of j_postacquisition.periods.ResampleImageSection
+    seq1 may be an array of order TXY, or any sequence of 2D frames (e.g. a list) - it is never copied.
+    The result is a new array of order TXY, of type dtype.'''
+    # Note that the frame after the end of the period wraps round to the start of the period
+    # (rather than to the start of seq1, as in periods.ResampleImageSection)
+    beforeIndex, afterIndex, remainder = resampling.resamplingPositions(thisPeriod,
+                                                                        newLength,
+                                                                        newLength,
+                                                                        thisPeriod)
+    result = np.empty((newLength,) + np.shape(seq1[0]), dtype=dtype)
+    return resampling.blendFrames(seq1, beforeIndex, afterIndex, remainder, out=result)
 
 
 def crossCorrelationRolling(seq1,
@@ -100,8 +192,10 @@ def crossCorrelationRolling(seq1,
                             useV=True,
                             log=False,
                             numSamplesPerPeriod=80,
-                            target=0):
-    '''Phase matching two sequences based on cross-correlation.'''
+                            target=0,
+                            pyramid=False):
+    '''Phase matching two sequences based on cross-correlation.
+    If pyramid is True, the shifts are found by a coarse-to-fine search (see pyramidScores) rather than by scoring them all at full resolution.'''
     if log == 'toy':
         # Outputs for toy examples
         strout1 = []
@@ -132,13 +226,25 @@ def crossCorrelationRolling(seq1,
         print('Resliced sequence #1:\t{0}'.format(strout1))
         print('Resliced sequence #2:\t{0}'.format(strout2))
 
-    seq1 = makeArrayFromSequence(seq1[:numSamplesPerPeriod])
-    seq2 = makeArrayFromSequence(seq2[:numSamplesPerPeriod])
-    scores = crossCorrelationScores(seq1, seq2)
-    print(f"crossCorrelationRolling: scores {scores}. Original lengths {origLen1} and {origLen2}")
+    if pyramid:
+        scores = pyramidScores(seq1[:numSamplesPerPeriod], seq2[:numSamplesPerPeriod])
+    else:
+        scores = crossCorrelationScores(seq1[:numSamplesPerPeriod], seq2[:numSamplesPerPeriod])
+    return alignmentFromScores(scores, origLen1, origLen2, useV, log, target)
+
+
+def alignmentFromScores(scores,
+                        origLen1,
+                        origLen2,
+                        useV=True,
+                        log=False,
+                        target=0):
+    '''Converts cross-correlation scores into the alignment returned by crossCorrelationRolling.
+    origLen1 and origLen2 are the lengths of the sequences before any resampling.'''
+    logger.debug('crossCorrelationRolling: scores %s. Original lengths %s and %s', scores, origLen1, origLen2)
     _, minValNoFit = minimumScores(scores, False)
     rollFactor, minVal = minimumScores(scores, useV)
-    rollFactor = (rollFactor/len(seq1))*origLen2
+    rollFactor = (rollFactor/len(scores))*origLen2
 
     alignment1 = (np.arange(0, origLen1)-rollFactor) % origLen1
     alignment2 = np.arange(0, origLen2)
@@ -154,13 +260,13 @@ def crossCorrelationRolling(seq1,
         # However FP rounding errors may make it negative - which causes havoc.
         # In this scenario, limit it to a small positive number
         # (we don't want exactly zero either, as that would cause problems with our 1/score weightings)
-        print(f'Suspicious negative value {minValNoFit}. Clipping this to small positive')
+        logger.warning('Suspicious negative value %s. Clipping this to small positive', minValNoFit)
         minValNoFit = 1e-5
     if minVal < 0.02*minValNoFit:
         # This is probably only an issue for synthetic or bloodless datasets but I have seen the score go negative,
         # which is catastrophic for the weighted least-squares fitting used in the LTU,
         # since 1/sqrt(minVal) is computed as part of our weighting!
-        print(f'Uncannily good fit {minVal}. Applying floor as a fraction of {minValNoFit} to make sure it does not get tiny or negative')
+        logger.warning('Uncannily good fit %s. Applying floor as a fraction of %s to make sure it does not get tiny or negative', minVal, minValNoFit)
         minVal = 0.02*minValNoFit
     # convert to list for consistency with cjn-sequence-alignment.nCascadingNW
     return (list(alignment1),
@@ -169,13 +275,6 @@ def crossCorrelationRolling(seq1,
             minVal)
 
 
-def makeArrayFromSequence(seq):
-    '''Utility function used as part of the FFT processing.'''
-    result = np.zeros((len(seq), seq.shape[1]*seq.shape[2]))
-    for i in range(len(seq)):
-        result[i] = np.array(seq[i], copy=False).flatten()
-    return result
-
 
 if __name__ == '__main__':
     print('Running toy example with')
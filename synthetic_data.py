@@ -0,0 +1,258 @@
+'''Synthetic beating-heart datasets, for benchmarking at a realistic scale without needing real fish data.
+
+The scene is a textured background with a two-chamber heart in the middle of it: the atrium and ventricle
+are blobs that swell and contract over each heart beat (the ventricle lagging the atrium), with blood that is
+darker than the surrounding tissue in brightfield. The heart period can drift slowly and jitter from beat to beat,
+and the whole scene can drift laterally (as the fish settles in the agarose). In the brightfield channel
+the fluorescence excitation laser can leak through as occasional flashes, which brighten the whole frame.
+The fluorescence channel sees the heart wall glowing, at a lower frame rate than the brightfield.
+
+The true phase of every frame is known, so the results of the period estimation, shifts, global solver and annotation
+can be checked against it. WriteSyntheticDataset writes a dataset to disk as multi-page tiffs with matching plists,
+in any of the metadata versions understood by image_loading.LoadImageFile, along with the ground truth:
+    python synthetic_data.py /tmp/synthetic --frames 2000 --size 256 256 --period 35 --metadata-version 3
+will create /tmp/synthetic/brightfield, /tmp/synthetic/fluorescence and /tmp/synthetic/ground_truth.npz'''
+
+# Python Imports
+import os
+import json
+import argparse
+import numpy as np
+# Module Imports
+import tifffile
+# Local Imports
+import plist_wrapper as jPlist
+
+
+def HeartPhases(numFrames, period, periodDrift=0.0, periodJitter=0.0, rng=None):
+    # True heart phase (in radians, wrapped to [0, 2pi)) of each of numFrames frames, along with the period (in frames) at each frame.
+    # periodDrift: fractional change in the period over the whole sequence (e.g. 0.1 for a heart that slows down by 10%)
+    # periodJitter: standard deviation of the beat-to-beat variation in the period, as a fraction of the period
+    if rng is None:
+        rng = np.random.default_rng()
+    periods = period * (1 + periodDrift * np.arange(numFrames) / max(numFrames - 1, 1))
+    if periodJitter > 0:
+        # A new random deviation for each beat, interpolated between beats so that the period changes smoothly
+        numBeats = int(np.ceil(numFrames / np.min(periods))) + 2
+        beatDeviations = rng.normal(0, periodJitter, numBeats)
+        beatIndex = np.cumsum(1.0 / periods)
+        periods = periods * (1 + np.interp(beatIndex, np.arange(numBeats), beatDeviations))
+    phases = 2 * np.pi * np.cumsum(1.0 / periods) + rng.uniform(0, 2 * np.pi)
+    return (phases % (2 * np.pi), periods)
+
+
+def LateralDrift(numFrames, driftPerFrame=(0.0, 0.0), wander=0.0, rng=None):
+    # Lateral position (x,y, in pixels) of the scene in each of numFrames frames:
+    # a steady drift of driftPerFrame, plus a random walk with a step of standard deviation wander
+    if rng is None:
+        rng = np.random.default_rng()
+    drift = np.arange(numFrames)[:, np.newaxis] * np.asarray(driftPerFrame, dtype='float')[np.newaxis, :]
+    if wander > 0:
+        drift = drift + np.cumsum(rng.normal(0, wander, (numFrames, 2)), axis=0)
+    return drift
+
+
+def LaserFlashes(numFrames, flashEvery=None, flashBrightness=0.5, rng=None):
+    # Fractional brightening of each of numFrames brightfield frames due to the fluorescence laser leaking through:
+    # on average one flash every flashEvery frames (at random), or none if flashEvery is None
+    if rng is None:
+        rng = np.random.default_rng()
+    flashes = np.zeros(numFrames)
+    if flashEvery is not None:
+        flashing = rng.random(numFrames) < 1.0 / flashEvery
+        flashes[flashing] = flashBrightness * rng.uniform(0.5, 1.0, np.count_nonzero(flashing))
+    return flashes
+
+
+class SceneModel(object):
+    # The (fixed) appearance of the synthetic fish, which RenderFrames draws at a given phase and lateral position
+
+    def __init__(self, shape, rng=None, numTextureWaves=12):
+        if rng is None:
+            rng = np.random.default_rng()
+        self.shape = tuple(shape)
+        scale = min(shape) / 256.0
+        # Background texture: a sum of random plane waves, so it can be drawn at any sub-pixel offset
+        self.textureK = rng.normal(0, 0.08 / max(scale, 1e-3), (numTextureWaves, 2))
+        self.textureAmplitude = rng.uniform(4, 12, numTextureWaves)
+        self.texturePhase = rng.uniform(0, 2 * np.pi, numTextureWaves)
+        # Chambers: centre (x,y) relative to the middle of the frame, radii at rest (x,y), and phase lag
+        self.chambers = [{'centre': (-30 * scale, -10 * scale), 'radii': (22 * scale, 16 * scale), 'lag': 0.0},
+                         {'centre': (25 * scale, 12 * scale), 'radii': (26 * scale, 20 * scale), 'lag': 2.2}]
+
+    def chamberProfiles(self, phase, drift, yy, xx):
+        # For each chamber, the (blob, wall) intensity profiles at this phase, on the grid yy, xx
+        profiles = []
+        for chamber in self.chambers:
+            # Contraction is sharper than relaxation, as in a real heart
+            contraction = 0.5 * (1 + np.cos(phase - chamber['lag'])) ** 2 / 2
+            size = 1.0 - 0.35 * contraction
+            cx = self.shape[1] / 2 + chamber['centre'][0] + drift[0]
+            cy = self.shape[0] / 2 + chamber['centre'][1] + drift[1]
+            r2 = ((xx - cx) / (chamber['radii'][0] * size)) ** 2 + ((yy - cy) / (chamber['radii'][1] * size)) ** 2
+            blob = np.exp(-r2 ** 2)
+            wall = np.exp(-((np.sqrt(r2) - 1.0) / 0.15) ** 2)
+            profiles.append((blob, wall))
+        return profiles
+
+    def background(self, drift, yy, xx):
+        # Each wave is separable (sin(a+b) = sin(a)cos(b) + cos(a)sin(b)), so we only need to evaluate it along one row and one column
+        x = xx[0] - drift[0]
+        y = yy[:, 0] - drift[1]
+        a = self.textureK[:, 0:1] * x[np.newaxis, :] + self.texturePhase[:, np.newaxis]
+        b = self.textureK[:, 1:2] * y[np.newaxis, :]
+        amplitude = self.textureAmplitude[:, np.newaxis]
+        return (np.cos(b) * amplitude).T @ np.sin(a) + (np.sin(b) * amplitude).T @ np.cos(a)
+
+    def brightfield(self, phase, drift, yy, xx):
+        # Brightfield intensity (before noise and flashes): light background, dark blood, darker walls
+        frame = 140 + self.background(drift, yy, xx)
+        for (blob, wall) in self.chamberProfiles(phase, drift, yy, xx):
+            frame -= 45 * blob + 30 * wall
+        return frame
+
+    def fluorescence(self, phase, drift, yy, xx):
+        # Fluorescence intensity (before noise): the heart walls glow on a dark background
+        frame = np.full(self.shape, 10.0)
+        for (blob, wall) in self.chamberProfiles(phase, drift, yy, xx):
+            frame += 120 * wall + 10 * blob
+        return frame
+
+
+def RenderFrames(scene, channel, phases, drifts, flashes=None, noise=3.0, dtype='uint8', rng=None):
+    # Render frames (of order TXY) of channel ('brightfield' or 'fluorescence') at the given phases and lateral drifts,
+    # with Gaussian noise of standard deviation noise, and brightened by the given fractional laser flashes
+    if rng is None:
+        rng = np.random.default_rng()
+    (yy, xx) = np.mgrid[0:scene.shape[0], 0:scene.shape[1]].astype('float')
+    render = getattr(scene, channel)
+    maxValue = np.iinfo(dtype).max
+    # Scale 8-bit intensities up for 16-bit cameras
+    gain = maxValue / 255.0
+    frames = np.empty((len(phases),) + scene.shape, dtype=dtype)
+    for n in range(len(phases)):
+        frame = render(phases[n], drifts[n], yy, xx)
+        if (flashes is not None) and (flashes[n] > 0):
+            frame = frame * (1 + flashes[n])
+        frame = gain * (frame + rng.normal(0, noise, scene.shape))
+        frames[n] = np.clip(frame, 0, maxValue)
+    return frames
+
+
+def SyntheticSequence(numFrames, shape=(256, 256), period=35.0, periodDrift=0.0, periodJitter=0.0, driftPerFrame=(0.0, 0.0),
+                      wander=0.0, flashEvery=None, channel='brightfield', noise=3.0, dtype='uint8', seed=0):
+    # An in-memory synthetic sequence, for benchmarks that don't need files on disk.
+    # Returns (frames, phases, periods, drifts), where frames is of order TXY and the others give the truth for each frame.
+    rng = np.random.default_rng(seed)
+    scene = SceneModel(shape, rng)
+    (phases, periods) = HeartPhases(numFrames, period, periodDrift, periodJitter, rng)
+    drifts = LateralDrift(numFrames, driftPerFrame, wander, rng)
+    flashes = LaserFlashes(numFrames, flashEvery, rng=rng) if channel == 'brightfield' else None
+    frames = RenderFrames(scene, channel, phases, drifts, flashes, noise, dtype, rng)
+    return (frames, phases, periods, drifts)
+
+
+def WriteImageFile(imagePath, frames, framesMetadata, globalMetadata, metadataVersion):
+    # Write frames as a (multi-page) tiff at imagePath, with a plist alongside it in the given metadata version
+    # (see image_loading.LoadImageFile):
+    # * version 1: a single frame per file, with all the metadata at the root level
+    # * version 2: metadata for each frame in 'frames', with the global metadata repeated in each of them
+    # * version 3: metadata for each frame in 'frames', with the global metadata once at the root level
+    plistPath = os.path.splitext(imagePath)[0] + '.plist'
+    if metadataVersion == 1:
+        assert(len(frames) == 1)
+        pl = dict(globalMetadata)
+        pl.update(framesMetadata[0])
+    elif metadataVersion == 2:
+        pl = {'metadata_version': 2, 'frames': [dict(globalMetadata, **frameMetadata) for frameMetadata in framesMetadata]}
+    else:
+        assert(metadataVersion == 3)
+        pl = dict(globalMetadata)
+        pl.update({'metadata_version': 3, 'frames': list(framesMetadata)})
+    tifffile.imwrite(imagePath, frames[0] if metadataVersion == 1 else frames)
+    jPlist.writePlist(pl, plistPath)
+
+
+def WriteChannel(path, scene, channel, frameIndices, phases, drifts, times, flashes, metadataVersion, framesPerFile, noise, dtype, rng):
+    # Render and write the frames of one channel, a file at a time (so the whole dataset is never held in memory).
+    # Files are named after the index of their first frame, as image_saving.SaveImagesToFolder does.
+    os.makedirs(path, exist_ok=True)
+    if metadataVersion == 1:
+        framesPerFile = 1
+    globalMetadata = {'binning_code': 0, 'channel': channel, 'synthetic': True}
+    for start in range(0, len(frameIndices), framesPerFile):
+        batch = np.arange(start, min(start + framesPerFile, len(frameIndices)))
+        frames = RenderFrames(scene, channel, phases[batch], drifts[batch],
+                              None if flashes is None else flashes[batch], noise, dtype, rng)
+        framesMetadata = []
+        for n in batch:
+            # (plistlib only accepts native python types)
+            t = float(times[n])
+            framesMetadata.append({'frame_number': int(frameIndices[n]),
+                                   'time_processing_started': t,
+                                   'time_received': t,
+                                   'time_exposed': t,
+                                   'stage_positions': {'last_known_z': 0.0, 'last_known_z_time': t}})
+        WriteImageFile('{0}/{1:06d}.tif'.format(path, start), frames, framesMetadata, globalMetadata, metadataVersion)
+
+
+def WriteSyntheticDataset(path, numFrames=2000, shape=(256, 256), framerate=80.0, period=35.0, periodDrift=0.0, periodJitter=0.0,
+                          driftPerFrame=(0.0, 0.0), wander=0.0, flashEvery=None, fluorescenceEvery=10, metadataVersion=3,
+                          framesPerFile=100, noise=3.0, dtype='uint8', seed=0):
+    # Write a synthetic dataset to path:
+    # * brightfield: numFrames frames at framerate (per second), with period given in brightfield frames
+    # * fluorescence: one frame every fluorescenceEvery brightfield frames (none if fluorescenceEvery is None)
+    # * ground_truth.npz: the true phase, period, lateral drift, laser flash and timestamp of every brightfield frame,
+    #   and the true phase and timestamp of every fluorescence frame
+    # The brightfield and fluorescence frames have timestamps (time_processing_started, time_exposed etc) on the same clock,
+    # so the fluorescence can be annotated from the brightfield as for real data (see annotation.AnnotateFluorChannel).
+    rng = np.random.default_rng(seed)
+    scene = SceneModel(shape, rng)
+    (phases, periods) = HeartPhases(numFrames, period, periodDrift, periodJitter, rng)
+    drifts = LateralDrift(numFrames, driftPerFrame, wander, rng)
+    flashes = LaserFlashes(numFrames, flashEvery, rng=rng)
+    times = np.arange(numFrames) / float(framerate)
+    frameIndices = np.arange(numFrames)
+    WriteChannel(path + '/brightfield', scene, 'brightfield', frameIndices, phases, drifts, times, flashes,
+                 metadataVersion, framesPerFile, noise, dtype, rng)
+
+    fluorIndices = np.arange(0, numFrames, fluorescenceEvery) if fluorescenceEvery is not None else np.arange(0)
+    if len(fluorIndices) > 0:
+        WriteChannel(path + '/fluorescence', scene, 'fluorescence', np.arange(len(fluorIndices)), phases[fluorIndices], drifts[fluorIndices],
+                     times[fluorIndices], None, metadataVersion, framesPerFile, noise, dtype, rng)
+
+    np.savez(path + '/ground_truth.npz', phases=phases, periods=periods, drifts=drifts, flashes=flashes, times=times,
+             fluorescencePhases=phases[fluorIndices], fluorescenceTimes=times[fluorIndices])
+    settings = {'numFrames': numFrames, 'shape': list(shape), 'framerate': framerate, 'period': period, 'periodDrift': periodDrift,
+                'periodJitter': periodJitter, 'driftPerFrame': list(driftPerFrame), 'wander': wander, 'flashEvery': flashEvery,
+                'fluorescenceEvery': fluorescenceEvery, 'metadataVersion': metadataVersion, 'framesPerFile': framesPerFile,
+                'noise': noise, 'dtype': dtype, 'seed': seed}
+    with open(path + '/settings.json', 'w') as f:
+        json.dump(settings, f, indent=2)
+    return settings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic beating-heart dataset (brightfield and fluorescence tiffs with plists, plus the ground truth)')
+    parser.add_argument('path', help='directory to write the dataset to')
+    parser.add_argument('--frames', type=int, default=2000, help='number of brightfield frames')
+    parser.add_argument('--size', type=int, nargs=2, default=[256, 256], metavar=('HEIGHT', 'WIDTH'), help='frame size in pixels')
+    parser.add_argument('--framerate', type=float, default=80.0, help='brightfield frames per second')
+    parser.add_argument('--period', type=float, default=35.0, help='heart period, in brightfield frames')
+    parser.add_argument('--period-drift', type=float, default=0.0, help='fractional change in the period over the dataset')
+    parser.add_argument('--period-jitter', type=float, default=0.0, help='beat-to-beat variation in the period, as a fraction of it')
+    parser.add_argument('--drift', type=float, nargs=2, default=[0.0, 0.0], metavar=('X', 'Y'), help='lateral drift, in pixels per frame')
+    parser.add_argument('--wander', type=float, default=0.0, help='random lateral wander, in pixels per frame')
+    parser.add_argument('--flash-every', type=float, default=None, help='average number of brightfield frames between laser flashes (default: no flashes)')
+    parser.add_argument('--fluorescence-every', type=int, default=10, help='brightfield frames per fluorescence frame (0 for no fluorescence)')
+    parser.add_argument('--metadata-version', type=int, default=3, choices=[1, 2, 3], help='plist metadata version')
+    parser.add_argument('--frames-per-file', type=int, default=100, help='frames per tiff (always 1 for metadata version 1)')
+    parser.add_argument('--noise', type=float, default=3.0, help='standard deviation of the camera noise (in 8-bit grey levels)')
+    parser.add_argument('--dtype', default='uint8', choices=['uint8', 'uint16'], help='pixel type')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    WriteSyntheticDataset(args.path, args.frames, tuple(args.size), args.framerate, args.period, args.period_drift, args.period_jitter,
+                          tuple(args.drift), args.wander, args.flash_every, args.fluorescence_every or None, args.metadata_version,
+                          args.frames_per_file, args.noise, args.dtype, args.seed)
+    print('Wrote {0} brightfield frames to {1}'.format(args.frames, args.path))
@@ -0,0 +1,29 @@
+'''Shared set-up for the tests. The modules live at the top of the repository rather than in a package,
+so we make them importable from there, and provide synthetic reference frames (see synthetic_data) to run through the LTU.'''
+
+# Python Imports
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def SyntheticUpdates(numUpdates, shape=(48, 48), period=30.0, seed=0):
+    # (frames, period, drift) for numUpdates reference frame sets of a single fish, drifting by up to a pixel per update
+    import synthetic_data
+    rng = np.random.default_rng(seed)
+    scene = synthetic_data.SceneModel(shape, rng)
+    (updates, cumulativeDrift) = ([], np.zeros(2))
+    for n in range(numUpdates):
+        drift = [int(d) for d in rng.integers(-1, 2, 2)]
+        cumulativeDrift += drift
+        (phases, _) = synthetic_data.HeartPhases(int(period) + 4, period, rng=rng)
+        updates.append((synthetic_data.RenderFrames(scene, 'brightfield', phases, [cumulativeDrift] * len(phases), rng=rng), period, drift))
+    return updates
+
+
+@pytest.fixture(scope='session')
+def syntheticUpdates():
+    return SyntheticUpdates(12)
@@ -0,0 +1,10 @@
+# Local Imports
+import memoryCC
+
+
+def test_trim_under_memory_budget():
+    memoryCC.checkTrimUnderMemoryBudget()
+
+
+def test_embedding_against_pixels():
+    memoryCC.checkEmbeddingAgainstPixels()
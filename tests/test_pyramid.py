@@ -0,0 +1,38 @@
+# Python Imports
+import numpy as np
+# Local Imports
+import simpleCC as scc
+import synthetic_data
+
+
+def scoringPairs(numPairs, numSamples=80, shape=(48, 48), seed=0):
+    # Pairs of sequences of numSamples frames spanning one heart period, as the scoring compares them,
+    # starting at random phases and drifted by up to a pixel relative to each other
+    rng = np.random.default_rng(seed)
+    scene = synthetic_data.SceneModel(shape, rng)
+    def sequence(drift):
+        phases = (rng.uniform(0, 2 * np.pi) + 2 * np.pi * np.arange(numSamples) / numSamples) % (2 * np.pi)
+        return synthetic_data.RenderFrames(scene, 'brightfield', phases, [drift] * numSamples, rng=rng).astype('float')
+    return [(sequence((0, 0)), sequence(rng.integers(-1, 2, 2))) for n in range(numPairs)]
+
+
+def test_pyramid_finds_the_same_shift_as_exhaustive_search():
+    for (seq1, seq2) in scoringPairs(30):
+        exhaustive = scc.crossCorrelationScores(seq1, seq2)
+        pyramid = scc.pyramidScores(seq1, seq2)
+        assert np.argmin(pyramid) == np.argmin(exhaustive)
+        # The shifts it does score are scored exactly, so the V-fitted minimum is the same too
+        scored = np.isfinite(pyramid)
+        assert np.allclose(pyramid[scored], exhaustive[scored], rtol=1e-6)
+        assert np.allclose(scc.minimumScores(pyramid), scc.minimumScores(exhaustive))
+
+
+def test_pyramid_window_contains_the_minimum():
+    # However far off the coarse level is, the window is moved on until the minimum has both neighbours scored
+    (seq1, seq2) = scoringPairs(1, seed=1)[0]
+    exhaustive = scc.crossCorrelationScores(seq1, seq2)
+    wrongCentre = (np.argmin(exhaustive) + 10) % len(exhaustive)
+    scores = scc.windowScores(seq1, seq2, wrongCentre, 2)
+    while not scc.minimumInsideWindow(scores):
+        scores = scc.windowScores(seq1, seq2, np.argmin(scores), 2, scores)
+    assert np.argmin(scores) == np.argmin(exhaustive)
@@ -0,0 +1,40 @@
+# Python Imports
+import io
+import contextlib
+import numpy as np
+# Local Imports
+import ltu_replay
+import ltu_worker
+import replay_ltu
+import synthetic_data
+
+
+def test_replay_reproduces_the_recorded_solutions(tmp_path):
+    rng = np.random.default_rng(0)
+    scenes = [synthetic_data.SceneModel((40, 40), rng) for fishIndex in range(2)]
+    calls = ltu_worker.syntheticCalls(scenes, 10, rng)
+    wrapper = ltu_worker.loadWrapper()
+    wrapper.setLTUReplayDirectory(str(tmp_path))
+    with contextlib.redirect_stdout(io.StringIO()):
+        for fishIndex in range(len(scenes)):
+            wrapper.resetRefFrameHistory(fishIndex)
+        solutions = [wrapper.processNewReferenceSequence(*call) for call in calls]
+    wrapper.setLTUReplayDirectory(None)
+
+    capture = ltu_replay.ReplayCapture(str(tmp_path))
+    recorded = [call for call in capture.calls if call['call'] == 'processNewReferenceSequence']
+    assert len(recorded) == len(calls)
+    assert np.allclose([call['result'] for call in recorded], solutions)
+
+    # A fresh copy of the wrapper, fed the same calls, must come up with the same solutions
+    results = replay_ltu.ReplaySession(capture, ltu_worker.loadWrapper())
+    assert results['mismatches'] == []
+    assert len(results['differences']) == len(calls)
+    assert sorted(results['footprints']) == [0, 1]
+
+
+def test_solution_difference():
+    assert replay_ltu.SolutionDifference(None, None) == 0.0
+    assert replay_ltu.SolutionDifference(None, 1.5) is None
+    assert replay_ltu.SolutionDifference(1.5, None) is None
+    assert replay_ltu.SolutionDifference(1.5, 1.25) == 0.25
@@ -0,0 +1,35 @@
+# Python Imports
+import numpy as np
+# Local Imports
+import shifts_global_solution as sgs
+
+
+def test_incremental_solver_matches_full_solve(numUpdates=60, period=60.0, maxOffset=3):
+    # Feed the shifts in one sequence at a time, as the LTU does, and compare each solution with a full solve of the same shifts.
+    # The true phases advance by a random fraction of a period each time, and the measured shifts are wrapped and noisy.
+    rng = np.random.default_rng(0)
+    truePhases = np.cumsum(rng.uniform(0, period, numUpdates))
+    (shifts, solver) = ([], sgs.IncrementalShiftSolver())
+    for j in range(1, numUpdates):
+        for i in range(max(0, j - maxOffset), j):
+            shift = (truePhases[j] - truePhases[i] + rng.normal(0, 0.3)) % period
+            shifts.append((i, j, shift, rng.uniform(0.5, 2.0)))
+        incremental = solver.solve(shifts, j + 1, period, log=False)
+        full = sgs.MakeShiftsSelfConsistent(shifts, j + 1, period, log=False)
+        assert np.max(np.abs(incremental[0] - full[0])) < 1e-9 * period
+        assert [shift[:2] for shift in incremental[1]] == [shift[:2] for shift in full[1]]
+    # And the solution should track the true phases (relative to the first sequence)
+    assert np.max(np.abs(full[0] - (truePhases - truePhases[0]))) < 2.0
+
+
+def test_incremental_solver_recovers_after_a_trim(period=60.0):
+    rng = np.random.default_rng(1)
+    truePhases = np.cumsum(rng.uniform(0, period, 20))
+    shifts = [(i, j, (truePhases[j] - truePhases[i]) % period, 1.0) for j in range(20) for i in range(max(0, j - 2), j)]
+    solver = sgs.IncrementalShiftSolver()
+    solver.solve(shifts, 20, period, log=False)
+    # A shorter history isn't an extension of the last one, so the solver has to fall back to a full solve
+    trimmed = [shift for shift in shifts if shift[1] < 12]
+    incremental = solver.solve(trimmed, 12, period, log=False)
+    full = sgs.MakeShiftsSelfConsistent(trimmed, 12, period, log=False)
+    assert np.allclose(incremental[0], full[0])
@@ -0,0 +1,71 @@
+# Python Imports
+import numpy as np
+# Local Imports
+from shift_table import ShiftTable
+import shifts_global_solution as sgs
+
+
+def exampleShifts(numSequences=10, maxOffset=3):
+    return [(i, j, 0.5 * (j - i) + 0.01 * i, 1.0 + 0.1 * j) for j in range(numSequences) for i in range(max(0, j - maxOffset), j)]
+
+
+def test_behaves_like_a_list():
+    shifts = exampleShifts()
+    table = ShiftTable()
+    for shift in shifts:
+        table.append(shift)
+    assert len(table) == len(shifts)
+    assert list(table) == shifts
+    assert table[0] == shifts[0] and table[-1] == shifts[-1]
+    assert list(table[2:5]) == shifts[2:5]
+    assert repr(table) == repr(shifts)
+    assert np.array_equal(np.asarray(table), np.array(shifts))
+
+
+def test_grows_past_its_initial_capacity():
+    shifts = exampleShifts(100)
+    table = ShiftTable()
+    table.extend(shifts)
+    assert len(shifts) > ShiftTable.initialCapacity
+    assert list(table) == shifts
+
+
+def test_copy_is_independent():
+    table = ShiftTable(exampleShifts())
+    copied = table.copy()
+    copied.append((10, 11, 0.5, 1.0))
+    assert len(copied) == len(table) + 1
+
+
+def test_trim():
+    shifts = exampleShifts()
+    table = ShiftTable(shifts)
+    table.trim(6)
+    assert list(table) == [shift for shift in shifts if shift[1] < 6]
+
+
+def test_lookup():
+    shifts = exampleShifts()
+    table = ShiftTable(shifts)
+    assert table.lookup(3, 5) == shifts[[(i, j) for (i, j, _, _) in shifts].index((3, 5))]
+    assert table.lookup(5, 3) is None
+    # The index must follow appends and trims
+    table.append((9, 10, 0.25, 2.0))
+    assert table.lookup(9, 10) == (9, 10, 0.25, 2.0)
+    table.trim(6)
+    assert table.lookup(9, 10) is None
+    assert table.lookup(3, 5) is not None
+
+
+def test_with_max_range():
+    shifts = exampleShifts()
+    table = ShiftTable(shifts)
+    for maxRange in [1, 2, 3]:
+        assert list(table.withMaxRange(maxRange)) == [shift for shift in shifts if shift[1] <= shift[0] + maxRange]
+
+
+def test_solve_with_table_matches_list():
+    shifts = exampleShifts()
+    fromList = sgs.MakeShiftsSelfConsistent(shifts, 10, 60, log=False)
+    fromTable = sgs.MakeShiftsSelfConsistent(ShiftTable(shifts), 10, 60, log=False)
+    assert np.allclose(fromList[0], fromTable[0])
@@ -0,0 +1,56 @@
+# Python Imports
+import numpy as np
+# Local Imports
+import memoryCC
+import simpleCC as scc
+import shifts_global_solution as sgs
+
+
+def runLTU(updates, trimAt=None, trimToLength=None, **kwargs):
+    # Run updates (see conftest.SyntheticUpdates) through the LTU, trimming the history after trimAt updates if requested.
+    # kwargs are passed on to both processNewReferenceSequence and trimLTUHistory.
+    (history, periodHistory, driftHistory, shifts) = ([], [], [], [])
+    solutions = []
+    for (n, (frames, period, drift)) in enumerate(updates):
+        if n == trimAt:
+            (history, periodHistory, driftHistory, shifts) = memoryCC.trimLTUHistory(history, periodHistory, driftHistory, shifts,
+                                                                                      trimToLength, **kwargs)
+        (history, periodHistory, driftHistory, shifts, rollFactor, residuals) = memoryCC.processNewReferenceSequence(frames, period, drift,
+                                                                                                                     history, periodHistory, driftHistory, shifts,
+                                                                                                                     numSamplesPerPeriod=60, maxOffsetToConsider=3,
+                                                                                                                     log=False, **kwargs)
+        solutions.append(rollFactor)
+    return (solutions, list(shifts))
+
+
+def test_cached_terms_match_uncached(syntheticUpdates):
+    history = [scc.resampleImageSection(frames, period, 60) for (frames, period, drift) in syntheticUpdates[:3]]
+    spectralCache = []
+    memoryCC.syncSpectralCache(history, spectralCache)
+    tile = [4, 40, 6, 44]
+    for rect in [tile, [10, 30, 10, 30], [4, 40, 6, 44]]:
+        (fft, energy) = memoryCC.cachedSpectralTerms(history, spectralCache, 1, 60, rect, tile)
+        (expectedFFT, expectedEnergy) = scc.spectralTerms(history[1][:, rect[0]:rect[1], rect[2]:rect[3]], 60)
+        assert np.allclose(fft, expectedFFT) and np.allclose(energy, expectedEnergy)
+    # A rect outside the cached tile means the entry has to be recalculated to cover it
+    (fft, energy) = memoryCC.cachedSpectralTerms(history, spectralCache, 1, 60, [0, 48, 0, 48], tile)
+    assert spectralCache[1][2] == [0, 48, 0, 48]
+    assert np.allclose(fft, scc.spectralTerms(history[1], 60)[0])
+
+
+def test_cache_does_not_change_the_results(syntheticUpdates):
+    (uncachedSolutions, uncachedShifts) = runLTU(syntheticUpdates)
+    (cachedSolutions, cachedShifts) = runLTU(syntheticUpdates, spectralCache=[])
+    assert np.allclose(cachedSolutions, uncachedSolutions)
+    assert np.allclose(np.array(cachedShifts), np.array(uncachedShifts))
+
+
+def test_cache_is_trimmed_with_the_history(syntheticUpdates):
+    # Entries beyond the trimmed length must not be reused for the sequences that replace them
+    (uncachedSolutions, uncachedShifts) = runLTU(syntheticUpdates, trimAt=8, trimToLength=5)
+    spectralCache = []
+    (cachedSolutions, cachedShifts) = runLTU(syntheticUpdates, trimAt=8, trimToLength=5, spectralCache=spectralCache,
+                                             solverState=sgs.IncrementalShiftSolver())
+    assert np.allclose(cachedSolutions, uncachedSolutions)
+    assert np.allclose(np.array(cachedShifts), np.array(uncachedShifts))
+    assert len(spectralCache) == 5 + len(syntheticUpdates) - 8